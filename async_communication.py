@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import threading
+from framing import FrameDecoder, FrameTooLargeError
+from network_communication import ConnectionState, NetworkCommunication
+
+logger = logging.getLogger(__name__)
+
+class PeerProtocol(ConnectionState, asyncio.BufferedProtocol):
+    """Protocol for a single peer connection, decoding frames as data arrives.
+
+    Outbound frames wait in a bounded queue and are handed to the transport whenever
+    it is not paused, so a slow peer fills its own queue instead of loop memory.
+    Frames are flushed one flush window after the first of them is queued, so a burst
+    reaches the socket as a single write.
+    """
+    def __init__(self, communication, address=None):
+        # Outgoing connections know the peer's address up front
+        super().__init__(communication, address, outgoing=address is not None)
+        self.transport = None
+        self.decoder = FrameDecoder(max_frame_size=communication.max_frame_size)
+        self.paused = False
+        self._flush_scheduled = False
+        
+    def connection_made(self, transport):
+        self.transport = transport
+        self.communication._configure_socket(transport.get_extra_info('socket'))
+        # With TLS, the handshake is complete by the time we get here
+        self.tls_object = transport.get_extra_info('ssl_object')
+        if self.tls_object is not None and not self.communication._check_tls(self):
+            self.rejected = True
+            transport.close()
+            return
+        if self.address is None:
+            self.address = transport.get_extra_info('peername')[:2]
+            logger.info("Connection from %s", self.address)
+        if not self.communication._register_connection(self.address, self):
+            # A simultaneous attempt already connected to the same address
+            transport.close()
+        
+    def get_buffer(self, sizehint):
+        # The event loop receives straight into the decoder's buffer
+        return self.decoder.get_buffer()
+        
+    def buffer_updated(self, nbytes):
+        self.decoder.advance(nbytes)
+        frames_in, bytes_in = self.frames_in, self.bytes_in
+        try:
+            for payload in self.decoder.frames():
+                self.communication._process_frame(self, payload)
+        except FrameTooLargeError as e:
+            logger.warning("Dropping connection to %s: %s", self.address, e)
+            self.transport.close()
+            return
+            
+        # A peer over its limits is not read from until it is back within them
+        delay = self.communication._inbound_delay(self, self.frames_in - frames_in, self.bytes_in - bytes_in)
+        if delay and not self.transport.is_closing():
+            self.transport.pause_reading()
+            self.communication.loop.call_later(delay, self._resume_reading)
+            
+    def _resume_reading(self):
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+            
+    def connection_lost(self, exc):
+        self.outbound.close()
+        self.communication._unregister_connection(self.address, self)
+        
+    def pause_writing(self):
+        self.paused = True
+        
+    def resume_writing(self):
+        self.paused = False
+        self._flush()
+        
+    def schedule_flush(self):
+        """Arrange for queued frames to be written. Safe to call from any thread."""
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            communication = self.communication
+            if communication.flush_window:
+                communication._call_in_loop(communication.loop.call_later, communication.flush_window, self._flush)
+            else:
+                communication._call_in_loop(self._flush)
+            
+    def _flush(self):
+        """Hand every queued frame to the transport unless it asked us to pause."""
+        self._flush_scheduled = False
+        if self.paused or self.transport.is_closing():
+            return
+        batch = self.outbound.take(block=False)
+        if batch:
+            frames = [self.compress_frame(data) for data in batch]
+            self.transport.writelines(frames)
+            self.communication.metrics.increment("socket_writes")
+            nbytes = sum(len(data) for data in frames)
+            self.outbound.record_sent(len(frames), nbytes)
+            delay = self.communication._outbound_delay(self, len(frames), nbytes)
+            if delay:
+                # Keep to the peer's limits; frames queued meanwhile wait for this flush
+                self._flush_scheduled = True
+                self.communication.loop.call_later(delay, self._flush)
+            
+    def close(self):
+        """Close the connection. Safe to call from any thread."""
+        # Wakes senders waiting for room at once, rather than once the transport has closed
+        self.outbound.close()
+        self.communication._call_in_loop(self.transport.close)
+        
+class AsyncNetworkCommunication(NetworkCommunication):
+    """Event-loop transport serving every connection from a single thread.
+
+    Exposes the same API as NetworkCommunication. Public methods may be called from
+    any thread; the work is handed over to the loop running in the background.
+    """
+    def __init__(self, port=5000, message_callback=None, connection_callback=None,
+                 connect_timeout=10, **kwargs):
+        super().__init__(port, message_callback, connection_callback, connect_timeout=connect_timeout, **kwargs)
+        self.loop = None
+        self.server = None
+        
+    def start_server(self):
+        """Start the event loop thread and listen for incoming connections."""
+        self.loop = asyncio.new_event_loop()
+        self.running = True
+        self.server_thread = threading.Thread(target=self._run_loop)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        
+        future = asyncio.run_coroutine_threadsafe(self._start_server(), self.loop)
+        try:
+            future.result()
+        except Exception:
+            self.stop()
+            raise
+        self.reconnects.start()
+        if self.multicast:
+            self.multicast.start()
+        logger.info("Server started on port %d", self.port)
+        
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+            
+    async def _start_server(self):
+        tls = dict(ssl=self.tls.server_context, ssl_handshake_timeout=self.connect_timeout) if self.tls else {}
+        self.server = await self.loop.create_server(
+            lambda: PeerProtocol(self),
+            '0.0.0.0',
+            self.port,
+            reuse_address=True,
+            **tls
+        )
+        
+    def _in_loop_thread(self):
+        return threading.current_thread() is self.server_thread
+        
+    def _call_in_loop(self, callback, *args):
+        """Run callback on the loop thread, directly if we are already on it."""
+        if self._in_loop_thread():
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+            
+    async def _connect(self, ip, port):
+        if self.find_peer(ip, port):
+            logger.debug("Already connected to peer at %s:%d", ip, port)
+            return True
+        self.metrics.increment("connect_attempts")
+        tls = {}
+        if self.tls:
+            # Without a server name asyncio uses the IP address, which offers no saved session
+            tls = dict(ssl=self.tls.client_context, server_hostname=self._tls_server_name(ip, port),
+                       ssl_handshake_timeout=self.connect_timeout)
+        try:
+            _, protocol = await asyncio.wait_for(
+                self.loop.create_connection(lambda: PeerProtocol(self, (ip, port)), ip, port, **tls),
+                self.connect_timeout
+            )
+        except Exception as e:
+            logger.warning("Error connecting to peer at %s:%d: %s", ip, port, e)
+            self.metrics.increment("connect_failures")
+            return False
+        if protocol.rejected:
+            self.metrics.increment("connect_failures")
+            return False
+            
+        logger.info("Connected to peer at %s:%d", ip, port)
+        return True
+        
+    def connect_to_peer(self, ip, port):
+        """Connect to a peer on the network, blocking until the attempt finishes."""
+        if not self.running:
+            return False
+        if self._in_loop_thread():
+            raise RuntimeError("connect_to_peer would block the event loop; use connect_to_peer_async")
+        future = asyncio.run_coroutine_threadsafe(self._connect(ip, port), self.loop)
+        return future.result()
+        
+    def connect_to_peer_async(self, ip, port, delay=0, callback=None):
+        """Connect to a peer on the loop without blocking or creating a thread."""
+        if not self.running:
+            return
+            
+        def attempt():
+            task = self.loop.create_task(self._connect(ip, port))
+            if callback:
+                task.add_done_callback(lambda t: callback(t.result()))
+                
+        self._call_in_loop(self.loop.call_later, delay, attempt)
+        
+    def _wait_for_room(self, conn):
+        # The loop thread makes the room, so it never waits for it
+        if not self._in_loop_thread():
+            super()._wait_for_room(conn)
+            
+    def _queue_frame(self, conn, data, can_block=True):
+        """Queue a frame for a peer and schedule the write on the loop."""
+        # Blocking the loop thread would stall every connection, so it never waits
+        queued = super()._queue_frame(conn, data, can_block and not self._in_loop_thread())
+        if queued:
+            conn.schedule_flush()
+        return queued
+            
+    def stop(self):
+        """Stop the server, close all connections and shut down the event loop."""
+        if not self.running:
+            return
+        self.running = False
+        self.reconnects.stop()
+        if self.multicast:
+            self.multicast.stop()
+        
+        if self.loop and self.loop.is_running():
+            if not self._in_loop_thread():
+                future = asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+                try:
+                    future.result(timeout=5)
+                except Exception as e:
+                    logger.error("Error during shutdown: %s", e)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            
+        logger.info("Network communication stopped")
+        
+    async def _shutdown(self):
+        if self.server:
+            self.server.close()
+        for protocol in list(self.connections.values()):
+            protocol.transport.close()
+        if self.server:
+            await self.server.wait_closed()
+        self.connections.clear()
@@ -0,0 +1,70 @@
+"""Compare the JSON and binary codecs: encode/decode time and bytes on the wire.
+
+Run from the repository root:
+
+    python benchmarks/codec_bench.py
+    python benchmarks/codec_bench.py --number 20000 --json results.json
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from codec import CODECS, decode_payload
+from framing import encode_frame
+
+# Representative frames: mostly short chat, occasionally long chat and control messages
+SAMPLES = {
+    "chat_short": {"type": "message", "content": "hey, lunch?"},
+    "chat_long": {"type": "message", "content": "Lorem ipsum dolor sit amet. " * 40},
+    "file_offer": {
+        "type": "file_offer",
+        "transfer_id": "5f0c9a2e7b6d4c1fa3e8b9d2c4f6a1e0",
+        "name": "holiday photos.zip",
+        "size": 734003200,
+        "file_key": "3b1f4d9e2c7a6b5f8e0d1c2b3a4f5e6d7c8b9a0f",
+    },
+    "nested": {
+        "type": "status",
+        "peers": [{"ip": "192.168.1.%d" % i, "port": 5000 + i, "online": i % 2 == 0} for i in range(8)],
+        "load": 0.42,
+    },
+}
+
+def run(number):
+    results = []
+    for sample_name, message in SAMPLES.items():
+        for codec in CODECS.values():
+            payload = codec.encode(message)
+            assert decode_payload(payload) == message
+            encode_time = timeit.timeit(lambda: codec.encode(message), number=number) / number
+            decode_time = timeit.timeit(lambda: decode_payload(payload), number=number) / number
+            results.append({
+                "sample": sample_name,
+                "codec": codec.name,
+                "wire_bytes": len(encode_frame(payload)),
+                "encode_us": encode_time * 1e6,
+                "decode_us": decode_time * 1e6,
+            })
+    return results
+    
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LNChat message codecs")
+    parser.add_argument("--number", type=int, default=10000, help="iterations per measurement (default: 10000)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to a JSON file")
+    args = parser.parse_args()
+    
+    results = run(args.number)
+    print(f"{'sample':<12} {'codec':<8} {'bytes':>7} {'encode us':>10} {'decode us':>10}")
+    for r in results:
+        print(f"{r['sample']:<12} {r['codec']:<8} {r['wire_bytes']:>7} {r['encode_us']:>10.2f} {r['decode_us']:>10.2f}")
+        
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+"""Load-generation benchmark: simulated peers on 127.0.0.1 using the real transports.
+
+A hub node and N client nodes are started in this process without Tk or zeroconf.
+In "send" mode every client sends to the hub with send_message; in "broadcast" mode
+the hub sends to every client with broadcast_message. In "room" mode every client
+broadcasts to every other client, over a full mesh of connections, through the hub
+acting as a relay, or as UDP multicast datagrams over a mesh (--topology). Each
+message carries its send time, so the receiver measures end-to-end latency.
+
+The report also counts socket writes and, on Linux, the TCP segments sent during the
+run, to show how well frames are coalesced (--flush-window 0 turns coalescing off).
+In send mode, --flood adds a client that sends to the hub as fast as it can, to show
+how much the per-peer inbound limits protect the other clients' latency. In room mode
+through a relay, the flooding client broadcasts to the room instead: the relay holds it
+to its limits, while the clients' connections to the relay, which carry everyone's
+messages, are not limited.
+
+With --tls every connection is encrypted. Before the load starts, an extra client
+connects to the hub (a client in a mesh) --handshakes times with a fresh TLS session cache and as many
+times resuming its last session, and the report gives the median time until each
+connection is ready; without --tls the same numbers show plain TCP. Compare a run
+with --tls against one without to see the throughput overhead of encryption.
+
+Run from the repository root:
+
+    python benchmarks/loopback_bench.py --peers 8 --rate 500 --size 200 --duration 10
+    python benchmarks/loopback_bench.py --mode broadcast --json after.json --compare before.json
+    python benchmarks/loopback_bench.py --mode room --topology relay --peers 32 --rate 20
+    python benchmarks/loopback_bench.py --mode broadcast --rate 800 --flush-window 0
+    python benchmarks/loopback_bench.py --flood --inbound-rate 0
+    python benchmarks/loopback_bench.py --mode room --topology relay --peers 8 --rate 300 --flood
+    python benchmarks/loopback_bench.py --json plain.json && python benchmarks/loopback_bench.py --tls --compare plain.json
+
+The JSON report includes the commit it was produced from, so runs can be compared across commits.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from network_communication import DEFAULT_FLUSH_WINDOW, NetworkCommunication, SEND_POLICIES, SEND_POLICY_BLOCK
+from flow_control import DEFAULT_INBOUND_RATE
+from async_communication import AsyncNetworkCommunication
+from tls import TLSIdentity
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+    
+TRANSPORTS = {
+    "threads": NetworkCommunication,
+    "asyncio": AsyncNetworkCommunication,
+}
+
+# Which way each compared metric should move; the rest only describe the run
+HIGHER_IS_BETTER = {"throughput_msgs_s", "throughput_mb_s"}
+LOWER_IS_BETTER = {"lost", "dropped_frames", "p50", "p99", "p999", "max", "mean",
+                   "threads_peak", "rss_peak_mb", "max_rss_mb", "connections", "socket_writes",
+                   "tcp_segments_out", "full", "resumed"}
+                   
+class LatencyRecorder:
+    """Collects the latency of every received benchmark message."""
+    def __init__(self):
+        self.latencies = []  # Nanoseconds; list.append is atomic, so receivers need no lock
+        self.flood_received = 0
+        
+    def on_message(self, address, message):
+        now = time.perf_counter_ns()
+        if message.get("flood"):
+            self.flood_received += 1
+            return
+        content = message.get("content", "")
+        _, sent, _ = content.split(":", 2)
+        self.latencies.append(now - int(sent))
+        
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+        
+def current_rss_mb():
+    """Resident set size of this process, or None where /proc is unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+        
+def tcp_segments_out():
+    """TCP segments this host has sent, or None where /proc is unavailable.
+
+    The count is host-wide, so it only describes the benchmark on an otherwise quiet machine.
+    """
+    try:
+        with open("/proc/net/snmp") as f:
+            header, values = [line.split() for line in f if line.startswith("Tcp:")]
+        return int(values[header.index("OutSegs")])
+    except (OSError, ValueError):
+        return None
+        
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+    
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+        
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+    
+def measure_handshakes(transport, options, target, count):
+    """Time connections to a node until ready, first with full handshakes, then resumed.
+
+    Returns the median milliseconds of each kind and how many connections resumed.
+    """
+    ready = threading.Event()
+    address = ("127.0.0.1", target.port)
+    # Listening on port 0 tells the target there is nothing to reconnect to
+    prober = transport(port=0, connection_callback=lambda address, connected: connected and ready.set(),
+                       reconnect=False, tls=TLSIdentity.generate("bench") if target.tls else None, **options)
+    prober.start_server()
+    if target.tls:
+        prober.pin_peer(*address, None, target.tls.fingerprint)
+        
+    def connect():
+        ready.clear()
+        start = time.perf_counter_ns()
+        if not prober.connect_to_peer(*address) or not ready.wait(5):
+            raise RuntimeError("Could not connect to the handshake target")
+        elapsed = time.perf_counter_ns() - start
+        for conn in list(prober.connections.values()):
+            conn.close()
+        while prober.connections:
+            time.sleep(0.001)
+        return elapsed
+        
+    full = []
+    for _ in range(count):
+        if prober.tls:
+            prober.tls.sessions.clear()
+        full.append(connect())
+    resumed = [connect() for _ in range(count)] if prober.tls else []
+    counters = prober.metrics.snapshot()["counters"]
+    prober.stop()
+    median = lambda values: percentile(sorted(values), 0.5) / 1e6 if values else None
+    return {"full": median(full), "resumed": median(resumed)}, counters.get("tls_resumed_handshakes", 0)
+    
+def sender(send, size, rate, deadline, counter, index):
+    """Send messages of the given size at rate per second (0 = unthrottled) until deadline."""
+    padding = "x" * size
+    interval = 1 / rate if rate else 0
+    next_send = time.perf_counter()
+    seq = 0
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        if interval:
+            if now < next_send:
+                time.sleep(next_send - now)
+            next_send += interval
+        prefix = f"{index}.{seq}:{time.perf_counter_ns()}:"
+        send({"type": "message", "content": prefix + padding[len(prefix):]})
+        seq += 1
+    counter[index] = seq
+    
+def run(args):
+    transport = TRANSPORTS[args.transport]
+    options = dict(send_policy=args.send_policy, send_queue_size=args.send_queue_size,
+                   compression=not args.no_compression, flush_window=args.flush_window,
+                   inbound_rate=args.inbound_rate or None)
+    recorder = LatencyRecorder()
+    hub_port = args.port or free_port()
+    # Every node has its own certificate, like separate instances would
+    identity = lambda: TLSIdentity.generate("bench") if args.tls else None
+    
+    mesh = args.mode == "room" and args.topology in ("mesh", "multicast")
+    # In room mode the hub only relays; its own user's copies are not measured
+    hub = transport(port=hub_port, message_callback=None if args.mode == "room" else recorder.on_message,
+                    relay_host=not mesh, tls=identity(), **options)
+    if args.mode == "room" and args.topology == "multicast":
+        # Repairs still need the mesh; a private port keeps other runs' datagrams out
+        options.update(multicast=True, multicast_port=free_port())
+    clients = [transport(port=free_port(), message_callback=recorder.on_message, tls=identity(), **options)
+               for _ in range(args.peers)]
+    nodes = clients if mesh else [hub] + clients
+    flooder = None
+    if args.flood and (args.mode == "send" or args.mode == "room" and not mesh):
+        flooder = transport(port=free_port(), tls=identity(), **options)
+        nodes.append(flooder)
+    for node in nodes:
+        node.start_server()
+    hub_address = ("127.0.0.1", hub_port)
+    # The hub is not started in a mesh, where the clients connect to each other
+    handshake_ms, handshakes_resumed = measure_handshakes(transport, options, clients[0] if mesh else hub,
+                                                          args.handshakes)
+    if mesh:
+        # Every pair of clients shares one connection
+        for index, client in enumerate(clients):
+            for other in clients[index + 1:]:
+                if not client.connect_to_peer("127.0.0.1", other.port):
+                    raise RuntimeError("Could not connect to a peer")
+    else:
+        for client in clients + ([flooder] if flooder else []):
+            client.relay = hub_address
+            if not client.connect_to_peer(*hub_address):
+                raise RuntimeError("Could not connect to the hub")
+            
+    # Wait for every connection to be registered and its handshake to finish
+    expected_connections = args.peers * (args.peers - 1) if mesh else 2 * (len(nodes) - 1)
+    settle_deadline = time.monotonic() + 5 + args.peers / 10
+    while time.monotonic() < settle_deadline and (
+            sum(len(node.connections) for node in nodes) < expected_connections
+            or not all(conn.handshake_done for node in nodes for conn in list(node.connections.values()))):
+        time.sleep(0.01)
+    connections = sum(len(node.connections) for node in nodes) // 2
+    if flooder:
+        # A misbehaving peer, ignoring the limits the hub advertised
+        for conn in list(flooder.connections.values()):
+            conn.outbound_limiter = None
+    
+    if args.mode == "send":
+        sends = [lambda message, client=client: client.send_message(hub_address, message) for client in clients]
+        fanout = 1
+    elif args.mode == "broadcast":
+        sends = [hub.broadcast_message]
+        fanout = args.peers
+    else:
+        sends = [client.broadcast_message for client in clients]
+        fanout = args.peers - 1
+        
+    rss_before = current_rss_mb()
+    threads_peak = threading.active_count()
+    counter = [0] * len(sends)
+    segments_before = tcp_segments_out()
+    start = time.perf_counter()
+    deadline = start + args.duration
+    senders = [threading.Thread(target=sender, args=(send, args.size, args.rate, deadline, counter, i))
+               for i, send in enumerate(sends)]
+    flood_counter = [0]
+    if flooder:
+        if args.mode == "send":
+            flood = lambda message: flooder.send_message(hub_address, dict(message, flood=True))
+        else:
+            flood = lambda message: flooder.broadcast_message(dict(message, flood=True))
+        senders.append(threading.Thread(target=sender, args=(flood, args.size, 0, deadline, flood_counter, 0)))
+    for thread in senders:
+        thread.start()
+        
+    rss_peak = rss_before
+    while any(thread.is_alive() for thread in senders):
+        threads_peak = max(threads_peak, threading.active_count())
+        rss = current_rss_mb()
+        if rss is not None:
+            rss_peak = max(rss_peak or 0, rss)
+        time.sleep(0.05)
+    for thread in senders:
+        thread.join()
+        
+    # Let in-flight messages arrive
+    expected = sum(counter) * fanout
+    drain_deadline = time.perf_counter() + args.drain_timeout
+    while len(recorder.latencies) < expected and time.perf_counter() < drain_deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    segments_after = tcp_segments_out()
+    
+    dropped = sum(stats["dropped_frames"] for node in nodes for stats in node.get_queue_stats().values())
+    counters = [node.metrics.snapshot()["counters"] for node in nodes]
+    frames_out = sum(c.get("frames_out", 0) for c in counters)
+    socket_writes = sum(c.get("socket_writes", 0) for c in counters)
+    for node in nodes:
+        node.stop()
+        
+    latencies = sorted(recorder.latencies)
+    received = len(latencies)
+    to_ms = lambda ns: None if ns is None else ns / 1e6
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": {
+            "sent": sum(counter),
+            "expected": expected,
+            "received": received,
+            "lost": expected - received,
+            "dropped_frames": dropped,
+            "connections": connections,
+            "handshake_ms": handshake_ms,
+            "handshakes_resumed": handshakes_resumed,
+            "flood_sent": flood_counter[0],
+            "flood_received": recorder.flood_received,
+            "socket_writes": socket_writes,
+            "frames_per_write": frames_out / socket_writes if socket_writes else None,
+            "tcp_segments_out": (segments_after - segments_before
+                                 if segments_before is not None and segments_after is not None else None),
+            "elapsed_s": elapsed,
+            "throughput_msgs_s": received / elapsed,
+            "throughput_mb_s": received * args.size / elapsed / 2 ** 20,
+            "latency_ms": {
+                "p50": to_ms(percentile(latencies, 0.50)),
+                "p99": to_ms(percentile(latencies, 0.99)),
+                "p999": to_ms(percentile(latencies, 0.999)),
+                "max": to_ms(latencies[-1] if latencies else None),
+                "mean": to_ms(sum(latencies) / received if received else None),
+            },
+            "threads_peak": threads_peak,
+            "rss_before_mb": rss_before,
+            "rss_peak_mb": rss_peak,
+            "max_rss_mb": peak_rss_mb(),
+        },
+    }
+    
+def flatten(results, prefix=""):
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{name}."))
+        else:
+            flat[prefix + name] = value
+    return flat
+    
+def print_report(report, baseline=None):
+    current = flatten(report["results"])
+    previous = flatten(baseline["results"]) if baseline else {}
+    if baseline:
+        print(f"{'metric':<24} {'baseline':>12} {'current':>12} {'change':>9}")
+    for name, value in current.items():
+        line = f"{name:<24} "
+        if baseline:
+            old = previous.get(name)
+            line += f"{'-' if old is None else f'{old:.3f}':>12} "
+        line += f"{'-' if value is None else f'{value:.3f}':>12}"
+        old = previous.get(name)
+        if baseline and old and value is not None:
+            change = (value - old) / old * 100
+            line += f" {change:>+8.1f}%"
+            metric = name.split(".")[-1]
+            if change and (metric in HIGHER_IS_BETTER or metric in LOWER_IS_BETTER):
+                line += " better" if (change > 0) == (metric in HIGHER_IS_BETTER) else " worse"
+        print(line)
+        
+def main():
+    parser = argparse.ArgumentParser(description="Loopback load and latency benchmark for LNChat transports")
+    parser.add_argument("--transport", choices=sorted(TRANSPORTS), default="threads")
+    parser.add_argument("--mode", choices=("send", "broadcast", "room"), default="send",
+                        help="clients send to the hub, the hub broadcasts to every client, or every client "
+                             "broadcasts to the others (default: send)")
+    parser.add_argument("--topology", choices=("relay", "mesh", "multicast"), default="relay",
+                        help="in room mode, broadcast through the hub as a relay, over a full mesh, or as "
+                             "multicast datagrams (default: relay)")
+    parser.add_argument("--peers", type=int, default=4, help="number of client peers (default: 4)")
+    parser.add_argument("--rate", type=float, default=200,
+                        help="messages per second per sender, 0 for as fast as possible (default: 200)")
+    parser.add_argument("--size", type=int, default=100, help="message content size in bytes (default: 100)")
+    parser.add_argument("--duration", type=float, default=5, help="seconds to send for (default: 5)")
+    parser.add_argument("--drain-timeout", type=float, default=10,
+                        help="seconds to wait for in-flight messages after sending stops (default: 10)")
+    parser.add_argument("--send-policy", choices=SEND_POLICIES, default=SEND_POLICY_BLOCK)
+    parser.add_argument("--send-queue-size", type=int, default=1000)
+    parser.add_argument("--no-compression", action="store_true")
+    parser.add_argument("--inbound-rate", type=float, default=DEFAULT_INBOUND_RATE,
+                        help=f"frames per second each node accepts from a peer, 0 for no limit "
+                             f"(default: {DEFAULT_INBOUND_RATE})")
+    parser.add_argument("--flood", action="store_true",
+                        help="in send mode, or room mode through a relay, add a client sending as fast as it can")
+    parser.add_argument("--flush-window", type=float, default=DEFAULT_FLUSH_WINDOW,
+                        help=f"seconds a writer waits to coalesce frames, 0 to write at once "
+                             f"(default: {DEFAULT_FLUSH_WINDOW})")
+    parser.add_argument("--tls", action="store_true", help="encrypt every connection")
+    parser.add_argument("--handshakes", type=int, default=20,
+                        help="connections timed for each kind of handshake (default: 20)")
+    parser.add_argument("--port", type=int, default=0, help="hub port (default: any free port)")
+    parser.add_argument("--json", metavar="PATH", help="write the report to a JSON file")
+    parser.add_argument("--compare", metavar="PATH", help="show changes against an earlier JSON report")
+    parser.add_argument("--verbose", action="store_true", help="show the transports' own output")
+    args = parser.parse_args()
+    if args.tls and args.mode == "room" and args.topology == "multicast":
+        parser.error("multicast datagrams cannot be encrypted; use --topology mesh or relay with --tls")
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+            
+    if args.verbose:
+        report = run(args)
+    else:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            report = run(args)
+            
+    print_report(report, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Measure LNChat cold start: time to a running node in headless mode, and import cost per mode.
+
+Run from the repository root:
+
+    python benchmarks/startup_bench.py
+    python benchmarks/startup_bench.py --runs 10 --json results.json
+
+The GUI's own startup time is printed by main.py on every launch ("Started in ...").
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, "main.py")
+
+# Modules each mode imports beyond the networking core
+UI_MODULES = {"headless": "console_ui", "GUI": "chat_ui"}
+
+def time_headless(port, data_dir):
+    """Start a headless node, quit it straight away and return (reported ms, wall ms)."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, MAIN, str(port), "--headless", "--data-dir", data_dir],
+        input="/quit\n", capture_output=True, text=True, timeout=60, cwd=ROOT
+    )
+    wall = (time.perf_counter() - start) * 1000
+    match = re.search(r"Started in (\d+) ms", result.stdout + result.stderr)
+    if not match:
+        raise RuntimeError(f"Headless node did not start:\n{result.stdout}{result.stderr}")
+    return float(match.group(1)), wall
+    
+def time_import(module):
+    """Return the milliseconds a fresh interpreter spends importing module, or None if it fails."""
+    code = f"import time; t = time.perf_counter(); import {module}; print((time.perf_counter() - t) * 1000)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=ROOT)
+    return float(result.stdout) if result.returncode == 0 else None
+    
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LNChat startup time")
+    parser.add_argument("--runs", type=int, default=5, help="launches per measurement (default: 5)")
+    parser.add_argument("--port", type=int, default=5900, help="first port to use (default: 5900)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results to a JSON file")
+    args = parser.parse_args()
+    
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        runs = [time_headless(args.port + i, data_dir) for i in range(args.runs)]
+    results["headless_ready_ms"] = statistics.median(reported for reported, _ in runs)
+    results["headless_wall_ms"] = statistics.median(wall for _, wall in runs)
+    for mode, module in UI_MODULES.items():
+        times = [time_import(module) for _ in range(args.runs)]
+        results[f"{mode}_ui_import_ms"] = None if None in times else statistics.median(times)
+        
+    for name, value in results.items():
+        print(f"{name:<24} {'unavailable' if value is None else f'{value:.1f}'}")
+        
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            
+if __name__ == "__main__":
+    main()
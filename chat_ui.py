@@ -1,10 +1,158 @@
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
+from tkinter import ttk, scrolledtext, messagebox, filedialog
 import threading
 import time
+import queue
+import itertools
+from collections import deque
 
+# Batches deleting more peer rows than this rebuild the list box instead
+PEER_LIST_REBUILD_THRESHOLD = 50
+
+# Most search hits listed at once
+SEARCH_RESULTS_LIMIT = 200
+
+class MessageRing:
+    """Fixed-capacity ring buffer of (key, sender, content) message records.
+
+    Keys are tuples starting with (timestamp, id) and records are kept in key order,
+    so lookups relative to a key are binary searches. Records mostly arrive in that
+    order, but one stamped by a peer's clock or brought in by history sync can be
+    older than the newest, and is inserted at its place. Once the buffer is full the
+    oldest record is overwritten.
+    """
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self._records = [None] * capacity
+        self._start = 0  # Slot of the oldest record
+        self._count = 0
+        
+    def __len__(self):
+        return self._count
+        
+    def _get(self, index):
+        return self._records[(self._start + index) % self.capacity]
+        
+    @property
+    def oldest_key(self):
+        return self._get(0)[0] if self._count else None
+        
+    @property
+    def newest_key(self):
+        return self._get(self._count - 1)[0] if self._count else None
+        
+    def add(self, record):
+        """Insert a record in key order, overwriting the oldest one when full.
+
+        Returns False if the buffer is full and the record is older than all of them.
+        """
+        index = self._bisect(record[0])
+        if self._count == self.capacity:
+            if index == 0:
+                return False
+            self._start = (self._start + 1) % self.capacity
+            self._count -= 1
+            index -= 1
+        # Records newer than this one move up a slot; none do in the usual case
+        for position in range(self._count, index, -1):
+            self._records[(self._start + position) % self.capacity] = self._get(position - 1)
+        self._records[(self._start + index) % self.capacity] = record
+        self._count += 1
+        return True
+        
+    def _bisect(self, key):
+        """Index of the first record whose key is greater than or equal to key."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._get(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+        
+    def newest(self, limit):
+        """Return the newest records, oldest first."""
+        return [self._get(index) for index in range(max(0, self._count - limit), self._count)]
+        
+    def before(self, key, limit):
+        """Return up to limit records older than key, oldest first."""
+        stop = self._bisect(key)
+        return [self._get(index) for index in range(max(0, stop - limit), stop)]
+        
+    def after(self, key, limit):
+        """Return up to limit records newer than key, oldest first."""
+        start = self._bisect(key)
+        if start < self._count and self._get(start)[0] == key:
+            start += 1
+        return [self._get(index) for index in range(start, min(self._count, start + limit))]
+        
+class PeerList:
+    """Peers and the list box rows showing them, indexed both ways.
+
+    Rows show the peers whose label contains the filter text, in the order the peers
+    connected. Looking up the peer on a row or the row of a peer is a dict or list
+    access, and a batch of changes touches only the rows that changed, so the list
+    stays cheap to maintain with thousands of peers.
+    """
+    def __init__(self):
+        self.labels = {}  # {address: label}, in the order peers connected
+        self.rows = []  # Address shown on each row
+        self.row_of = {}  # {address: row}, for shown peers only
+        self.filter = ""
+        
+    def __len__(self):
+        return len(self.labels)
+        
+    def address_at(self, row):
+        return self.rows[row] if 0 <= row < len(self.rows) else None
+        
+    def _matches(self, label):
+        return self.filter in label.lower()
+        
+    def update(self, changes):
+        """Apply {address: label, or None if the peer left} changes.
+
+        Returns the rows to delete, highest first, and the labels to append, which is
+        how the list box must change to match.
+        """
+        deleted = []
+        appended = []
+        for address, label in changes.items():
+            old = self.labels.get(address)
+            if old == label:
+                continue
+            if address in self.row_of:
+                deleted.append(self.row_of.pop(address))
+            self.labels.pop(address, None)
+            if label is not None:
+                self.labels[address] = label
+                if self._matches(label):
+                    appended.append(address)
+                    
+        if deleted:
+            gone = set(deleted)
+            self.rows = [address for row, address in enumerate(self.rows) if row not in gone]
+            for row in range(min(deleted), len(self.rows)):
+                self.row_of[self.rows[row]] = row
+        for address in appended:
+            self.row_of[address] = len(self.rows)
+            self.rows.append(address)
+        deleted.sort(reverse=True)
+        return deleted, [self.labels[address] for address in appended]
+        
+    def set_filter(self, text):
+        """Show only the peers whose label contains text. Returns the labels of every row."""
+        self.filter = text.strip().lower()
+        self.rows = [address for address, label in self.labels.items() if self._matches(label)]
+        self.row_of = {address: row for row, address in enumerate(self.rows)}
+        return [self.labels[address] for address in self.rows]
+        
 class ChatUI:
-    def __init__(self, send_callback=None, connect_callback=None):
+    def __init__(self, send_callback=None, connect_callback=None, frame_rate=30, max_batch=500,
+                 history_size=10000, history_window=500, history_page=100, send_file_callback=None,
+                 history_loader=None, broadcast_callback=None, search_callback=None,
+                 file_response_callback=None):
         self.root = tk.Tk()
         self.root.title("LNChat - Local Network Chat")
         self.root.geometry("800x600")
@@ -12,13 +160,50 @@ class ChatUI:
         
         self.send_callback = send_callback
         self.connect_callback = connect_callback
+        self.send_file_callback = send_file_callback
+        self.broadcast_callback = broadcast_callback
+        self.file_response_callback = file_response_callback  # (transfer_id, accepted)
+        # search_callback(text, address=None, limit=...) returns (key, peer, sender, content)
+        # records from the stored history, newest first
+        self.search_callback = search_callback
         
         self.peers = {}  # {address: name}
         self.selected_peer = None
+        self.peer_list = PeerList()
+        self._peer_changes = {}  # {address: label or None} since the list box was last updated
+        self._filter_job = None
+        self._search_job = None
+        # Searches run on their own thread and post their results back as events
+        self._search_requests = queue.SimpleQueue()
+        self._search_thread = None
+        self._search_generation = 0  # Number of the search whose results are wanted
+        
+        # Updates from network threads are queued here and applied on the Tk thread
+        self._events = queue.SimpleQueue()
+        self.frame_interval = max(1, int(1000 / frame_rate))
+        self.max_batch = max_batch
+        
+        # Recent message records live in a ring buffer; only a window of them is rendered.
+        # history_loader(before=None, after=None, limit=...) pages in older records from
+        # persistent storage, keyed by (timestamp, id).
+        self.history = MessageRing(history_size)
+        self.history_window = min(history_window, history_size)
+        self.history_page = history_page
+        self.history_loader = history_loader
+        self._view = deque()  # (key, line count) of each rendered record, oldest first
+        self._loaded_oldest = False  # The loader has no records older than the view
+        self._paging_scheduled = False
+        self._local_seq = itertools.count(1)  # Orders messages that have no persistent id
         
         self._create_ui()
         self._setup_styles()
         
+        # Start with the most recent page of stored history
+        if self.history_loader:
+            self._append_records(self.history_loader(limit=self.history_page))
+        
+        self.root.after(self.frame_interval, self._drain_events)
+        
     def _setup_styles(self):
         """Setup custom styles for the UI."""
         style = ttk.Style()
@@ -48,11 +233,17 @@ class ChatUI:
         self.connection_status = ttk.Label(self.connection_frame, text="Disconnected", style="Disconnected.TLabel")
         self.connection_status.pack(side=tk.LEFT)
         
+        # Filter-as-you-type for long peer lists
+        self.peer_filter = tk.StringVar()
+        self.peer_filter.trace_add("write", self._on_filter_changed)
+        ttk.Entry(left_panel, textvariable=self.peer_filter, font=("Arial", 10)).pack(fill=tk.X, pady=(0, 5))
+        
         # Peers listbox with scrollbar
         peers_frame = ttk.Frame(left_panel)
         peers_frame.pack(fill=tk.BOTH, expand=True)
         
-        self.peers_listbox = tk.Listbox(peers_frame, font=("Arial", 10))
+        # Without exportselection=False, selecting text in the filter would clear the selected peer
+        self.peers_listbox = tk.Listbox(peers_frame, font=("Arial", 10), exportselection=False)
         self.peers_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         
         peers_scrollbar = ttk.Scrollbar(peers_frame, orient=tk.VERTICAL, command=self.peers_listbox.yview)
@@ -63,12 +254,27 @@ class ChatUI:
         self.peers_listbox.bind('<<ListboxSelect>>', self._on_peer_selected)
         
         # Right panel - Chat
+        chat_header = ttk.Frame(right_panel)
+        chat_header.pack(fill=tk.X, pady=(0, 5))
+        ttk.Label(chat_header, text="Chat", font=("Arial", 12, "bold")).pack(side=tk.LEFT)
+        
+        # Search box over the stored history; hits are listed above the chat
+        self.search_text = tk.StringVar()
+        self.search_text.trace_add("write", self._on_search_changed)
+        self.search_selected_only = tk.BooleanVar(value=False)
+        self.search_results = tk.Listbox(right_panel, font=("Arial", 10), height=8)
+        if self.search_callback:
+            ttk.Checkbutton(chat_header, text="Selected peer only", variable=self.search_selected_only,
+                            command=self._on_search_changed).pack(side=tk.RIGHT)
+            ttk.Entry(chat_header, textvariable=self.search_text, font=("Arial", 10),
+                      width=24).pack(side=tk.RIGHT, padx=(0, 5))
+            ttk.Label(chat_header, text="Search:").pack(side=tk.RIGHT, padx=(0, 5))
+            
         # Chat history
-        ttk.Label(right_panel, text="Chat", font=("Arial", 12, "bold")).pack(pady=(0, 5), anchor=tk.W)
-        
         self.chat_history = scrolledtext.ScrolledText(right_panel, wrap=tk.WORD, font=("Arial", 10))
         self.chat_history.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
         self.chat_history.config(state=tk.DISABLED)
+        self.chat_history.config(yscrollcommand=self._on_history_scroll)
         
         # Message input and send button
         input_frame = ttk.Frame(right_panel)
@@ -81,6 +287,12 @@ class ChatUI:
         self.send_button = ttk.Button(input_frame, text="Send", command=self._on_send_message)
         self.send_button.pack(side=tk.RIGHT)
         
+        self.send_all_button = ttk.Button(input_frame, text="Send to All", command=self._on_send_to_all)
+        self.send_all_button.pack(side=tk.RIGHT, padx=(0, 5))
+        
+        self.send_file_button = ttk.Button(input_frame, text="Send File...", command=self._on_send_file)
+        self.send_file_button.pack(side=tk.RIGHT, padx=(0, 5))
+        
         # Initially disable message input and send button
         self._update_input_state()
         
@@ -88,93 +300,368 @@ class ChatUI:
         """Handle peer selection from the listbox."""
         selection = self.peers_listbox.curselection()
         if selection:
-            index = selection[0]
-            peer_info = self.peers_listbox.get(index)
-            
-            # Extract address from peer info
-            for address, name in self.peers.items():
-                if f"{name} ({address[0]}:{address[1]})" == peer_info:
-                    self.selected_peer = address
-                    self._update_input_state()
-                    return
+            address = self.peer_list.address_at(selection[0])
+            if address is not None:
+                self.selected_peer = address
+                self._update_input_state()
+                return
                     
         self.selected_peer = None
         self._update_input_state()
         
+    def _on_search_changed(self, *args):
+        """Search the history once typing pauses."""
+        if self._search_job is not None:
+            self.root.after_cancel(self._search_job)
+        self._search_job = self.root.after(200, self._apply_search)
+        
+    def _apply_search(self):
+        self._search_job = None
+        self._search_generation += 1
+        text = self.search_text.get().strip()
+        if not text:
+            self.search_results.pack_forget()
+            return
+        address = self.selected_peer if self.search_selected_only.get() else None
+        self._search_requests.put((self._search_generation, text, address))
+        if self._search_thread is None:
+            self._search_thread = threading.Thread(target=self._search_loop)
+            self._search_thread.daemon = True
+            self._search_thread.start()
+        
+    def _search_loop(self):
+        """Run searches off the Tk thread, skipping those further typing has overtaken."""
+        while True:
+            request = self._search_requests.get()
+            try:
+                while True:
+                    request = self._search_requests.get_nowait()
+            except queue.Empty:
+                pass
+            generation, text, address = request
+            try:
+                records = self.search_callback(text, address, limit=SEARCH_RESULTS_LIMIT)
+            except Exception as e:
+                records = []
+                self.add_message("System", f"Search failed: {e}")
+            self._events.put(("search", generation, records))
+            
+    def _show_search_results(self, generation, records):
+        if generation != self._search_generation:
+            return  # The text changed since this search started
+        lines = []
+        for key, peer, sender, content in records:
+            timestamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(key[0]))
+            lines.append(f"[{timestamp}] {sender}: {' '.join(content.split())}")
+        self.search_results.delete(0, tk.END)
+        self.search_results.insert(tk.END, *(lines or ["No messages found"]))
+        if not self.search_results.winfo_ismapped():
+            self.search_results.pack(fill=tk.X, pady=(0, 5), before=self.chat_history)
+        
+    def _on_filter_changed(self, *args):
+        """Refilter the peer list once typing pauses."""
+        if self._filter_job is not None:
+            self.root.after_cancel(self._filter_job)
+        self._filter_job = self.root.after(150, self._apply_filter)
+        
+    def _apply_filter(self):
+        self._filter_job = None
+        self._update_peers_list()  # Pending changes first, so the rebuild includes them
+        self._rebuild_peers_list(self.peer_list.set_filter(self.peer_filter.get()))
+        
     def _on_send_message(self, event=None):
         """Handle sending a message."""
         message = self.message_input.get().strip()
         if message and self.selected_peer and self.send_callback:
-            # Call the send callback
-            success = self.send_callback(self.selected_peer, {"type": "message", "content": message})
+            # Call the send callback; it returns the key the message was stored under
+            key = self.send_callback(self.selected_peer, {"type": "message", "content": message})
             
-            if success:
+            if key:
                 # Add message to chat history
-                self.add_message("You", message)
+                self.add_message("You", message, key=key if isinstance(key, tuple) else None)
                 
                 # Clear input
                 self.message_input.delete(0, tk.END)
         
+    def _on_send_to_all(self):
+        """Handle sending a message to everyone in the room."""
+        message = self.message_input.get().strip()
+        if message and self.broadcast_callback:
+            key = self.broadcast_callback({"type": "message", "content": message})
+            if key:
+                self.add_message("You (to all)", message, key=key if isinstance(key, tuple) else None)
+                self.message_input.delete(0, tk.END)
+                
+    def _on_send_file(self):
+        """Let the user pick a file and offer it to the selected peer."""
+        if not (self.selected_peer and self.send_file_callback):
+            return
+        path = filedialog.askopenfilename(parent=self.root, title="Send File")
+        if path and not self.send_file_callback(self.selected_peer, path):
+            self.show_error("Send File", f"Could not offer {path} to the selected peer.")
+            
+    def _ask_file(self, transfer_id, sender, name, size):
+        """Let the user accept or turn down a file offered by a peer."""
+        accepted = messagebox.askyesno("Receive File", f"{sender} wants to send you {name} ({size} bytes). "
+                                       "Receive it?", parent=self.root)
+        if self.file_response_callback and not self.file_response_callback(transfer_id, accepted) and accepted:
+            self.show_error("Receive File", f"{name} is no longer offered.")
+            
     def _update_input_state(self):
         """Update the state of input fields based on selection."""
         if self.selected_peer:
-            self.message_input.config(state=tk.NORMAL)
             self.send_button.config(state=tk.NORMAL)
+            self.send_file_button.config(state=tk.NORMAL)
         else:
-            self.message_input.config(state=tk.DISABLED)
             self.send_button.config(state=tk.DISABLED)
+            self.send_file_button.config(state=tk.DISABLED)
+            
+        # Messages to the whole room need someone connected, but no selection
+        room = bool(self.peers and self.broadcast_callback)
+        self.send_all_button.config(state=tk.NORMAL if room else tk.DISABLED)
+        self.message_input.config(state=tk.NORMAL if self.selected_peer or room else tk.DISABLED)
             
     def add_peer(self, address, name=None):
+        """Add a peer to the list. Safe to call from any thread."""
+        self._events.put(("add_peer", address, name))
+        
+    def remove_peer(self, address):
+        """Remove a peer from the list. Safe to call from any thread."""
+        self._events.put(("remove_peer", address))
+        
+    def add_message(self, sender, content, key=None):
+        """Add a message to the chat history. Safe to call from any thread.
+
+        key is the (timestamp, id) under which the message was stored, if it was.
+        """
+        if key is None:
+            key = (time.time(), 0, next(self._local_seq))
+        self._events.put(("message", key, sender, content))
+        
+    def offer_file(self, transfer_id, sender, name, size):
+        """Ask whether to receive a file a peer offered. Safe to call from any thread."""
+        self._events.put(("offer", transfer_id, sender, name, size))
+        
+    def _drain_events(self):
+        """Apply a batch of queued updates, then schedule the next frame."""
+        records = []
+        peers_changed = False
+        try:
+            for _ in range(self.max_batch):
+                event = self._events.get_nowait()
+                kind = event[0]
+                if kind == "message":
+                    records.append(event[1:])
+                elif kind == "add_peer":
+                    self._apply_add_peer(*event[1:])
+                    peers_changed = True
+                elif kind == "remove_peer":
+                    self._apply_remove_peer(*event[1:])
+                    peers_changed = True
+                elif kind == "search":
+                    self._show_search_results(*event[1:])
+                elif kind == "offer":
+                    # Asked once this batch is drawn, as the dialog waits for the user
+                    self.root.after_idle(self._ask_file, *event[1:])
+        except queue.Empty:
+            pass
+            
+        # Refresh the peer list once per batch rather than once per change
+        if peers_changed:
+            self._update_peers_list()
+            
+        if records:
+            records.sort(key=lambda record: record[0])
+            self._append_records(records)
+            
+        self.root.after(self.frame_interval, self._drain_events)
+        
+    def _apply_add_peer(self, address, name=None):
         """Add a peer to the list."""
         if name is None:
             name = f"Peer-{len(self.peers) + 1}"
             
         self.peers[address] = name
-        self._update_peers_list()
+        self._peer_changes[address] = f"{name} ({address[0]}:{address[1]})"
         
-        # Update connection status
-        if self.peers:
-            self.connection_status.config(text="Connected", style="Connected.TLabel")
-        
-    def remove_peer(self, address):
+    def _apply_remove_peer(self, address):
         """Remove a peer from the list."""
         if address in self.peers:
             del self.peers[address]
+            self._peer_changes[address] = None
             
             # If the removed peer was selected, clear selection
             if self.selected_peer == address:
                 self.selected_peer = None
                 self._update_input_state()
                 
-            self._update_peers_list()
-            
-            # Update connection status
-            if not self.peers:
-                self.connection_status.config(text="Disconnected", style="Disconnected.TLabel")
-                
     def _update_peers_list(self):
-        """Update the peers listbox."""
+        """Apply the peer changes of a batch to the listbox and update the connection status."""
+        changes, self._peer_changes = self._peer_changes, {}
+        deleted, appended = self.peer_list.update(changes)
+        if len(deleted) > PEER_LIST_REBUILD_THRESHOLD:
+            # Past a point one rebuild is cheaper than many single-row deletes
+            self._rebuild_peers_list([self.peer_list.labels[address] for address in self.peer_list.rows])
+        else:
+            for row in deleted:
+                self.peers_listbox.delete(row)
+            if appended:
+                self.peers_listbox.insert(tk.END, *appended)
+                
+        self._update_input_state()
+            
+        # Update connection status
+        if self.peers:
+            self.connection_status.config(text="Connected", style="Connected.TLabel")
+        else:
+            self.connection_status.config(text="Disconnected", style="Disconnected.TLabel")
+            
+    def _rebuild_peers_list(self, labels):
+        """Replace every row of the peers listbox, keeping the selected peer selected."""
         self.peers_listbox.delete(0, tk.END)
-        
-        for address, name in self.peers.items():
-            self.peers_listbox.insert(tk.END, f"{name} ({address[0]}:{address[1]})")
+        if labels:
+            self.peers_listbox.insert(tk.END, *labels)
+        row = self.peer_list.row_of.get(self.selected_peer)
+        if row is not None:
+            self.peers_listbox.selection_set(row)
+            self.peers_listbox.see(row)
             
-    def add_message(self, sender, content):
-        """Add a message to the chat history."""
-        self.chat_history.config(state=tk.NORMAL)
-        
-        # Add timestamp
-        timestamp = time.strftime("%H:%M:%S")
-        
-        # Format and insert message
-        self.chat_history.insert(tk.END, f"[{timestamp}] {sender}: ", "sender")
-        self.chat_history.insert(tk.END, f"{content}\n", "message")
+    def _append_records(self, records):
+        """Store new message records and render them if the view follows the newest messages."""
+        following = (not self._view or self._view[-1][0] == self.history.newest_key) \
+            and self.chat_history.yview()[1] >= 1.0
+        
+        records = sorted(record for record in records if self.history.add(record))
+        if not following or not records:
+            # The user is reading older messages; new ones are paged in on scroll
+            return
+            
+        if self._view and records[0][0] < self._view[-1][0]:
+            # Some records belong before ones already shown, so redraw the newest window
+            self._clear_view()
+            records = self.history.newest(self.history_window)
+        elif len(records) >= self.history_window:
+            # Only the newest window of records can survive the trim below
+            self._clear_view()
+            records = records[-self.history_window:]
+        self._render_records(records, at_end=True)
+        self._trim_view(from_top=True)
         
         # Auto-scroll to bottom
         self.chat_history.see(tk.END)
         
+    def _clear_view(self):
+        """Remove every rendered record."""
+        self.chat_history.config(state=tk.NORMAL)
+        self.chat_history.delete("1.0", tk.END)
         self.chat_history.config(state=tk.DISABLED)
+        self._view.clear()
+        self._loaded_oldest = False
         
+    def _render_records(self, records, at_end):
+        """Insert records at either end of the chat history with a single widget call."""
+        if not records:
+            return 0
+            
+        lines = []
+        entries = []
+        for key, sender, content in records:
+            timestamp = time.strftime("%H:%M:%S", time.localtime(key[0]))
+            lines.extend((f"[{timestamp}] {sender}: ", "sender", f"{content}\n", "message"))
+            entries.append((key, content.count("\n") + 1))
+            
+        self.chat_history.config(state=tk.NORMAL)
+        if at_end:
+            self.chat_history.insert(tk.END, *lines)
+            self._view.extend(entries)
+        else:
+            self.chat_history.insert("1.0", *lines)
+            self._view.extendleft(reversed(entries))
+        self.chat_history.config(state=tk.DISABLED)
+        return sum(count for _, count in entries)
+        
+    def _trim_view(self, from_top):
+        """Drop rendered records beyond the history window. Returns the number of lines removed."""
+        excess = len(self._view) - self.history_window
+        if excess <= 0:
+            return 0
+            
+        self.chat_history.config(state=tk.NORMAL)
+        if from_top:
+            lines = sum(self._view.popleft()[1] for _ in range(excess))
+            self.chat_history.delete("1.0", f"{lines + 1}.0")
+            self._loaded_oldest = False
+        else:
+            lines = sum(self._view.pop()[1] for _ in range(excess))
+            total = sum(count for _, count in self._view)
+            self.chat_history.delete(f"{total + 1}.0", tk.END)
+        self.chat_history.config(state=tk.DISABLED)
+        return lines
+        
+    def _has_older(self):
+        if not self._view:
+            return False
+        if self.history.oldest_key is not None and self.history.oldest_key < self._view[0][0]:
+            return True
+        return self.history_loader is not None and not self._loaded_oldest
+        
+    def _has_newer(self):
+        return bool(self._view) and self._view[-1][0] < self.history.newest_key
+        
+    def _on_history_scroll(self, first, last):
+        """Keep the scrollbar in sync and page records in when scrolling past either end."""
+        self.chat_history.vbar.set(first, last)
+        
+        older = float(first) <= 0.0 and self._has_older()
+        newer = float(last) >= 1.0 and self._has_newer()
+        if (older or newer) and not self._paging_scheduled:
+            self._paging_scheduled = True
+            self.root.after_idle(self._page_history, older)
+            
+    def _load_older(self):
+        """Return the page of records just above the view, from the ring or the loader."""
+        first_key = self._view[0][0]
+        records = self.history.before(first_key, self.history_page)
+        missing = self.history_page - len(records)
+        if missing and self.history_loader:
+            bound = records[0][0] if records else first_key
+            older = self.history_loader(before=bound[:2], limit=missing)
+            if len(older) < missing:
+                self._loaded_oldest = True
+            records = older + records
+        return records
+        
+    def _load_newer(self):
+        """Return the page of records just below the view, from the ring or the loader."""
+        last_key = self._view[-1][0]
+        oldest_key = self.history.oldest_key
+        if self.history_loader and oldest_key is not None and last_key < oldest_key:
+            # Records between the view and the ring have been overwritten; read them back
+            stored = self.history_loader(after=last_key[:2], limit=self.history_page)
+            records = [record for record in stored if record[0] < oldest_key]
+            if records:
+                return records
+        elif oldest_key is not None and last_key < oldest_key:
+            # Nothing to fill the gap with; jump to the oldest record still held
+            return self.history.newest(len(self.history))[:self.history_page]
+        return self.history.after(last_key, self.history_page)
+            
+    def _page_history(self, older):
+        """Render the next page of records above or below the current window."""
+        self._paging_scheduled = False
+        top_line = int(self.chat_history.index("@0,0").split(".")[0])
+        
+        if older:
+            inserted = self._render_records(self._load_older(), at_end=False)
+            self._trim_view(from_top=False)
+            
+            # Keep the lines the user was looking at in place
+            self.chat_history.yview(f"{top_line + inserted}.0")
+        else:
+            self._render_records(self._load_newer(), at_end=True)
+            removed = self._trim_view(from_top=True)
+            self.chat_history.yview(f"{max(1, top_line - removed)}.0")
+            
     def show_error(self, title, message):
         """Show an error message."""
         messagebox.showerror(title, message)
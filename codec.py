@@ -0,0 +1,243 @@
+import json
+import struct
+
+try:
+    import msgpack  # Optional C implementation of the same body encoding
+except ImportError:
+    msgpack = None
+    
+class CodecError(Exception):
+    """Raised when a payload cannot be encoded or decoded."""
+    
+class JSONCodec:
+    """UTF-8 JSON, understood by every peer."""
+    name = "json"
+    
+    def encode(self, message):
+        return json.dumps(message, separators=(",", ":")).encode("utf-8")
+        
+    def decode(self, payload):
+        try:
+            return json.loads(bytes(payload))
+        except (ValueError, UnicodeDecodeError, RecursionError) as e:
+            raise CodecError(f"Invalid JSON: {e}") from e
+            
+# Binary payloads start with a struct-packed header: magic byte and body kind
+BINARY_MAGIC = 0xB1
+BINARY_HEADER = struct.Struct("!BB")
+KIND_PACKED = 0  # Body is a msgpack-encoded message
+KIND_CHAT = 1  # Body is the UTF-8 content of a {"type": "message", "content": ...} message
+
+_UINT8 = struct.Struct("!B")
+_UINT16 = struct.Struct("!H")
+_UINT32 = struct.Struct("!I")
+_INT64 = struct.Struct("!q")
+_UINT64 = struct.Struct("!Q")
+_FLOAT64 = struct.Struct("!d")
+
+def _pack(value, out):
+    """Append the msgpack encoding of value to the bytearray out."""
+    if value is None:
+        out.append(0xC0)
+    elif value is True:
+        out.append(0xC3)
+    elif value is False:
+        out.append(0xC2)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -32 <= value < 0:
+            out.append(value & 0xFF)
+        elif -(1 << 63) <= value < (1 << 63):
+            out.append(0xD3)
+            out += _INT64.pack(value)
+        elif 0 <= value < (1 << 64):
+            out.append(0xCF)
+            out += _UINT64.pack(value)
+        else:
+            raise CodecError(f"Integer out of range: {value}")
+    elif isinstance(value, float):
+        out.append(0xCB)
+        out += _FLOAT64.pack(value)
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        size = len(data)
+        if size < 32:
+            out.append(0xA0 | size)
+        elif size < 0x100:
+            out.append(0xD9)
+            out.append(size)
+        elif size < 0x10000:
+            out.append(0xDA)
+            out += _UINT16.pack(size)
+        else:
+            out.append(0xDB)
+            out += _UINT32.pack(size)
+        out += data
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        size = len(value)
+        if size < 0x100:
+            out.append(0xC4)
+            out.append(size)
+        elif size < 0x10000:
+            out.append(0xC5)
+            out += _UINT16.pack(size)
+        else:
+            out.append(0xC6)
+            out += _UINT32.pack(size)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        size = len(value)
+        if size < 16:
+            out.append(0x90 | size)
+        elif size < 0x10000:
+            out.append(0xDC)
+            out += _UINT16.pack(size)
+        else:
+            out.append(0xDD)
+            out += _UINT32.pack(size)
+        for item in value:
+            _pack(item, out)
+    elif isinstance(value, dict):
+        size = len(value)
+        if size < 16:
+            out.append(0x80 | size)
+        elif size < 0x10000:
+            out.append(0xDE)
+            out += _UINT16.pack(size)
+        else:
+            out.append(0xDF)
+            out += _UINT32.pack(size)
+        for key, item in value.items():
+            _pack(key, out)
+            _pack(item, out)
+    else:
+        raise CodecError(f"Cannot encode {type(value).__name__}")
+        
+def _unpack(data, offset):
+    """Decode one msgpack value from data at offset. Returns (value, next offset)."""
+    code = data[offset]
+    offset += 1
+    if code < 0x80:
+        return code, offset
+    if code >= 0xE0:
+        return code - 0x100, offset
+    if 0xA0 <= code <= 0xBF:
+        size = code & 0x1F
+        return str(data[offset:offset + size], "utf-8"), offset + size
+    if 0x90 <= code <= 0x9F:
+        return _unpack_array(data, offset, code & 0x0F)
+    if 0x80 <= code <= 0x8F:
+        return _unpack_map(data, offset, code & 0x0F)
+    if code == 0xC0:
+        return None, offset
+    if code == 0xC2:
+        return False, offset
+    if code == 0xC3:
+        return True, offset
+    if code == 0xCB:
+        return _FLOAT64.unpack_from(data, offset)[0], offset + 8
+    if code == 0xD3:
+        return _INT64.unpack_from(data, offset)[0], offset + 8
+    if code == 0xCF:
+        return _UINT64.unpack_from(data, offset)[0], offset + 8
+    if code in (0xD9, 0xDA, 0xDB, 0xC4, 0xC5, 0xC6):
+        length = {0xD9: _UINT8, 0xDA: _UINT16, 0xDB: _UINT32, 0xC4: _UINT8, 0xC5: _UINT16, 0xC6: _UINT32}[code]
+        (size,) = length.unpack_from(data, offset)
+        offset += length.size
+        if offset + size > len(data):
+            raise CodecError("Truncated binary payload")
+        chunk = data[offset:offset + size]
+        value = str(chunk, "utf-8") if code in (0xD9, 0xDA, 0xDB) else bytes(chunk)
+        return value, offset + size
+    if code in (0xDC, 0xDD):
+        length = _UINT16 if code == 0xDC else _UINT32
+        return _unpack_array(data, offset + length.size, length.unpack_from(data, offset)[0])
+    if code in (0xDE, 0xDF):
+        length = _UINT16 if code == 0xDE else _UINT32
+        return _unpack_map(data, offset + length.size, length.unpack_from(data, offset)[0])
+    raise CodecError(f"Unsupported type code 0x{code:02x}")
+    
+def _unpack_array(data, offset, size):
+    items = []
+    for _ in range(size):
+        item, offset = _unpack(data, offset)
+        items.append(item)
+    return items, offset
+    
+def _unpack_map(data, offset, size):
+    result = {}
+    for _ in range(size):
+        key, offset = _unpack(data, offset)
+        result[key], offset = _unpack(data, offset)
+    return result, offset
+    
+class BinaryCodec:
+    """Compact binary encoding: a struct-packed header followed by a msgpack body.
+
+    Plain chat messages, by far the most common frame, skip the body encoding
+    altogether and carry just their UTF-8 content.
+    """
+    name = "binary"
+    _chat_header = BINARY_HEADER.pack(BINARY_MAGIC, KIND_CHAT)
+    _packed_header = BINARY_HEADER.pack(BINARY_MAGIC, KIND_PACKED)
+    
+    def encode(self, message):
+        if len(message) == 2 and message.get("type") == "message" and isinstance(message.get("content"), str):
+            return self._chat_header + message["content"].encode("utf-8")
+        if msgpack is not None:
+            return self._packed_header + msgpack.packb(message, use_bin_type=True)
+        out = bytearray(self._packed_header)
+        _pack(message, out)
+        return bytes(out)
+        
+    def decode(self, payload):
+        if len(payload) < BINARY_HEADER.size:
+            raise CodecError("Truncated binary payload")
+        magic, kind = BINARY_HEADER.unpack_from(payload)
+        if magic != BINARY_MAGIC:
+            raise CodecError("Not a binary payload")
+        body = payload[BINARY_HEADER.size:]
+        try:
+            if kind == KIND_CHAT:
+                return {"type": "message", "content": str(body, "utf-8")}
+            if kind == KIND_PACKED:
+                if msgpack is not None:
+                    return msgpack.unpackb(body, raw=False)
+                message, end = _unpack(body, 0)
+                if end != len(body):
+                    raise CodecError("Trailing data in binary payload")
+                return message
+        except (IndexError, struct.error, UnicodeDecodeError, ValueError, TypeError, RecursionError) as e:
+            # TypeError is an unhashable map key, RecursionError nesting too deep to follow
+            raise CodecError(f"Invalid binary payload: {e}") from e
+        raise CodecError(f"Unknown binary payload kind {kind}")
+        
+JSON_CODEC = JSONCodec()
+BINARY_CODEC = BinaryCodec()
+
+# Codecs this build understands, best first
+CODECS = {codec.name: codec for codec in (BINARY_CODEC, JSON_CODEC)}
+
+# Codecs offered to peers. Without msgpack the binary codec decodes messages slower
+# than JSON does, so it is only understood, never asked for.
+ADVERTISED_CODECS = list(CODECS) if msgpack is not None else [JSON_CODEC.name]
+
+def negotiate_codec(offered):
+    """Pick the best codec both sides offer, falling back to JSON."""
+    for name in ADVERTISED_CODECS:
+        if name in offered:
+            return CODECS[name]
+    return JSON_CODEC
+    
+def decode_payload(payload):
+    """Decode a frame payload with whichever codec produced it.
+
+    Payloads are self-describing by their first byte, so a peer that switches codecs
+    after the handshake never confuses the receiver.
+    """
+    if not payload:
+        raise CodecError("Empty payload")
+    if payload[0] == BINARY_MAGIC:
+        return BINARY_CODEC.decode(payload)
+    return JSON_CODEC.decode(payload)
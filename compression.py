@@ -0,0 +1,117 @@
+import time
+import zlib
+
+# Compressed payloads start with this byte, which never begins a JSON or binary payload
+COMPRESSED_MAGIC = 0xC1
+COMPRESSED_PREFIX = bytes([COMPRESSED_MAGIC])
+
+# Compression methods this build understands, best first
+COMPRESSIONS = ("zlib",)
+
+# Payloads smaller than this are sent as they are; compressing them rarely pays off
+DEFAULT_COMPRESSION_THRESHOLD = 256
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Every sync flush ends with these bytes, so they are left off on the wire and restored on receipt
+_SYNC_TAIL = b"\x00\x00\xff\xff"
+
+class CompressionError(Exception):
+    """Raised when a compressed payload cannot be decompressed."""
+    
+class StreamCompressor:
+    """Compresses one connection's outgoing payloads as a single deflate stream.
+
+    Each payload is sync-flushed so the receiver can decode it on arrival, but the
+    window carries over between payloads, so keys and phrases repeated across messages
+    cost only a few bytes after their first appearance. Payloads must therefore be
+    compressed in exactly the order they are written to the connection.
+    """
+    def __init__(self, level=DEFAULT_COMPRESSION_LEVEL, threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        self.threshold = threshold
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        
+        # Statistics
+        self.compressed_frames = 0
+        self.skipped_frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+        
+    def compress(self, payload):
+        """Return the payload to send: compressed, or unchanged if below the threshold."""
+        if len(payload) < self.threshold:
+            self.skipped_frames += 1
+            return payload
+            
+        start = time.thread_time()
+        data = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu_time += time.thread_time() - start
+        
+        data = COMPRESSED_PREFIX + data[:-len(_SYNC_TAIL)]
+        self.compressed_frames += 1
+        self.bytes_in += len(payload)
+        self.bytes_out += len(data)
+        return data
+        
+    def stats(self):
+        """Return bytes saved and CPU time spent compressing."""
+        return {
+            "compressed_frames": self.compressed_frames,
+            "skipped_frames": self.skipped_frames,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "cpu_seconds": self.cpu_time,
+        }
+        
+class StreamDecompressor:
+    """Decompresses the payloads produced by a peer's StreamCompressor, in order."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        
+        # Statistics
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.0
+        
+    def decompress(self, payload):
+        """Return the original payload, refusing to inflate past max_size bytes."""
+        start = time.thread_time()
+        chunks = []
+        remaining = self.max_size + 1
+        try:
+            for data in (payload[1:], _SYNC_TAIL):
+                chunk = self._decompressor.decompress(data, remaining)
+                remaining -= len(chunk)
+                if remaining <= 0 or self._decompressor.unconsumed_tail:
+                    raise CompressionError(f"Decompressed payload exceeds limit of {self.max_size} bytes")
+                chunks.append(chunk)
+        except zlib.error as e:
+            raise CompressionError(f"Invalid compressed payload: {e}") from e
+        finally:
+            self.cpu_time += time.thread_time() - start
+            
+        data = b"".join(chunks)
+        self.frames += 1
+        self.bytes_in += len(payload)
+        self.bytes_out += len(data)
+        return data
+        
+    def stats(self):
+        """Return bytes received compressed and CPU time spent decompressing."""
+        return {
+            "frames": self.frames,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_out - self.bytes_in,
+            "cpu_seconds": self.cpu_time,
+        }
+        
+def negotiate_compression(offered):
+    """Pick the best compression method both sides support, or None."""
+    for name in COMPRESSIONS:
+        if name in offered:
+            return name
+    return None
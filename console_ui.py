@@ -0,0 +1,350 @@
+import hmac
+import json
+import logging
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+HELP = """Commands:
+  /peers                  list connected peers
+  /to N                   send following lines to peer N
+  /msg N TEXT             send TEXT to peer N
+  /all TEXT               send TEXT to everyone in the room
+  /file N PATH            send a file to peer N
+  /accept N               receive the file offered as N
+  /reject N               turn down the file offered as N
+  /connect IP PORT        connect to a peer manually
+  /history [COUNT]        show the most recent stored messages
+  /search TEXT            find stored messages containing every word of TEXT
+  /stats                  show metrics as JSON
+  /help                   show this help
+  /quit                   stop LNChat
+Any other line is sent to the peer chosen with /to."""
+
+# Seconds a TCP control client has to send the control token
+CONTROL_TOKEN_TIMEOUT = 10
+
+class ConsoleSession:
+    """One command stream: stdin/stdout or a client of the control socket."""
+    def __init__(self, write):
+        self.write = write
+        self.selected_peer = None
+        
+class ConsoleUI:
+    """Line-based front end for running LNChat without a display.
+
+    Offers the same interface as ChatUI, so LNChat drives either one. Commands are
+    read from stdin and from clients of a control socket, which lets a daemon be
+    controlled after it has detached from the terminal. Events are written to stdout
+    and to every connected control client.
+
+    The control socket is a Unix-domain socket at control_path, which only our own
+    user may open, or where those are unavailable a TCP socket on 127.0.0.1 at
+    control_port. Any local user can reach the latter, so its clients must send
+    control_token as their first line.
+    """
+    def __init__(self, send_callback=None, connect_callback=None, send_file_callback=None,
+                 history_loader=None, control_path=None, control_port=None, control_token=None,
+                 input_stream=None, output_stream=None, stats_callback=None, broadcast_callback=None,
+                 search_callback=None, file_response_callback=None):
+        if control_port is not None and not control_token:
+            raise ValueError("A control port needs a token")
+        self.send_callback = send_callback
+        self.broadcast_callback = broadcast_callback
+        self.connect_callback = connect_callback
+        self.send_file_callback = send_file_callback
+        self.file_response_callback = file_response_callback  # (transfer_id, accepted)
+        self.history_loader = history_loader
+        self.search_callback = search_callback
+        self.stats_callback = stats_callback
+        self.control_path = control_path
+        self.control_port = control_port
+        self.control_token = control_token
+        self.input_stream = input_stream or sys.stdin
+        self.output_stream = output_stream or sys.stdout
+        
+        self.peers = {}  # {address: name}
+        self._peer_counter = 0
+        self.offers = {}  # {number: transfer_id} of files offered to us
+        self._offer_counter = 0
+        self.lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._control_socket = None
+        self._clients = []  # Sessions of connected control clients
+        self._console = ConsoleSession(self._write_console)
+        
+    def _write_console(self, text):
+        self.output_stream.write(text + "\n")
+        self.output_stream.flush()
+        
+    def _emit(self, text):
+        """Write an event line to the console and every control client."""
+        with self.lock:
+            sessions = [self._console] + self._clients
+        for session in sessions:
+            try:
+                session.write(text)
+            except (OSError, ValueError):
+                pass
+                
+    def add_peer(self, address, name=None):
+        """Add a peer to the list. Safe to call from any thread."""
+        with self.lock:
+            if name is None:
+                self._peer_counter += 1
+                name = f"Peer-{self._peer_counter}"
+            self.peers[address] = name
+        self._emit(f"* Connected: {name} ({address[0]}:{address[1]})")
+        
+    def remove_peer(self, address):
+        """Remove a peer from the list. Safe to call from any thread."""
+        with self.lock:
+            name = self.peers.pop(address, None)
+        if name is not None:
+            self._emit(f"* Disconnected: {name} ({address[0]}:{address[1]})")
+            
+    def add_message(self, sender, content, key=None):
+        """Show a message. Safe to call from any thread.
+
+        key is the (timestamp, id) under which the message was stored, if it was.
+        """
+        self._emit(self._format(key[0] if key else time.time(), sender, content))
+        
+    def offer_file(self, transfer_id, sender, name, size):
+        """Ask whether to receive a file a peer offered. Safe to call from any thread."""
+        with self.lock:
+            self._offer_counter += 1
+            number = self._offer_counter
+            self.offers[number] = transfer_id
+        self._emit(f"* {sender} offers {name} ({size} bytes): /accept {number} or /reject {number}")
+        
+    def _format(self, timestamp, sender, content):
+        return f"[{time.strftime('%H:%M:%S', time.localtime(timestamp))}] {sender}: {content}"
+        
+    def _peer_list(self):
+        with self.lock:
+            return list(self.peers.items())
+            
+    def _resolve_peer(self, session, index):
+        """Return the address of peer number index (1-based, as listed by /peers)."""
+        peers = self._peer_list()
+        if index.isdigit() and 1 <= int(index) <= len(peers):
+            return peers[int(index) - 1][0]
+        session.write(f"No peer {index}; use /peers to list them")
+        return None
+            
+    def handle_command(self, session, line):
+        """Execute one input line for a session."""
+        line = line.strip()
+        if not line:
+            return
+        if not line.startswith("/"):
+            if session.selected_peer is None:
+                session.write("No peer selected; use /to N first")
+            else:
+                self._send(session, session.selected_peer, line)
+            return
+            
+        command, _, args = line.partition(" ")
+        args = args.strip()
+        if command == "/peers":
+            peers = self._peer_list()
+            if not peers:
+                session.write("No connected peers")
+            for index, (address, name) in enumerate(peers, 1):
+                marker = " *" if address == session.selected_peer else ""
+                session.write(f"{index}. {name} ({address[0]}:{address[1]}){marker}")
+        elif command == "/to":
+            address = self._resolve_peer(session, args)
+            if address is not None:
+                session.selected_peer = address
+                session.write(f"Sending to {self.peers.get(address, address)}")
+        elif command == "/msg":
+            index, _, text = args.partition(" ")
+            address = self._resolve_peer(session, index)
+            if address is not None and text.strip():
+                self._send(session, address, text.strip())
+        elif command == "/all":
+            if args and self.broadcast_callback:
+                key = self.broadcast_callback({"type": "message", "content": args})
+                if key:
+                    self.add_message("You (to all)", args, key=key if isinstance(key, tuple) else None)
+                else:
+                    session.write("No connected peers")
+        elif command == "/file":
+            index, _, path = args.partition(" ")
+            address = self._resolve_peer(session, index)
+            if address is not None and self.send_file_callback:
+                if not self.send_file_callback(address, path.strip()):
+                    session.write(f"Could not offer {path.strip()} to {self.peers.get(address, address)}")
+        elif command in ("/accept", "/reject"):
+            with self.lock:
+                transfer_id = self.offers.pop(int(args), None) if args.isdigit() else None
+            if transfer_id is None:
+                session.write(f"No file offer {args}")
+            elif self.file_response_callback and not self.file_response_callback(transfer_id, command == "/accept"):
+                session.write(f"File offer {args} is no longer available")
+        elif command == "/connect":
+            try:
+                ip, port = args.split()
+                port = int(port)
+            except ValueError:
+                session.write("Usage: /connect IP PORT")
+                return
+            if self.connect_callback and not self.connect_callback(ip, port):
+                session.write(f"Could not connect to {ip}:{port}")
+        elif command == "/history":
+            limit = int(args) if args.isdigit() else 20
+            if self.history_loader:
+                for key, sender, content in self.history_loader(limit=limit):
+                    session.write(self._format(key[0], sender, content))
+        elif command == "/search":
+            if args and self.search_callback:
+                # Oldest first like /history, so the newest hit ends up next to the prompt
+                records = self.search_callback(args, limit=20)
+                if not records:
+                    session.write("No messages found")
+                for key, peer, sender, content in reversed(records):
+                    session.write(self._format(key[0], sender, content))
+        elif command == "/stats":
+            if self.stats_callback:
+                session.write(json.dumps(self.stats_callback(), indent=2, default=str))
+        elif command == "/help":
+            session.write(HELP)
+        elif command == "/quit":
+            self.stop()
+        else:
+            session.write(f"Unknown command {command}; /help lists the commands")
+            
+    def _send(self, session, address, text):
+        if not self.send_callback:
+            return
+        key = self.send_callback(address, {"type": "message", "content": text})
+        if key:
+            self.add_message("You", text, key=key if isinstance(key, tuple) else None)
+        else:
+            session.write(f"Could not send to {self.peers.get(address, address)}")
+            
+    def _read_console(self):
+        """Execute commands from the input stream until it ends."""
+        for line in self.input_stream:
+            if self._stopped.is_set():
+                return
+            self.handle_command(self._console, line)
+            
+        # Without a control socket nothing could ever stop a daemon whose input has ended
+        if self._control_socket is None:
+            self.stop()
+            
+    def _start_control_server(self):
+        if self.control_path is not None:
+            self._control_socket = self._bind_control_path()
+            where = self.control_path
+        else:
+            self._control_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._control_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._control_socket.bind(("127.0.0.1", self.control_port))
+            where = f"127.0.0.1:{self.control_port}"
+        # Nobody can connect before listen(), so the socket is never reachable more widely
+        self._control_socket.listen(5)
+        thread = threading.Thread(target=self._accept_control_clients)
+        thread.daemon = True
+        thread.start()
+        logger.info("Control interface listening on %s", where)
+        
+    def _bind_control_path(self):
+        """Bind a Unix-domain socket at control_path that only our own user may open."""
+        try:
+            if stat.S_ISSOCK(os.lstat(self.control_path).st_mode):
+                # Left behind by an instance that did not stop cleanly
+                os.unlink(self.control_path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.control_path)
+            os.chmod(self.control_path, 0o600)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+        
+    def _accept_control_clients(self):
+        while not self._stopped.is_set():
+            try:
+                client, _ = self._control_socket.accept()
+            except OSError:
+                break
+            thread = threading.Thread(target=self._serve_control_client, args=(client,))
+            thread.daemon = True
+            thread.start()
+            
+    def _serve_control_client(self, client):
+        """Execute commands from one control client until it disconnects."""
+        with client, client.makefile("r", encoding="utf-8", errors="replace") as lines:
+            if self.control_path is None and not self._check_token(client, lines):
+                return
+            session = ConsoleSession(lambda text: client.sendall((text + "\n").encode("utf-8")))
+            with self.lock:
+                self._clients.append(session)
+            try:
+                for line in lines:
+                    self.handle_command(session, line)
+                    if self._stopped.is_set():
+                        break
+            except OSError:
+                pass
+            finally:
+                with self.lock:
+                    self._clients.remove(session)
+                    
+    def _check_token(self, client, lines):
+        """Whether a TCP control client's first line is the control token."""
+        client.settimeout(CONTROL_TOKEN_TIMEOUT)
+        try:
+            line = lines.readline()
+        except OSError:
+            return False
+        client.settimeout(None)
+        if hmac.compare_digest(line.strip().encode("utf-8"), self.control_token.encode("utf-8")):
+            return True
+        logger.warning("Control client sent a wrong token")
+        try:
+            client.sendall(b"Wrong control token\n")
+        except OSError:
+            pass
+        return False
+        
+    def start(self):
+        """Serve commands until /quit, the end of input or stop()."""
+        if self.control_path is not None or self.control_port is not None:
+            self._start_control_server()
+            
+        reader = threading.Thread(target=self._read_console)
+        reader.daemon = True
+        reader.start()
+        
+        # Wait in short steps so Ctrl+C is handled promptly on every platform
+        while not self._stopped.wait(0.5):
+            pass
+            
+    def stop(self):
+        """Stop serving commands."""
+        self._stopped.set()
+        if self._control_socket:
+            # Shutting down wakes the accept() call, which close() alone does not
+            try:
+                self._control_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._control_socket.close()
+            if self.control_path is not None:
+                try:
+                    os.unlink(self.control_path)
+                except OSError:
+                    pass
@@ -0,0 +1,437 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import socket
+import struct
+import threading
+import uuid
+import zlib
+from tls import certificate_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Each chunk on a data channel is preceded by its file offset, length and CRC-32
+CHUNK_HEADER = struct.Struct("!QII")
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_DOWNLOAD_DIR = os.path.join(os.path.expanduser("~"), "LNChat Downloads")
+
+# Offers waiting for the user before further ones are turned down
+MAX_PENDING_OFFERS = 32
+
+# Transfer ids and file keys are hex digests; anything else is not used in a file name
+_TRANSFER_ID = re.compile(r"[0-9a-f]{1,64}")
+
+class FileTransferError(Exception):
+    """Raised when a transfer cannot continue."""
+    
+def _recv_exactly(sock, view):
+    """Fill a writable memoryview from the socket, raising if the peer goes away."""
+    received = 0
+    while received < len(view):
+        nbytes = sock.recv_into(view[received:])
+        if not nbytes:
+            raise FileTransferError("Connection closed mid-transfer")
+        received += nbytes
+        
+def _file_key(path):
+    """Identify a file's content version, so a resumed transfer continues the same file."""
+    stat = os.stat(path)
+    name = os.path.basename(path)
+    return hashlib.sha1(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+    
+def _safe_name(name):
+    """Strip any directory components a peer may have put in a file name."""
+    name = os.path.basename(name.replace("\\", "/")).strip()
+    return name if name not in ("", ".", "..") else "download"
+    
+class FileTransferManager:
+    """Sends and receives files over dedicated data connections.
+
+    Offers and acceptances travel as control messages on the normal chat connection.
+    The file itself is streamed over a separate TCP connection per transfer, so a large
+    file never delays chat messages. The sender streams chunks with socket.sendfile and
+    the receiver verifies each chunk's checksum before recording it as the new resume
+    point, so an interrupted transfer continues from the last good offset.
+
+    When the chat connections use TLS, so do the data connections. The receiver's
+    certificate must be the one its chat connection presented, and the sender proves
+    itself with the transfer id, which only travelled over the encrypted chat connection.
+
+    Offered files wait for the user to accept_offer() or reject_offer() them, unless
+    auto_accept is set; a transfer that was accepted once is resumed without asking.
+    """
+    def __init__(self, communication, download_dir=DEFAULT_DOWNLOAD_DIR, callback=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, timeout=30, max_retries=3, auto_accept=False,
+                 max_pending=MAX_PENDING_OFFERS):
+        self.communication = communication
+        self.download_dir = download_dir
+        self.callback = callback
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.auto_accept = auto_accept
+        self.max_pending = max_pending
+        self.outgoing = {}  # {transfer_id: info}
+        self.incoming = {}  # {transfer_id: info}
+        self.pending = {}  # {transfer_id: info} of offers waiting for the user
+        self.accepted = set()  # Ids of unfinished transfers the user accepted
+        self.lock = threading.Lock()
+        
+    def _notify(self, event, info):
+        """Report a transfer event: offer, accept, progress, complete or failed."""
+        if self.callback:
+            self.callback(event, dict(info))
+            
+    def send_file(self, address, path):
+        """Offer a file to a peer. Returns the transfer id, or None if the offer failed."""
+        size = os.path.getsize(path)
+        info = {
+            "transfer_id": uuid.uuid4().hex,
+            "direction": "send",
+            "address": address,
+            "path": path,
+            "name": os.path.basename(path),
+            "size": size,
+            "offset": 0,
+            "attempts": 0,
+        }
+        with self.lock:
+            self.outgoing[info["transfer_id"]] = info
+        if not self._offer(info):
+            with self.lock:
+                self.outgoing.pop(info["transfer_id"], None)
+            return None
+        return info["transfer_id"]
+        
+    def _offer(self, info):
+        info["attempts"] += 1
+        self._notify("offer", info)
+        return self.communication.send_message(info["address"], {
+            "type": "file_offer",
+            "transfer_id": info["transfer_id"],
+            "name": info["name"],
+            "size": info["size"],
+            "file_key": _file_key(info["path"]),
+        })
+        
+    def handle_message(self, address, message):
+        """Process a file_* control message received from a peer."""
+        kind = message.get("type")
+        if kind == "file_offer":
+            self._on_offer(address, message)
+        elif kind == "file_accept":
+            self._on_accept(address, message)
+        elif kind == "file_reject":
+            with self.lock:
+                info = self.outgoing.pop(message.get("transfer_id"), None)
+            if info:
+                info["error"] = message.get("reason", "rejected")
+                self._notify("failed", info)
+        elif kind == "file_error":
+            with self.lock:
+                info = self.outgoing.get(message.get("transfer_id"))
+            if info:
+                self._retry(info, message.get("reason", "receiver error"))
+        elif kind == "file_complete":
+            with self.lock:
+                info = self.outgoing.pop(message.get("transfer_id"), None)
+            if info:
+                info["offset"] = info["size"]
+                self._notify("complete", info)
+                
+    def _on_offer(self, address, message):
+        """Check an offered file and hold it for the user to accept or reject."""
+        transfer_id = message.get("transfer_id")
+        size = message.get("size")
+        if (not isinstance(transfer_id, str) or not _TRANSFER_ID.fullmatch(transfer_id)
+                or not isinstance(size, int) or isinstance(size, bool) or size < 0):
+            logger.warning("Received invalid file offer from %s", address)
+            return
+        file_key = message.get("file_key")
+        info = {
+            "transfer_id": transfer_id,
+            "direction": "receive",
+            "address": address,
+            "name": _safe_name(str(message.get("name", ""))),
+            "size": size,
+            "offset": 0,
+            # Names the partial file, so a later offer of the same file resumes it
+            "file_key": file_key if isinstance(file_key, str) and _TRANSFER_ID.fullmatch(file_key) else transfer_id,
+        }
+        evicted = None
+        with self.lock:
+            # A sender retrying an interrupted transfer offers it again
+            ask = transfer_id not in self.accepted and not self.auto_accept
+            if ask:
+                self.pending[transfer_id] = info
+                if len(self.pending) > self.max_pending:
+                    evicted = self.pending.pop(next(iter(self.pending)))
+        if evicted:
+            self._reject(evicted, "too many offers waiting")
+        if ask:
+            self._notify("offer", info)
+        else:
+            self._accept(info)
+            
+    def accept_offer(self, transfer_id):
+        """Receive a file the user accepted. Returns False if the offer is gone."""
+        with self.lock:
+            info = self.pending.pop(transfer_id, None)
+        if info is None:
+            return False
+        if info["address"] not in self.communication.connections:
+            info["error"] = "peer disconnected"
+            self._notify("failed", info)
+            return False
+        self._accept(info)
+        return True
+        
+    def reject_offer(self, transfer_id, reason="declined"):
+        """Turn down a file the user did not want. Returns False if the offer is gone."""
+        with self.lock:
+            info = self.pending.pop(transfer_id, None)
+        if info is None:
+            return False
+        self._reject(info, reason)
+        return True
+        
+    def _reject(self, info, reason):
+        logger.info("Not receiving %s from %s: %s", info["name"], info["address"], reason)
+        self.communication.send_message(info["address"], {
+            "type": "file_reject", "transfer_id": info["transfer_id"], "reason": reason
+        })
+        info["error"] = reason
+        self._notify("failed", info)
+        
+    def _accept(self, info):
+        """Prepare the partial file and a listening socket for an accepted file."""
+        # Offers of different files, or versions of a file, never share a partial file
+        part_path = os.path.join(self.download_dir, f"{info['name']}.{info['file_key'][:16]}.part")
+        state_path = part_path + ".json"
+        with self.lock:
+            busy = any(other["part_path"] == part_path for other in self.incoming.values())
+        if busy:
+            self._reject(info, "already receiving this file")
+            return
+        
+        try:
+            os.makedirs(self.download_dir, exist_ok=True)
+            offset = self._load_resume_offset(state_path, info["file_key"], info["size"])
+            have = os.path.getsize(part_path) if offset else 0
+            if shutil.disk_usage(self.download_dir).free < info["size"] - have:
+                self._reject(info, "not enough disk space")
+                return
+            
+            # Pre-allocate the full file so chunks can be written in place
+            with open(part_path, "r+b" if offset else "wb") as f:
+                f.truncate(info["size"])
+                
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.bind(("0.0.0.0", 0))
+            listener.listen(1)
+            listener.settimeout(self.timeout)
+        except OSError as e:
+            logger.warning("Cannot receive %s from %s: %s", info["name"], info["address"], e)
+            self._reject(info, str(e))
+            return
+            
+        info.update(offset=offset, part_path=part_path, state_path=state_path)
+        with self.lock:
+            self.incoming[info["transfer_id"]] = info
+            self.accepted.add(info["transfer_id"])
+        self._save_resume_offset(info)
+        self._notify("accept", info)
+        
+        thread = threading.Thread(target=self._receive, args=(info, listener))
+        thread.daemon = True
+        thread.start()
+        
+        self.communication.send_message(info["address"], {
+            "type": "file_accept",
+            "transfer_id": info["transfer_id"],
+            "offset": offset,
+            "port": listener.getsockname()[1],
+        })
+        
+    def _on_accept(self, address, message):
+        """Start streaming an accepted file from the offset the receiver asked for."""
+        with self.lock:
+            info = self.outgoing.get(message.get("transfer_id"))
+        offset, port = message.get("offset", 0), message.get("port")
+        if info is None or not isinstance(offset, int) or not isinstance(port, int):
+            return
+        info["offset"] = min(max(offset, 0), info["size"])
+        self._notify("accept", info)
+        
+        thread = threading.Thread(target=self._send, args=(info, address[0], port))
+        thread.daemon = True
+        thread.start()
+        
+    def _send(self, info, ip, port):
+        """Stream chunks from disk to the receiver's data channel."""
+        try:
+            with self._connect_data_channel(ip, port, info["address"]) as sock, \
+                    open(info["path"], "rb") as f:
+                sock.sendall(info["transfer_id"].encode("ascii"))
+                if info["size"] == 0:
+                    return
+                    
+                # Checksums are computed over the page cache via mmap; the data itself
+                # goes from the file to the socket without passing through Python
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        offset = info["offset"]
+                        while offset < info["size"]:
+                            length = min(self.chunk_size, info["size"] - offset)
+                            crc = zlib.crc32(view[offset:offset + length])
+                            sock.sendall(CHUNK_HEADER.pack(offset, length, crc))
+                            sent = sock.sendfile(f, offset, length)
+                            if sent != length:
+                                raise FileTransferError("File changed while sending")
+                            offset += length
+                            info["offset"] = offset
+                            self._notify("progress", info)
+                    finally:
+                        view.release()
+                        
+                # Wait for the receiver to close the channel once it has verified everything
+                sock.settimeout(self.timeout)
+                sock.recv(1)
+        except (OSError, ValueError, FileTransferError) as e:
+            logger.warning("Error sending %s to %s: %s", info["name"], info["address"], e)
+            # While the peer is still connected its file_error report drives the retry
+            if info["address"] not in self.communication.connections:
+                self._retry(info, e)
+                
+    def _connect_data_channel(self, ip, port, address):
+        """Open the data connection to a receiver, encrypted if the chat connection is."""
+        sock = socket.create_connection((ip, port), timeout=self.timeout)
+        tls = self.communication.tls
+        if tls is None:
+            return sock
+        try:
+            sock = tls.client_context.wrap_socket(sock)
+            expected = self.communication.peer_fingerprint(address)
+            if expected is not None and certificate_fingerprint(sock.getpeercert(binary_form=True)) != expected:
+                raise FileTransferError("Receiver's certificate does not match its chat connection")
+        except (OSError, FileTransferError):
+            sock.close()
+            raise
+        return sock
+        
+    def _retry(self, info, error):
+        """Offer an interrupted transfer again; the receiver resumes from its last good offset."""
+        with self.lock:
+            active = info["transfer_id"] in self.outgoing
+        if active and info["attempts"] < self.max_retries and self.communication.running:
+            if self._offer(info):
+                return
+        with self.lock:
+            self.outgoing.pop(info["transfer_id"], None)
+        info["error"] = str(error)
+        self._notify("failed", info)
+        
+    def _receive(self, info, listener):
+        """Accept the data channel and write verified chunks into the partial file."""
+        try:
+            with listener:
+                sock, address = listener.accept()
+            sock.settimeout(self.timeout)
+            if self.communication.tls:
+                sock = self.communication.tls.server_context.wrap_socket(sock, server_side=True)
+            with sock, open(info["part_path"], "r+b") as f:
+                if address[0] != info["address"][0]:
+                    raise FileTransferError(f"Unexpected data connection from {address[0]}")
+                    
+                preamble = bytearray(len(info["transfer_id"]))
+                _recv_exactly(sock, memoryview(preamble))
+                if preamble.decode("ascii", "replace") != info["transfer_id"]:
+                    raise FileTransferError("Data channel opened for another transfer")
+                    
+                header = bytearray(CHUNK_HEADER.size)
+                buffer = bytearray(self.chunk_size)
+                while info["offset"] < info["size"]:
+                    _recv_exactly(sock, memoryview(header))
+                    offset, length, crc = CHUNK_HEADER.unpack(header)
+                    if offset != info["offset"] or length > len(buffer) or offset + length > info["size"]:
+                        raise FileTransferError("Unexpected chunk")
+                        
+                    chunk = memoryview(buffer)[:length]
+                    _recv_exactly(sock, chunk)
+                    if zlib.crc32(chunk) != crc:
+                        raise FileTransferError(f"Checksum mismatch at offset {offset}")
+                        
+                    f.seek(offset)
+                    f.write(chunk)
+                    f.flush()
+                    info["offset"] = offset + length
+                    self._save_resume_offset(info)
+                    self._notify("progress", info)
+                    
+            final_path = self._finish(info)
+        except (OSError, FileTransferError) as e:
+            logger.warning("Error receiving %s from %s: %s", info["name"], info["address"], e)
+            with self.lock:
+                self.incoming.pop(info["transfer_id"], None)
+            info["error"] = str(e)
+            self._notify("failed", info)
+            
+            # Let the sender offer the file again; it resumes from the saved offset
+            self.communication.send_message(info["address"], {
+                "type": "file_error", "transfer_id": info["transfer_id"], "reason": str(e)
+            })
+            return
+            
+        with self.lock:
+            self.incoming.pop(info["transfer_id"], None)
+            self.accepted.discard(info["transfer_id"])
+        info["path"] = final_path
+        self.communication.send_message(info["address"], {
+            "type": "file_complete", "transfer_id": info["transfer_id"]
+        })
+        self._notify("complete", info)
+        
+    def _finish(self, info):
+        """Move a fully received file to its final name and drop the resume state."""
+        base, ext = os.path.splitext(os.path.join(self.download_dir, info["name"]))
+        final_path = base + ext
+        counter = 1
+        while os.path.exists(final_path):
+            final_path = f"{base} ({counter}){ext}"
+            counter += 1
+        os.replace(info["part_path"], final_path)
+        try:
+            os.remove(info["state_path"])
+        except OSError:
+            pass
+        return final_path
+        
+    def _load_resume_offset(self, state_path, file_key, size):
+        """Return the last verified offset of an earlier attempt at the same file, or 0."""
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if state.get("file_key") != file_key or state.get("size") != size:
+            return 0
+        return min(int(state.get("offset", 0)), size)
+        
+    def _save_resume_offset(self, info):
+        """Record the last verified offset next to the partial file."""
+        state = {"file_key": info["file_key"], "size": info["size"], "offset": info["offset"]}
+        tmp_path = info["state_path"] + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, info["state_path"])
+        
+    def get_transfers(self):
+        """Return a snapshot of every active transfer."""
+        with self.lock:
+            return [dict(info) for info in list(self.outgoing.values()) + list(self.incoming.values())]
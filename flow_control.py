@@ -0,0 +1,58 @@
+import time
+
+# Frames per second and bytes per second a peer may send us, and the burst of frames
+# allowed above that rate. Generous for chat, so only a flooding peer is held back.
+DEFAULT_INBOUND_RATE = 1000
+DEFAULT_INBOUND_BURST = 1000
+DEFAULT_INBOUND_BYTE_RATE = 32 * 1024 * 1024
+
+class TokenBucket:
+    """Token bucket that lets callers overdraw it and then wait off the debt.
+
+    A frame's size is only known once it has been read, so charge() always succeeds
+    and returns how long the caller should pause before taking more.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        
+    def charge(self, amount):
+        """Take amount tokens and return the seconds until the bucket is out of debt."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+        
+class FlowLimiter:
+    """Frame and byte rate limits for one direction of one connection.
+
+    Used by a receiver to stop reading from a peer that exceeds its limits, and by a
+    sender to keep to the limits its peer advertised, so a well-behaved sender is never
+    held back by the receiver. A rate of None or 0 leaves that dimension unlimited.
+    """
+    def __init__(self, rate=DEFAULT_INBOUND_RATE, burst=DEFAULT_INBOUND_BURST,
+                 byte_rate=DEFAULT_INBOUND_BYTE_RATE):
+        self.frames = TokenBucket(rate, burst or rate) if rate else None
+        # Bytes may burst by a second's worth, so large messages are not held back
+        self.bytes = TokenBucket(byte_rate, byte_rate) if byte_rate else None
+        
+    @classmethod
+    def from_advertisement(cls, flow):
+        """Create the limiter for the [rate, burst, byte_rate] a peer advertised, or None."""
+        if not isinstance(flow, list) or len(flow) != 3:
+            return None
+        rate, burst, byte_rate = (value if isinstance(value, (int, float)) and value > 0 else None
+                                  for value in flow)
+        if rate is None and byte_rate is None:
+            return None
+        return cls(rate, burst, byte_rate)
+        
+    def charge(self, frames, nbytes):
+        """Account for frames totalling nbytes and return the seconds to pause for."""
+        delay = self.frames.charge(frames) if self.frames else 0
+        if self.bytes:
+            delay = max(delay, self.bytes.charge(nbytes))
+        return delay
@@ -0,0 +1,107 @@
+import struct
+
+# Every frame on the wire is a 4-byte big-endian payload length followed by the payload
+HEADER = struct.Struct("!I")
+HEADER_SIZE = HEADER.size
+
+# Largest payload a peer may announce before the connection is dropped
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+class FrameTooLargeError(Exception):
+    """Raised when a peer announces a frame above the configured limit."""
+    def __init__(self, size, limit):
+        super().__init__(f"Frame of {size} bytes exceeds limit of {limit} bytes")
+        self.size = size
+        self.limit = limit
+        
+def encode_frame(payload):
+    """Prefix a payload with its length header."""
+    return HEADER.pack(len(payload)) + payload
+    
+class FrameDecoder:
+    """Incremental decoder that reassembles length-prefixed frames from a byte stream.
+
+    Data is received straight into a reusable buffer, so the receive loop does not
+    allocate per chunk. Payloads are returned as memoryview slices of that buffer and
+    are only valid until more data is received.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, buffer_size=64 * 1024):
+        self.max_frame_size = max_frame_size
+        self._buffer_size = buffer_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Offset of the first unconsumed byte
+        self._end = 0  # Offset one past the last received byte
+        self._wanted = 0  # Bytes still missing from a partially received frame
+        
+    def get_buffer(self, min_size=1):
+        """Return a writable view of the free space at the end of the buffer."""
+        self._reserve(max(min_size, self._wanted, 1))
+        return self._view[self._end:]
+        
+    def advance(self, nbytes):
+        """Mark nbytes written into the view returned by get_buffer as received."""
+        self._end += nbytes
+        
+    def recv_from(self, sock):
+        """Receive available data from a socket into the buffer. Returns 0 on EOF."""
+        nbytes = sock.recv_into(self.get_buffer())
+        self.advance(nbytes)
+        return nbytes
+        
+    def feed(self, data):
+        """Append data obtained elsewhere (e.g. from a non-socket source)."""
+        size = len(data)
+        self.get_buffer(size)[:size] = data
+        self.advance(size)
+        
+    def frames(self):
+        """Yield every complete payload currently in the buffer."""
+        while True:
+            available = self._end - self._start
+            if available < HEADER_SIZE:
+                break
+                
+            (size,) = HEADER.unpack_from(self._buffer, self._start)
+            if size > self.max_frame_size:
+                raise FrameTooLargeError(size, self.max_frame_size)
+                
+            if available < HEADER_SIZE + size:
+                # Make room for the whole frame on the next receive
+                self._wanted = HEADER_SIZE + size - available
+                break
+                
+            begin = self._start + HEADER_SIZE
+            self._start = begin + size
+            self._wanted = 0
+            yield self._view[begin:self._start]
+            
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > self._buffer_size:
+                # Release the memory taken by an oversized frame
+                self._buffer = bytearray(self._buffer_size)
+                self._view = memoryview(self._buffer)
+                
+    def pending(self):
+        """Number of received bytes not yet returned as a frame."""
+        return self._end - self._start
+        
+    def _reserve(self, nbytes):
+        """Ensure at least nbytes of free space follow the received data."""
+        if len(self._buffer) - self._end >= nbytes:
+            return
+            
+        pending = self._end - self._start
+        needed = pending + nbytes
+        if needed <= len(self._buffer):
+            # Compact: move the unconsumed bytes to the front of the buffer
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            # Grow to fit; previously returned payload views keep the old buffer alive
+            buffer = bytearray(max(needed, 2 * len(self._buffer)))
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        self._start = 0
+        self._end = pending
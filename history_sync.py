@@ -0,0 +1,210 @@
+import logging
+import queue
+import threading
+import time
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+# Buckets covering every message time, from the epoch on
+ALL_BUCKETS = (0, 2 ** 40)
+
+# A range whose hashes differ is split into this many smaller ranges
+SYNC_FANOUT = 16
+
+# Ranges holding at most this many of our messages are settled by listing their uids
+SYNC_LEAF_SIZE = 64
+
+# Messages sent per sync_messages frame, and uids asked for per sync_request
+SYNC_BATCH_SIZE = 200
+
+# Seconds a peer's clock may run ahead of ours; messages from further in the future
+# would stay below every later message in the time-ordered history
+MAX_CLOCK_SKEW = 300
+
+def sync_fields(message):
+    """Return the store.append() arguments that make a received room message take part in sync.
+
+    Empty unless the sender gave the message its uid, author and a time no later than
+    MAX_CLOCK_SKEW ahead of ours.
+    """
+    uid, sent_at, author = message.get("uid"), message.get("sent_at"), message.get("author")
+    if not isinstance(uid, str) or not isinstance(author, str) or not isinstance(sent_at, (int, float)):
+        return {}
+    if not 0 <= sent_at <= time.time() + MAX_CLOCK_SKEW:
+        return {}
+    return {"uid": uid, "timestamp": sent_at, "author": author}
+    
+class HistorySync:
+    """Brings two peers' shared history up to date with each other after they connect.
+
+    The store keeps a hash and count for every bucket of message time. The peer that
+    dialled sends the hash of its whole history; the other compares it with its own
+    and, where they differ, sends back the hashes of SYNC_FANOUT smaller ranges, split
+    so each holds a similar share of its messages. Both sides keep narrowing down the
+    ranges that differ this way until one holds few enough messages to list their
+    uids, and then send each other only the messages the other lacks, in batches.
+    Identical histories cost one message each way, and the rest grows with the number
+    of differing ranges rather than the size of the history.
+
+    Runs on its own thread, so neither the database nor a large transfer holds up
+    live chat. sender_name(author) names the sender of a received message,
+    and message_callback(sender, content, key) is told about each one the store did
+    not have yet, once it is written.
+    """
+    def __init__(self, communication, store, conversation, sender_name, message_callback=None):
+        self.communication = communication
+        self.store = store
+        self.conversation = conversation  # Key the synced messages are stored under
+        self.sender_name = sender_name
+        self.message_callback = message_callback
+        self.metrics = communication.metrics
+        self._jobs = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def start(self, address):
+        """Start syncing with the peer at address."""
+        self._jobs.put((address, None))
+        
+    def handle_message(self, address, message):
+        """Queue a sync message from a peer for the sync thread."""
+        self._jobs.put((address, message))
+        
+    def stop(self):
+        self._jobs.put(None)
+        self._thread.join(timeout=5)
+        
+    def _run(self):
+        handlers = {
+            "sync_ranges": self._on_ranges,
+            "sync_ids": self._on_ids,
+            "sync_request": self._on_request,
+            "sync_messages": self._on_messages,
+        }
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            address, message = job
+            try:
+                if message is None:
+                    self.metrics.increment("sync_started")
+                    low, high = ALL_BUCKETS
+                    self._send_ranges(address, [self._summarise(self.store.sync_buckets(low, high), low, high)])
+                elif message.get("type") in handlers:
+                    handlers[message["type"]](address, message)
+            except Exception as e:
+                logger.warning("Error syncing history with %s: %s", address, e)
+                
+    def _summarise(self, buckets, low, high):
+        """Return [low, high, hash, count] for the buckets of a range."""
+        range_hash = count = 0
+        for _, bucket_hash, bucket_count in buckets:
+            range_hash ^= bucket_hash
+            count += bucket_count
+        return [low, high, range_hash, count]
+        
+    def _split(self, buckets, low, high):
+        """Split a range into up to SYNC_FANOUT ranges holding similar numbers of our messages."""
+        share = sum(count for _, _, count in buckets) / SYNC_FANOUT
+        ranges = []
+        start = low
+        first = 0
+        held = 0
+        for index, (_, _, count) in enumerate(buckets[:-1]):
+            held += count
+            if held >= share:
+                # The next range starts at the next bucket, so the ranges leave no gaps
+                end = buckets[index + 1][0]
+                ranges.append(self._summarise(buckets[first:index + 1], start, end))
+                start, first, held = end, index + 1, 0
+        ranges.append(self._summarise(buckets[first:], start, high))
+        return ranges
+        
+    def _send(self, address, message):
+        if not self.communication.send_message(address, message):
+            raise ConnectionError("peer disconnected")
+            
+    def _send_ranges(self, address, ranges):
+        self.metrics.increment("sync_rounds")
+        self._send(address, {"type": "sync_ranges", "ranges": ranges})
+        
+    def _send_records(self, address, records):
+        for start in range(0, len(records), SYNC_BATCH_SIZE):
+            self._send(address, {"type": "sync_messages", "messages": records[start:start + SYNC_BATCH_SIZE]})
+        self.metrics.increment("sync_messages_sent", len(records))
+        
+    def _on_ranges(self, address, message):
+        """Compare the peer's range hashes with ours, narrowing down the ranges that differ."""
+        narrower = []
+        listed = []
+        for entry in message.get("ranges", []):
+            if not (isinstance(entry, list) and len(entry) == 4 and all(isinstance(value, int) for value in entry)):
+                continue
+            low, high, remote_hash, remote_count = entry
+            buckets = self.store.sync_buckets(low, high)
+            local = self._summarise(buckets, low, high)
+            if local[2:] == [remote_hash, remote_count]:
+                continue
+            if remote_count == 0:
+                # Everything we have there is missing on the other side
+                self._send_records(address, self.store.sync_records(low, high))
+            elif local[3] <= SYNC_LEAF_SIZE or len(buckets) == 1:
+                listed.append([low, high, self.store.sync_ids(low, high)])
+            else:
+                narrower.extend(self._split(buckets, low, high))
+        if listed:
+            self._send(address, {"type": "sync_ids", "ranges": listed})
+        if narrower:
+            self._send_ranges(address, narrower)
+            
+    def _on_ids(self, address, message):
+        """Send the messages the peer does not list, and ask for the ones we lack."""
+        extra = []
+        missing = []
+        for entry in message.get("ranges", []):
+            if not (isinstance(entry, list) and len(entry) == 3 and isinstance(entry[0], int)
+                    and isinstance(entry[1], int) and isinstance(entry[2], list)):
+                continue
+            low, high, remote_ids = entry
+            remote_ids = set(remote_ids)
+            local_ids = set(self.store.sync_ids(low, high))
+            if remote_ids:
+                extra.extend(uid for uid in local_ids if uid not in remote_ids)
+            else:
+                self._send_records(address, self.store.sync_records(low, high))
+            missing.extend(uid for uid in remote_ids if isinstance(uid, str) and uid not in local_ids)
+        self._send_uids(address, extra)
+        for start in range(0, len(missing), SYNC_BATCH_SIZE):
+            self._send(address, {"type": "sync_request", "uids": missing[start:start + SYNC_BATCH_SIZE]})
+            
+    def _send_uids(self, address, uids):
+        for start in range(0, len(uids), SYNC_BATCH_SIZE):
+            self._send_records(address, self.store.sync_records(uids=uids[start:start + SYNC_BATCH_SIZE]))
+            
+    def _on_request(self, address, message):
+        uids = [uid for uid in message.get("uids", []) if isinstance(uid, str)]
+        self._send_uids(address, uids[:SYNC_BATCH_SIZE])
+        
+    def _on_messages(self, address, message):
+        """Store the messages the peer sent us; any we already have are skipped by the store."""
+        received = 0
+        for record in message.get("messages", []):
+            if not (isinstance(record, list) and len(record) == 4):
+                continue
+            uid, timestamp, author, content = record
+            fields = sync_fields({"uid": uid, "sent_at": timestamp, "author": author})
+            if not fields or not isinstance(content, str):
+                continue
+            # Never shown as ours, whatever author the peer claims: we hold everything we sent
+            sender = self.sender_name(author)
+            on_written = None
+            if self.message_callback:
+                on_written = partial(self.message_callback, sender, content)
+            self.store.append(self.conversation, sender, content, on_written=on_written, **fields)
+            received += 1
+        if received:
+            logger.info("Received %d messages of history from %s", received, address)
+            self.metrics.increment("sync_messages_received", received)
@@ -1,111 +1,319 @@
-import threading
 import time
-import sys
+
+# Taken before anything else is imported so the reported startup time covers the imports
+STARTED_AT = time.perf_counter()
+
+import argparse
+import logging
+import os
+import threading
 import socket
-import json
-from network_discovery import NetworkDiscovery
-from network_communication import NetworkCommunication
-from chat_ui import ChatUI
+import secrets
+import uuid
+from network_discovery import NetworkDiscovery, ROLE_RELAY
+from network_communication import (NetworkCommunication, SEND_POLICIES, SEND_POLICY_DISCONNECT,
+                                   DEFAULT_SEND_BLOCK_TIMEOUT)
+from async_communication import AsyncNetworkCommunication
+from file_transfer import DEFAULT_DOWNLOAD_DIR
+from compression import DEFAULT_COMPRESSION_THRESHOLD
+from message_store import MessageStore, DEFAULT_DATA_DIR
+from metrics import Metrics, start_stats_server
+from tls import TLSIdentity
+from history_sync import HistorySync, sync_fields
+
+logger = logging.getLogger(__name__)
+
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+# Conversation key under which room broadcasts are stored
+ROOM_KEY = "*"
+
+# Available transport engines, selectable with --transport
+TRANSPORTS = {
+    "threads": NetworkCommunication,
+    "asyncio": AsyncNetworkCommunication,
+}
 
 class LNChat:
-    def __init__(self, port=5000):
+    def __init__(self, port=5000, transport="threads", send_policy=SEND_POLICY_DISCONNECT, send_queue_size=1000,
+                 send_block_timeout=DEFAULT_SEND_BLOCK_TIMEOUT, download_dir=DEFAULT_DOWNLOAD_DIR,
+                 data_dir=DEFAULT_DATA_DIR, compression=True, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 headless=False, control_path=None, control_port=None, stats_port=None, relay=False,
+                 multicast=False, tls=False):
         self.port = port
+        self.relay = relay
+        self.headless = headless
+        self.stats_port = stats_port
+        self.stats_server = None
         self.running = False
-        
+
+        # Counters and timings shared by every component, see get_stats()
+        self.metrics = Metrics()
+
+        # Initialize persistent message history
+        self.store = MessageStore(os.path.join(data_dir, f"history-{port}.sqlite3"))
+        self.history_lock = threading.Lock()
+
+        # A new certificate every run; peers learn its fingerprint from our discovery record
+        self.tls = TLSIdentity.generate("LNChat") if tls else None
+
         # Initialize network discovery
-        self.discovery = NetworkDiscovery(port=port)
+        # Relays advertise their role, so clients can elect one instead of connecting to everyone
+        properties = {}
+        if relay:
+            properties["role"] = ROLE_RELAY
+        if self.tls:
+            properties["tls"] = self.tls.fingerprint
+        self.discovery = NetworkDiscovery(port=port, metrics=self.metrics, properties=properties)
         self.discovery.add_listener(self._on_service_change)
-        
+        # Names us as the author of our room messages, on peers they are synced to
+        self.author = f"{self.discovery.local_ip}:{port}"
+
         # Initialize network communication
-        self.communication = NetworkCommunication(
+        self.communication = TRANSPORTS[transport](
             port=port,
             message_callback=self._on_message_received,
-            connection_callback=self._on_connection_change
+            connection_callback=self._on_connection_change,
+            send_policy=send_policy,
+            send_queue_size=send_queue_size,
+            send_block_timeout=send_block_timeout,
+            download_dir=download_dir,
+            file_callback=self._on_file_event,
+            compression=compression,
+            compression_threshold=compression_threshold,
+            metrics=self.metrics,
+            node_id=self.discovery.unique_id,
+            relay_host=relay,
+            multicast=multicast,
+            tls=self.tls
         )
-        
+
+        # Catches up on the room messages exchanged while we or a peer were offline
+        self.history_sync = HistorySync(self.communication, self.store, ROOM_KEY, self._room_sender_name,
+                                        self._on_synced_message)
+
         # Initialize UI
-        self.ui = ChatUI(
+        self.ui = self._create_ui(data_dir, control_path, control_port)
+
+        # Last progress step reported per file transfer
+        self.transfer_progress = {}
+
+    def _create_ui(self, data_dir, control_path, control_port):
+        """Create the console front end when headless, the Tk window otherwise."""
+        callbacks = dict(
             send_callback=self._on_send_message,
-            connect_callback=self._on_connect_to_peer
+            connect_callback=self._on_connect_to_peer,
+            broadcast_callback=self._on_broadcast_message,
+            send_file_callback=self._on_send_file,
+            history_loader=self.store.load_page,
+            search_callback=self._on_search,
+            file_response_callback=self._on_file_response
         )
-        
-        # Keep track of connection attempts to avoid duplicates
-        self.connection_attempts = set()
-        
+        if self.headless:
+            from console_ui import ConsoleUI
+            control_token = None
+            if control_port is not None:
+                control_token = self._write_control_token(os.path.join(data_dir, f"control-{control_port}.token"))
+            return ConsoleUI(control_path=control_path, control_port=control_port, control_token=control_token,
+                             stats_callback=self.get_stats, **callbacks)
+
+        # Importing tkinter is slow and needs a display, so only the GUI pays for it
+        from chat_ui import ChatUI
+        return ChatUI(**callbacks)
+
+    def _write_control_token(self, path):
+        """Create a new control port token in a file only our own user may read."""
+        token = secrets.token_urlsafe(32)
+        if os.path.exists(path):
+            os.unlink(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as token_file:
+            token_file.write(token + "\n")
+        logger.info("Control port clients must first send the token in %s", path)
+        return token
+
     def _on_service_change(self, service_info, added):
         """Handle service discovery events."""
         ip, port = service_info
-        
+
         if added:
-            print(f"Discovered service: {ip}:{port}")
-            
-            # Attempt to connect to the discovered service
-            # Use a thread to avoid blocking
-            if (ip, port) not in self.connection_attempts:
-                self.connection_attempts.add((ip, port))
-                threading.Thread(
-                    target=self._connect_to_service,
-                    args=(ip, port)
-                ).start()
+            logger.info("Discovered service: %s:%d", ip, port)
+            # Connections to the peer are checked against the certificate it advertised
+            peer = self.discovery.get_peer(service_info)
+            if peer:
+                self.communication.pin_peer(ip, port, *peer)
         else:
-            print(f"Service removed: {ip}:{port}")
-            
-    def _connect_to_service(self, ip, port):
-        """Connect to a discovered service."""
-        # Wait a bit to avoid connection race conditions
-        time.sleep(1)
-        
-        # Attempt to connect
-        success = self.communication.connect_to_peer(ip, port)
-        if success:
-            print(f"Successfully connected to {ip}:{port}")
+            logger.info("Service removed: %s:%d", ip, port)
+            self.communication.reconnects.cancel((ip, port))
+        self._update_topology(service_info if added else None)
+
+    def _update_topology(self, discovered=None):
+        """Elect a relay, or fall back to connecting to every peer when there is none.
+
+        Every client elects the relay with the smallest id, so they all meet on the same
+        one and the room needs one connection per client instead of one per pair.
+        Relays themselves wait for clients to connect.
+        """
+        if self.relay:
+            return
+        relays = self.discovery.get_relays()
+        elected = relays[0][1] if relays else None
+        if elected != self.communication.relay:
+            logger.info("Room broadcasts now go %s", f"through the relay at {elected[0]}:{elected[1]}"
+                        if elected else "to every peer directly")
+            self.communication.relay = elected
+            # Without a relay, connect to everyone already discovered
+            targets = [elected] if elected else self.discovery.get_discovered_services()
+        elif elected is None and discovered is not None:
+            targets = [discovered]
         else:
-            # Remove from connection attempts to allow retry
-            self.connection_attempts.discard((ip, port))
-            
+            targets = []
+
+        # Connect in the background, retrying with backoff until it works. If the peer
+        # connects to us at the same time, the handshake keeps just one connection.
+        for ip, port in targets:
+            if not self.communication.find_peer(ip, port):
+                self.communication.reconnects.schedule((ip, port), ip, port)
+
     def _on_message_received(self, address, message):
         """Handle received messages."""
-        if message.get("type") == "message":
+        if str(message.get("type", "")).startswith("sync_"):
+            self.history_sync.handle_message(address, message)
+        elif message.get("type") == "message":
             content = message.get("content", "")
+            # Messages fanned out by the relay name the peer they came from; nobody else may
+            origin = message.get("origin_address")
+            if (origin is not None and self._is_relay(address) and isinstance(origin, list) and len(origin) == 2
+                    and isinstance(origin[0], str) and isinstance(origin[1], int)):
+                address = tuple(origin)
             sender_name = self.ui.peers.get(address, f"Peer ({address[0]}:{address[1]})")
-            
-            # Add message to UI
-            self.ui.add_message(sender_name, content)
-            
+            conversation = self._peer_key(address)
+            fields = {}
+            if message.get("room"):
+                sender_name += " (to all)"
+                conversation = ROOM_KEY
+                fields = sync_fields(message)
+
+            # Store the message and add it to the UI in the same order
+            with self.history_lock:
+                key = self.store.append(conversation, sender_name, content, **fields)
+                self.ui.add_message(sender_name, content, key=key)
+
+    def _is_relay(self, address):
+        """Whether address is our connection to the relay we elected."""
+        relay = self.communication.relay
+        return relay is not None and self.communication.find_peer(*relay) == address
+
+    def _on_synced_message(self, sender, content, key):
+        """Show a room message history sync brought in, at its place in the history."""
+        self.ui.add_message(sender, content, key=key)
+
+    def _room_sender_name(self, author):
+        """Sender name of a room message received through history sync."""
+        return f"Peer ({author}) (to all)"
+
+    def _peer_key(self, address):
+        """Conversation key under which messages exchanged with a peer are stored."""
+        return address[0]
+
     def _on_connection_change(self, address, connected):
         """Handle connection changes."""
         if connected:
             # Add peer to UI
             self.ui.add_peer(address)
+            # The side that dialled starts the history sync, so it runs once per connection
+            conn = self.communication.connections.get(address)
+            if conn is not None and conn.outgoing:
+                self.history_sync.start(address)
         else:
             # Remove peer from UI
             self.ui.remove_peer(address)
-            
-            # Allow reconnection attempts
-            self.connection_attempts.discard(address)
-            
+
     def _on_send_message(self, address, message):
-        """Handle sending a message from the UI."""
-        return self.communication.send_message(address, message)
-        
+        """Handle sending a message from the UI. Returns the stored key, or None on failure."""
+        if not self.communication.send_message(address, message):
+            return None
+        with self.history_lock:
+            return self.store.append(self._peer_key(address), "You", message.get("content", ""), outgoing=True)
+
+    def _on_broadcast_message(self, message):
+        """Handle sending a message to the whole room. Returns the stored key, or None if nobody is connected."""
+        if not self.communication.connections:
+            return None
+        # A uid, time and author let peers that miss the message catch up on it later
+        fields = {"uid": uuid.uuid4().hex, "timestamp": time.time(), "author": self.author}
+        self.communication.broadcast_message(dict(message, room=True, uid=fields["uid"],
+                                                  sent_at=fields["timestamp"], author=self.author))
+        with self.history_lock:
+            return self.store.append(ROOM_KEY, "You (to all)", message.get("content", ""), outgoing=True, **fields)
+
+    def _on_search(self, text, address=None, limit=50):
+        """Search the stored history, within the conversation with address if one is given."""
+        return self.store.search(text, peer=self._peer_key(address) if address else None, limit=limit)
+
+    def _on_send_file(self, address, path):
+        """Handle a file chosen in the UI for the selected peer."""
+        return self.communication.send_file(address, path) is not None
+
+    def _on_file_event(self, event, info):
+        """Report file transfer progress in the chat window."""
+        transfer_id = info["transfer_id"]
+        sending = info["direction"] == "send"
+        name = info["name"]
+
+        if event == "offer" and sending and transfer_id not in self.transfer_progress:
+            self.transfer_progress[transfer_id] = 0
+            self.ui.add_message("System", f"Sending {name} ({info['size']} bytes)")
+        elif event == "offer":
+            # Nothing is written to disk until the user accepts
+            address = info["address"]
+            sender_name = self.ui.peers.get(address, f"Peer ({address[0]}:{address[1]})")
+            self.ui.offer_file(transfer_id, sender_name, name, info["size"])
+        elif event == "accept" and not sending and transfer_id not in self.transfer_progress:
+            self.transfer_progress[transfer_id] = 0
+            self.ui.add_message("System", f"Receiving {name} ({info['size']} bytes)")
+        elif event == "progress" and info["size"]:
+            # Only report every 25% to keep the chat readable
+            step = info["offset"] * 4 // info["size"]
+            if step > self.transfer_progress.get(transfer_id, 0) and step < 4:
+                self.transfer_progress[transfer_id] = step
+                self.ui.add_message("System", f"{name}: {step * 25}%")
+        elif event == "complete":
+            self.transfer_progress.pop(transfer_id, None)
+            where = "" if sending else f" to {info['path']}"
+            self.ui.add_message("System", f"{name}: {'sent' if sending else 'saved'}{where}")
+        elif event == "failed":
+            self.transfer_progress.pop(transfer_id, None)
+            self.ui.add_message("System", f"{name}: transfer failed ({info.get('error', 'unknown error')})")
+
+    def _on_file_response(self, transfer_id, accepted):
+        """Receive or turn down a file a peer offered. Returns False if the offer is gone."""
+        transfers = self.communication.file_transfers
+        return transfers.accept_offer(transfer_id) if accepted else transfers.reject_offer(transfer_id)
+
     def _on_connect_to_peer(self, ip, port):
         """Handle manual connection to a peer."""
-        if (ip, port) not in self.connection_attempts:
-            self.connection_attempts.add((ip, port))
-            return self.communication.connect_to_peer(ip, port)
-        return False
-        
+        return self.communication.connect_to_peer(ip, port)
+
     def start(self):
         """Start the chat application."""
         self.running = True
-        
+
         # Start network communication
         self.communication.start_server()
-        
+
         # Start network discovery
-        self.discovery.register_service()
+        self.discovery.register_service_async()
         self.discovery.start_discovery()
-        
+
+        if self.stats_port is not None:
+            self.stats_server = start_stats_server(self.stats_port, self.get_stats)
+
+        mode = "headless" if self.headless else "GUI"
+        startup = time.perf_counter() - STARTED_AT
+        self.metrics.observe("startup_seconds", int(startup * 1e9))
+        logger.info("Started in %.0f ms (%s mode)", startup * 1000, mode)
+
         # Start UI in the main thread
         try:
             self.ui.start()
@@ -113,34 +321,103 @@ class LNChat:
             pass
         finally:
             self.stop()
-            
+
+    def get_stats(self):
+        """Return the application's metrics and per-peer statistics as plain data."""
+        stats = self.communication.get_stats()
+        stats["transfers"] = len(self.communication.file_transfers.get_transfers())
+        return stats
+
     def stop(self):
         """Stop the chat application."""
         if not self.running:
             return
-            
+
         self.running = False
-        
+
         # Stop network discovery
         self.discovery.stop()
-        
+
+        if self.stats_server:
+            self.stats_server.shutdown()
+
         # Stop network communication
         self.communication.stop()
-        
+        self.history_sync.stop()
+
+        # Write any pending history to disk
+        self.store.close()
+
         # Stop UI
         self.ui.stop()
-        
+
 if __name__ == "__main__":
-    # Default port
-    port = 5000
-    
-    # Check if port is provided as command line argument
-    if len(sys.argv) > 1:
-        try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print(f"Invalid port number: {sys.argv[1]}. Using default port {port}.")
-    
+    parser = argparse.ArgumentParser(description="LNChat - Local Network Chat")
+    parser.add_argument("port", nargs="?", type=int, default=5000, help="TCP port to listen on (default: 5000)")
+    parser.add_argument("--transport", choices=sorted(TRANSPORTS),
+                        help="networking engine: one thread per connection, or a single asyncio event loop "
+                             "(default: threads, or asyncio with --relay)")
+    parser.add_argument("--send-policy", choices=SEND_POLICIES, default=SEND_POLICY_DISCONNECT,
+                        help="what to do when a slow peer's send queue is full (default: disconnect)")
+    parser.add_argument("--send-block-timeout", type=float, default=DEFAULT_SEND_BLOCK_TIMEOUT,
+                        help="with --send-policy block, seconds to wait for room before dropping the message "
+                             f"(default: {DEFAULT_SEND_BLOCK_TIMEOUT:g})")
+    parser.add_argument("--send-queue-size", type=int, default=1000,
+                        help="maximum number of messages queued per peer (default: 1000)")
+    parser.add_argument("--download-dir", default=DEFAULT_DOWNLOAD_DIR,
+                        help="where received files are saved")
+    parser.add_argument("--data-dir", default=DEFAULT_DATA_DIR,
+                        help="where message history is stored (default: ~/.lnchat)")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="never compress messages, even for peers that support it")
+    parser.add_argument("--compression-threshold", type=int, default=DEFAULT_COMPRESSION_THRESHOLD,
+                        help=f"compress messages of at least this many bytes (default: {DEFAULT_COMPRESSION_THRESHOLD})")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window, taking commands on stdin (type /help)")
+    parser.add_argument("--control-socket", metavar="PATH",
+                        help="with --headless, also accept commands on a Unix-domain socket at PATH, "
+                             "which only our own user may open")
+    parser.add_argument("--control-port", type=int,
+                        help="with --headless, also accept commands on this port on 127.0.0.1 from clients "
+                             "that first send the token written to the data directory; "
+                             "prefer --control-socket where available")
+    parser.add_argument("--relay", action="store_true",
+                        help="relay room broadcasts for the peers on the network, which then connect only to us")
+    parser.add_argument("--multicast", action="store_true",
+                        help="send room messages as one UDP multicast datagram when every peer can receive it")
+    parser.add_argument("--tls", action="store_true",
+                        help="encrypt every connection; peers must be started with it too")
+    parser.add_argument("--stats-port", type=int,
+                        help="serve metrics as JSON on http://127.0.0.1:PORT/stats")
+    parser.add_argument("--log-level", choices=LOG_LEVELS, default="INFO",
+                        help="DEBUG also logs every message sent and received (default: INFO)")
+    args = parser.parse_args()
+    if args.control_socket and not hasattr(socket, "AF_UNIX"):
+        parser.error("--control-socket needs Unix-domain sockets; use --control-port on this platform")
+    if args.control_socket and args.control_port is not None:
+        parser.error("use either --control-socket or --control-port")
+    if args.tls and args.multicast:
+        parser.error("--multicast sends room messages as plain UDP datagrams and cannot be used with --tls")
+
+    logging.basicConfig(level=args.log_level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
     # Create and start the chat application
-    chat = LNChat(port=port)
+    chat = LNChat(
+        port=args.port,
+        transport=args.transport or ("asyncio" if args.relay else "threads"),
+        send_policy=args.send_policy,
+        send_queue_size=args.send_queue_size,
+        send_block_timeout=args.send_block_timeout,
+        download_dir=args.download_dir,
+        data_dir=args.data_dir,
+        compression=not args.no_compression,
+        compression_threshold=args.compression_threshold,
+        headless=args.headless,
+        control_path=args.control_socket,
+        control_port=args.control_port,
+        stats_port=args.stats_port,
+        relay=args.relay,
+        multicast=args.multicast,
+        tls=args.tls
+    )
     chat.start()
@@ -0,0 +1,399 @@
+import hashlib
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DATA_DIR = os.path.join(os.path.expanduser("~"), ".lnchat")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    peer TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    sender TEXT NOT NULL,
+    content TEXT NOT NULL,
+    outgoing INTEGER NOT NULL,
+    uid TEXT,
+    author TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_peer_time ON messages (peer, timestamp);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (timestamp);
+"""
+
+# Messages with a uid are shared between peers and kept in step by history sync. Each
+# SYNC_BUCKET_SECONDS of message time is a bucket whose hash, the XOR of its messages'
+# hashes, and count are updated as messages are written.
+SYNC_SCHEMA = """
+CREATE UNIQUE INDEX IF NOT EXISTS messages_uid ON messages (uid) WHERE uid IS NOT NULL;
+CREATE TABLE IF NOT EXISTS sync_buckets (
+    bucket INTEGER PRIMARY KEY,
+    hash INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+"""
+SYNC_BUCKET_SECONDS = 300
+
+# Full-text index over message content and conversation. It refers to the messages
+# table rather than keeping its own copy of the text, and the trigger indexes each
+# message as it is written. Indexing the peer lets the index itself narrow a search to
+# one conversation.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_search USING fts5(
+    content, peer, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_search (rowid, content, peer) VALUES (new.id, new.content, new.peer);
+END;
+"""
+
+# Matches a search takes from the index, newest written first, before ordering them by
+# message time; a multiple of the limit, as synced messages are written out of time order
+SEARCH_CANDIDATES_FACTOR = 4
+
+# Bytes of the database file mapped into memory, so the index is paged in as searches touch it
+MMAP_SIZE = 256 * 1024 * 1024
+
+def search_expression(text):
+    """Turn what the user typed into an FTS5 query matching every word, the last as a prefix.
+
+    Returns None when the text has no words.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    # Quoting keeps words like AND or NEAR from being read as operators
+    return " ".join(f'"{word}"' for word in words) + "*"
+    
+def message_hash(uid):
+    """Return the 64-bit hash a message contributes to its bucket."""
+    return int.from_bytes(hashlib.sha256(uid.encode("utf-8")).digest()[:8], "big", signed=True)
+    
+def sync_bucket(timestamp):
+    """Return the bucket of a message time; computed like SQLite's CAST, so queries agree."""
+    return int(timestamp / SYNC_BUCKET_SECONDS)
+    
+class MessageStore:
+    """Persistent chat history in SQLite.
+
+    Appends are queued and written in batches by a single background thread, so
+    callers never wait on the disk. Reads page through the history with the
+    (peer, timestamp) and (timestamp) indexes, so loading a page costs the same no
+    matter how much history has accumulated. Message content is also kept in a
+    full-text index, updated in the same transaction as each batch, which search()
+    queries without reading the messages that do not match. Messages appended with a
+    uid are written once however often they arrive, and summarised in per-bucket
+    hashes for history sync.
+    """
+    def __init__(self, path, batch_size=500, flush_interval=0.2):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        
+        # Readers use their own connection; the writer thread opens another
+        self._read_conn = self._connect()
+        self._read_conn.executescript(SCHEMA)
+        self._upgrade_schema()
+        self._read_conn.executescript(SYNC_SCHEMA)
+        self._read_lock = threading.Lock()
+        self.searchable = self._create_search_index()
+        
+        # Ids are assigned up front so callers can refer to a message before it is written
+        (last_id,) = self._read_conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()
+        self._next_id = last_id + 1
+        self._id_lock = threading.Lock()
+        self._on_written = {}  # {id: callback} of messages whose writing someone awaits
+        
+        self._pending = queue.Queue()
+        self._writer_thread = threading.Thread(target=self._write_loop)
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+        
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        return conn
+        
+    def _upgrade_schema(self):
+        """Add the columns history written by older versions lacks."""
+        conn = self._read_conn
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+        with conn:
+            for column in ("uid", "author"):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE messages ADD COLUMN {column} TEXT")
+                    
+    def _create_search_index(self):
+        """Create the full-text index, indexing any history written before it existed.
+
+        Returns False if this SQLite build lacks FTS5, in which case search() scans.
+        """
+        conn = self._read_conn
+        exists = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'messages_search'").fetchone()
+        if exists and "peer" not in exists[0]:
+            # Written by a version that indexed content alone
+            with conn:
+                conn.execute("DROP TRIGGER IF EXISTS messages_search_insert")
+                conn.execute("DROP TABLE messages_search")
+            exists = None
+        try:
+            with conn:
+                conn.executescript(SEARCH_SCHEMA)
+                if not exists:
+                    conn.execute("INSERT INTO messages_search (messages_search) VALUES ('rebuild')")
+        except sqlite3.OperationalError as e:
+            logger.warning("Full-text search unavailable, searches will scan the history: %s", e)
+            return False
+        return True
+        
+    def append(self, peer, sender, content, outgoing=False, timestamp=None, uid=None, author=None,
+               on_written=None):
+        """Queue a message for writing and return its (timestamp, id) key.
+
+        A message with a uid takes part in history sync, and is not written if a message
+        with the same uid already was. author names who wrote it for the peers it is
+        synced to. on_written(key) is called from the writer thread once the message
+        is written, and not at all if it was skipped.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._id_lock:
+            message_id = self._next_id
+            self._next_id += 1
+            if on_written is not None:
+                self._on_written[message_id] = on_written
+        self._pending.put((message_id, peer, timestamp, sender, content, int(outgoing), uid, author))
+        return timestamp, message_id
+        
+    def _write_loop(self):
+        """Write queued messages in batches, one transaction per batch."""
+        conn = self._connect()
+        running = True
+        while running:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                if item is None:
+                    break
+                    
+            # None marks the end of the queue; flush markers are events to set
+            rows = [item for item in batch if isinstance(item, tuple)]
+            if rows:
+                queued = rows
+                try:
+                    with conn:
+                        rows = self._new_rows(conn, rows)
+                        conn.executemany(
+                            "INSERT INTO messages (id, peer, timestamp, sender, content, outgoing, uid, author) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            rows
+                        )
+                        self._update_buckets(conn, rows)
+                except sqlite3.Error as e:
+                    logger.error("Error writing message history: %s", e)
+                    rows = []
+                self._notify_written(queued, rows)
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    item.set()
+        conn.close()
+        
+    def _notify_written(self, queued, written):
+        """Call the on_written callbacks of a batch's messages that were written."""
+        if not self._on_written:
+            return
+        with self._id_lock:
+            callbacks = [self._on_written.pop(row[0], None) for row in queued]
+        written_ids = {row[0] for row in written}
+        for row, callback in zip(queued, callbacks):
+            if callback is not None and row[0] in written_ids:
+                try:
+                    callback((row[2], row[0]))
+                except Exception as e:
+                    logger.error("Error in message written callback: %s", e)
+        
+    def _new_rows(self, conn, rows):
+        """Drop the rows whose uid is already stored or earlier in the batch."""
+        uids = [row[6] for row in rows if row[6] is not None]
+        if not uids:
+            return rows
+        placeholders = ", ".join("?" * len(uids))
+        seen = {uid for (uid,) in conn.execute(f"SELECT uid FROM messages WHERE uid IN ({placeholders})", uids)}
+        new_rows = []
+        for row in rows:
+            uid = row[6]
+            if uid is not None:
+                if uid in seen:
+                    continue
+                seen.add(uid)
+            new_rows.append(row)
+        return new_rows
+        
+    def _update_buckets(self, conn, rows):
+        """Fold newly written messages into their buckets' hashes and counts."""
+        added = {}  # {bucket: (hash, count)} of the new messages
+        for row in rows:
+            uid = row[6]
+            if uid is not None:
+                bucket = sync_bucket(row[2])
+                bucket_hash, count = added.get(bucket, (0, 0))
+                added[bucket] = (bucket_hash ^ message_hash(uid), count + 1)
+        if not added:
+            return
+        placeholders = ", ".join("?" * len(added))
+        for bucket, bucket_hash, count in conn.execute(
+                f"SELECT bucket, hash, count FROM sync_buckets WHERE bucket IN ({placeholders})", list(added)):
+            new_hash, new_count = added[bucket]
+            added[bucket] = (new_hash ^ bucket_hash, new_count + count)
+        conn.executemany("INSERT OR REPLACE INTO sync_buckets (bucket, hash, count) VALUES (?, ?, ?)",
+                         [(bucket, bucket_hash, count) for bucket, (bucket_hash, count) in added.items()])
+        
+    def flush(self, timeout=None):
+        """Wait until every message appended so far has been written."""
+        done = threading.Event()
+        self._pending.put(done)
+        return done.wait(timeout)
+        
+    def load_page(self, peer=None, before=None, after=None, limit=100):
+        """Return up to limit messages, oldest first, as (key, sender, content) records.
+
+        Keys are (timestamp, id) tuples. With before, the newest messages older than that
+        key are returned; with after, the oldest messages newer than it; otherwise the
+        most recent ones. peer restricts the page to one conversation.
+        """
+        clauses = []
+        params = []
+        if peer is not None:
+            clauses.append("peer = ?")
+            params.append(peer)
+        if before is not None:
+            clauses.append("(timestamp, id) < (?, ?)")
+            params.extend(before)
+        if after is not None:
+            clauses.append("(timestamp, id) > (?, ?)")
+            params.extend(after)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        order = "ASC" if after is not None else "DESC"
+        query = (f"SELECT timestamp, id, sender, content FROM messages {where} "
+                 f"ORDER BY timestamp {order}, id {order} LIMIT ?")
+        params.append(limit)
+        
+        with self._read_lock:
+            rows = self._read_conn.execute(query, params).fetchall()
+        if order == "DESC":
+            rows.reverse()
+        return [((timestamp, message_id), sender, content) for timestamp, message_id, sender, content in rows]
+        
+    def search(self, text, peer=None, since=None, until=None, limit=50):
+        """Return up to limit messages containing every word of text, newest first.
+
+        Records are (key, peer, sender, content), with keys as in load_page. The last
+        word also matches longer words starting with it, so results can follow typing.
+        peer restricts the search to one conversation, since and until to a time range.
+        Messages still waiting to be written are not found.
+
+        The index finds the matches, including for a peer, and only the newest written
+        few times limit of them are read and ordered by message time, so a search costs
+        the same however many messages match. A time range, or a peer key without
+        words such as the room's, is checked against every match instead.
+        """
+        expression = search_expression(text)
+        if expression is None:
+            return []
+        clauses = []
+        params = []
+        if self.searchable:
+            expression = f"content : ({expression})"
+            indexed_peer = peer is None or re.search(r"\w", peer)
+            if peer is not None and indexed_peer:
+                # The exact peer is checked below; the index narrows the matches to it first
+                expression += ' AND peer : ^"{}"'.format(peer.replace('"', '""'))
+            candidates = limit * SEARCH_CANDIDATES_FACTOR
+            if since is not None or until is not None or not indexed_peer:
+                candidates = -1
+            source = ("messages JOIN (SELECT rowid FROM messages_search WHERE messages_search MATCH ? "
+                      "ORDER BY rowid DESC LIMIT ?) AS hits ON messages.id = hits.rowid")
+            params.extend((expression, candidates))
+        else:
+            source = "messages"
+            for word in re.findall(r"\w+", text):
+                clauses.append("content LIKE ?")
+                params.append(f"%{word}%")
+        if peer is not None:
+            clauses.append("peer = ?")
+            params.append(peer)
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        query = (f"SELECT timestamp, id, peer, sender, content FROM {source} "
+                 f"{where} ORDER BY timestamp DESC, id DESC LIMIT ?")
+        params.append(limit)
+        
+        with self._read_lock:
+            rows = self._read_conn.execute(query, params).fetchall()
+        return [((timestamp, message_id), peer, sender, content)
+                for timestamp, message_id, peer, sender, content in rows]
+                
+    def sync_buckets(self, low, high):
+        """Return the (bucket, hash, count) of every non-empty bucket from low up to high, in order."""
+        with self._read_lock:
+            return self._read_conn.execute(
+                "SELECT bucket, hash, count FROM sync_buckets WHERE bucket >= ? AND bucket < ? ORDER BY bucket",
+                (low, high)).fetchall()
+                
+    def _bucket_clause(self, low, high):
+        # The timestamp bounds let the index narrow the scan; the bucket check is exact
+        clause = ("uid IS NOT NULL AND timestamp >= ? AND timestamp < ? "
+                  f"AND CAST(timestamp / {SYNC_BUCKET_SECONDS} AS INTEGER) BETWEEN ? AND ?")
+        return clause, ((low - 1) * SYNC_BUCKET_SECONDS, (high + 1) * SYNC_BUCKET_SECONDS, low, high - 1)
+        
+    def sync_ids(self, low, high):
+        """Return the uids of the messages in the buckets from low up to high."""
+        clause, params = self._bucket_clause(low, high)
+        with self._read_lock:
+            return [uid for (uid,) in self._read_conn.execute(f"SELECT uid FROM messages WHERE {clause}", params)]
+            
+    def sync_records(self, low=None, high=None, uids=None):
+        """Return messages to sync as [uid, timestamp, author, content] records, oldest first.
+
+        Selects the messages in the buckets from low up to high, or those with the given uids.
+        """
+        if uids is not None:
+            clause = f"uid IN ({', '.join('?' * len(uids))})"
+            params = list(uids)
+        else:
+            clause, params = self._bucket_clause(low, high)
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                f"SELECT uid, timestamp, author, content FROM messages WHERE {clause} ORDER BY timestamp, id",
+                params).fetchall()
+        return [list(row) for row in rows]
+        
+    def close(self):
+        """Write everything still queued and close the database."""
+        self._pending.put(None)
+        self._writer_thread.join(timeout=5)
+        with self._read_lock:
+            self._read_conn.close()
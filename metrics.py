@@ -0,0 +1,204 @@
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Hot paths time one operation in this many; a sample describes the distribution just as well
+TIMING_SAMPLE_INTERVAL = 16
+
+# Histogram buckets are powers of two of roughly a microsecond (1024 ns), up to about 69 s
+BUCKET_COUNT = 27
+
+class Histogram:
+    """Distribution of durations in exponentially sized buckets.
+
+    Durations are recorded in integer nanoseconds; finding the bucket is a shift and a
+    bit_length(), so recording costs the same however many values have been recorded.
+    Percentiles are estimated as the upper bound of the bucket they fall in, so they
+    are accurate to within a factor of two.
+    """
+    def __init__(self):
+        self.buckets = [0] * BUCKET_COUNT
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        
+    def observe(self, nanoseconds):
+        index = (nanoseconds >> 10).bit_length()
+        self.buckets[index if index < BUCKET_COUNT else BUCKET_COUNT - 1] += 1
+        self.count += 1
+        self.total += nanoseconds
+        if self.min is None or nanoseconds < self.min:
+            self.min = nanoseconds
+        if nanoseconds > self.max:
+            self.max = nanoseconds
+            
+    def merge(self, other):
+        """Add the values recorded by another histogram."""
+        buckets = list(other.buckets)
+        for index, count in enumerate(buckets):
+            self.buckets[index] += count
+        self.count += sum(buckets)
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+        
+    def percentile(self, fraction):
+        """Estimate a percentile in seconds."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                # The last bucket also holds everything longer, so it has no upper bound
+                bound = 1024 << index if index < BUCKET_COUNT - 1 else self.max
+                return min(bound, self.max) / 1e9
+        return self.max / 1e9
+        
+    def snapshot(self):
+        """Summarize the distribution in seconds."""
+        return {
+            "count": self.count,
+            "mean": self.total / self.count / 1e9 if self.count else None,
+            "min": self.min / 1e9 if self.count else None,
+            "p50": self.percentile(0.50),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            "max": self.max / 1e9 if self.count else None,
+        }
+        
+class _Shard:
+    """Counters and histograms written by a single thread."""
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.counters = {}
+        self.histograms = {}
+        
+    def merge_into(self, counters, histograms):
+        # Copying a dict or list is atomic under the GIL, so the owner may keep writing
+        for name, value in dict(self.counters).items():
+            counters[name] = counters.get(name, 0) + value
+        for name, histogram in dict(self.histograms).items():
+            total = histograms.get(name)
+            if total is None:
+                total = histograms[name] = Histogram()
+            total.merge(histogram)
+            
+class Metrics:
+    """Registry of named counters and duration histograms.
+
+    Every thread records into its own shard, so the hot paths never contend for a
+    lock; shards are only combined when a snapshot is taken. Components that already
+    keep their own counts can register a collector instead of counting twice.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self._collectors = []
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()  # Totals of shards whose threads have exited
+        
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self.lock:
+                self._shards.append(shard)
+            return shard
+            
+    def increment(self, name, value=1):
+        """Add value to a counter."""
+        counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + value
+        
+    def observe(self, name, nanoseconds):
+        """Record a duration, in nanoseconds, in a histogram."""
+        histograms = self._shard().histograms
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.observe(nanoseconds)
+        
+    def add_collector(self, collector):
+        """Register a function returning {name: value} counters to add to every snapshot."""
+        with self.lock:
+            self._collectors.append(collector)
+            
+    def timer(self, name):
+        """Context manager recording the duration of its block in a histogram."""
+        return _Timer(self, name)
+        
+    def snapshot(self):
+        """Return every counter and histogram summary as plain data."""
+        counters = {}
+        histograms = {}
+        with self.lock:
+            # Fold the shards of finished threads into the retired totals for good
+            live = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    live.append(shard)
+                else:
+                    shard.merge_into(self._retired.counters, self._retired.histograms)
+            self._shards = live
+            self._retired.merge_into(counters, histograms)
+            for shard in live:
+                shard.merge_into(counters, histograms)
+            collectors = list(self._collectors)
+        for collector in collectors:
+            for name, value in collector().items():
+                counters[name] = counters.get(name, 0) + value
+        return {
+            "uptime_seconds": time.time() - self.started,
+            "counters": counters,
+            "histograms": {name: histogram.snapshot() for name, histogram in histograms.items()},
+        }
+        
+class _Timer:
+    __slots__ = ("metrics", "name", "start")
+    
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+        
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter_ns() - self.start)
+        
+class _StatsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/stats"):
+            self.send_error(404)
+            return
+        body = json.dumps(self.server.get_stats(), indent=2, default=str).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def log_message(self, format, *args):
+        logger.debug("Stats request from %s: %s", self.address_string(), format % args)
+        
+def start_stats_server(port, get_stats):
+    """Serve get_stats() as JSON on http://127.0.0.1:port/stats from a background thread."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), _StatsHandler)
+    server.daemon_threads = True
+    server.get_stats = get_stats
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("Stats available at http://127.0.0.1:%d/stats", server.server_address[1])
+    return server
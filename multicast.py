@@ -0,0 +1,319 @@
+import logging
+import socket
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from codec import JSON_CODEC, CodecError
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# Administratively scoped group and port shared by every LNChat node on the LAN
+MULTICAST_GROUP = "239.255.76.78"
+MULTICAST_PORT = 47478
+
+# Every datagram starts with the magic byte, the sender's node id, the TCP port it
+# listens on and a per-sender sequence number. A datagram without a payload is a
+# heartbeat carrying the last sequence number sent.
+DATAGRAM_MAGIC = 0xD1
+DATAGRAM_HEADER = struct.Struct("!B16sHQ")
+
+# Larger messages go over TCP: this fits a 1500-byte MTU with room for the IP and
+# UDP headers, so datagrams are never fragmented
+MAX_DATAGRAM_PAYLOAD = 1200
+
+# Messages kept for repairing other nodes' gaps
+HISTORY_SIZE = 1024
+
+# How long a gap may wait for its repair before the missing messages are given up
+REPAIR_TIMEOUT = 1.0
+
+# Pause after the last message before a heartbeat lets receivers notice a lost tail
+HEARTBEAT_DELAY = 0.5
+
+# Senders tracked at once; the one heard from least recently makes room for a new one
+MAX_STREAMS = 256
+
+# Senders not heard from for this long are forgotten
+STREAM_IDLE_TIMEOUT = 300
+
+class _Stream:
+    """Receive state for one sender."""
+    def __init__(self, next_seq):
+        self.next_seq = next_seq  # Next sequence number to deliver
+        self.highest = next_seq - 1  # Highest sequence number known to have been sent
+        self.pending = {}  # {seq: (address, message)} received ahead of a gap
+        self.gap_since = None  # When the oldest unfilled gap was noticed
+        self.requested = set()  # Missing sequence numbers already asked for
+        self.last_heard = time.monotonic()
+        
+    def missing(self):
+        return [seq for seq in range(self.next_seq, self.highest + 1) if seq not in self.pending]
+        
+class MulticastChannel:
+    """Room broadcasts as IP multicast datagrams, one per message however big the room.
+
+    Each sender numbers its datagrams. A receiver delivers every sender's messages in
+    order; when it sees a gap it asks the sender for the missing messages over their
+    TCP connection, through request_repair(sender, seqs), and holds back later ones
+    until they arrive or REPAIR_TIMEOUT passes. Senders keep their last HISTORY_SIZE
+    messages to answer such requests, so messages further behind are given up without
+    asking, however large a sequence number a datagram claims. Messages whose encoding exceeds
+    MAX_DATAGRAM_PAYLOAD are numbered but not sent, and the caller sends them over TCP
+    like a repair, so they keep their place in the sender's order.
+    """
+    def __init__(self, node_id, port, deliver, request_repair, group=MULTICAST_GROUP,
+                 multicast_port=MULTICAST_PORT, metrics=None):
+        self.node_id = uuid.UUID(node_id)
+        self.port = port  # Our TCP port, so receivers know where to find us
+        self.deliver = deliver  # deliver(sender, address, message)
+        self.request_repair = request_repair  # request_repair(sender, seqs) -> bool
+        self.group = group
+        self.multicast_port = multicast_port
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.sock = None
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+        self._seq = 0
+        self._history = OrderedDict()  # {seq: message} of our latest messages
+        self._last_send = None  # When we last sent a message not yet followed by a heartbeat
+        self._streams = OrderedDict()  # {sender UUID: _Stream}, least recently heard first
+        
+    def start(self):
+        """Join the group and start receiving."""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # Every node on this host listens on the same port
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind(("", self.multicast_port))
+        membership = struct.pack("4s4s", socket.inet_aton(self.group), socket.inet_aton("0.0.0.0"))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)  # Stay on the LAN
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)  # Reach nodes on this host
+        self.sock.settimeout(0.2)
+        self.running = True
+        self.thread = threading.Thread(target=self._receive_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Multicast channel joined %s:%d", self.group, self.multicast_port)
+        
+    @property
+    def last_seq(self):
+        """Sequence number of the last message sent, 0 before the first."""
+        return self._seq
+        
+    def _datagram(self, seq, payload=b""):
+        return DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, self.node_id.bytes, self.port, seq) + payload
+        
+    def send(self, message):
+        """Send a message to the group.
+
+        Returns its sequence number and whether it was sent; a message too large for a
+        datagram must be delivered with that sequence number over TCP instead.
+        """
+        payload = JSON_CODEC.encode(message)
+        too_large = len(payload) > MAX_DATAGRAM_PAYLOAD
+        with self.lock:
+            self._seq += 1
+            seq = self._seq
+            self._history[seq] = message
+            if len(self._history) > HISTORY_SIZE:
+                self._history.popitem(last=False)
+            self._last_send = time.monotonic()
+        if too_large:
+            self.metrics.increment("multicast_too_large")
+            return seq, False
+        try:
+            self.sock.sendto(self._datagram(seq, payload), (self.group, self.multicast_port))
+        except OSError as e:
+            # Receivers repair the gap from the history like any other loss
+            logger.warning("Error sending multicast datagram: %s", e)
+        self.metrics.increment("multicast_sent")
+        return seq, True
+        
+    def repair(self, seqs):
+        """Return the (seq, message) pairs still in our history among seqs."""
+        with self.lock:
+            return [(seq, self._history[seq]) for seq in seqs if seq in self._history]
+            
+    def _receive_loop(self):
+        while self.running:
+            try:
+                data, (ip, _) = self.sock.recvfrom(65535)
+            except socket.timeout:
+                data = None
+            except OSError:
+                break
+            if data:
+                self._on_datagram(data, ip)
+            self._expire_gaps()
+            self._heartbeat()
+            
+    def _on_datagram(self, data, ip):
+        if len(data) < DATAGRAM_HEADER.size or data[0] != DATAGRAM_MAGIC:
+            return
+        _, sender, port, seq = DATAGRAM_HEADER.unpack_from(data)
+        sender = uuid.UUID(bytes=sender)
+        if sender == self.node_id:
+            return  # Looped back to us
+        payload = data[DATAGRAM_HEADER.size:]
+        
+        message = None
+        if payload:
+            try:
+                message = JSON_CODEC.decode(payload)
+            except CodecError as e:
+                logger.warning("Received invalid multicast message from %s: %s", ip, e)
+            if not isinstance(message, dict):
+                message = None  # Still fills its place in the sequence
+            self.metrics.increment("multicast_received")
+            
+        with self.lock:
+            # Start with whatever is sent after we joined
+            stream = self._stream(sender, seq if payload else seq + 1)
+            if payload:
+                self._accept(sender, stream, seq, (ip, port), message)
+            else:
+                stream.highest = max(stream.highest, seq)
+                self._skip_unrepairable(sender, stream)
+            missing = self._note_gap(stream)
+        if missing:
+            self._request(sender, missing)
+            
+    def expect(self, sender, next_seq):
+        """Start receiving from sender at next_seq, unless its datagrams already arrived.
+
+        Without this, a receiver starts at the first datagram it happens to get, and
+        messages lost before it are never asked for.
+        """
+        with self.lock:
+            self._stream(sender, next_seq)
+            
+    def on_repair(self, sender, seq, address, message):
+        """Accept a message sent over TCP, as a repair or because it was too large."""
+        with self.lock:
+            stream = self._stream(sender, seq)
+            if not self._accept(sender, stream, seq, address, message):
+                return
+        self.metrics.increment("multicast_repaired")
+        
+    def _stream(self, sender, next_seq):
+        """Return the receive state of a sender just heard from, starting it at next_seq if new.
+
+        Called with the lock held.
+        """
+        stream = self._streams.get(sender)
+        if stream is None:
+            if len(self._streams) >= MAX_STREAMS:
+                self._streams.popitem(last=False)
+            stream = self._streams[sender] = _Stream(next_seq)
+        else:
+            self._streams.move_to_end(sender)
+            stream.last_heard = time.monotonic()
+        return stream
+        
+    def _accept(self, sender, stream, seq, address, message):
+        """Queue a message and deliver everything now in order. Called with the lock held.
+
+        Returns False for a message already delivered, queued or given up on.
+        """
+        if seq < stream.next_seq or seq in stream.pending:
+            return False
+        stream.pending[seq] = (address, message)
+        stream.highest = max(stream.highest, seq)
+        self._deliver_ready(sender, stream)
+        self._skip_unrepairable(sender, stream)
+        return True
+        
+    def _skip_unrepairable(self, sender, stream):
+        """Give up on messages too far behind for the sender to still hold. Called with the lock held."""
+        oldest = stream.highest - HISTORY_SIZE + 1
+        if stream.next_seq >= oldest:
+            return
+        held = sorted(seq for seq in stream.pending if seq < oldest)
+        lost = oldest - stream.next_seq - len(held)
+        logger.warning("Lost %d multicast messages from %s", lost, sender)
+        self.metrics.increment("multicast_lost", lost)
+        for seq in held:
+            address, message = stream.pending.pop(seq)
+            if message is not None:
+                self.deliver(sender, address, message)
+        stream.next_seq = oldest
+        stream.requested = {seq for seq in stream.requested if seq >= oldest}
+        self._deliver_ready(sender, stream)
+        
+    def _deliver_ready(self, sender, stream):
+        while stream.next_seq in stream.pending:
+            address, message = stream.pending.pop(stream.next_seq)
+            stream.next_seq += 1
+            if message is not None:
+                self.deliver(sender, address, message)
+        if stream.next_seq > stream.highest:
+            stream.gap_since = None
+            stream.requested.clear()
+            
+    def _note_gap(self, stream):
+        """Return the missing sequence numbers not asked for yet."""
+        if stream.next_seq > stream.highest:
+            return None
+        if stream.gap_since is None:
+            stream.gap_since = time.monotonic()
+        missing = [seq for seq in stream.missing() if seq not in stream.requested]
+        stream.requested.update(missing)
+        return missing
+        
+    def _request(self, sender, seqs):
+        self.metrics.increment("multicast_nacks")
+        if not self.request_repair(sender, seqs):
+            logger.debug("Cannot repair %d multicast messages from %s without a connection", len(seqs), sender)
+            
+    def _expire_gaps(self):
+        """Give up on gaps whose repair has not arrived in time."""
+        now = time.monotonic()
+        with self.lock:
+            while self._streams:
+                sender, stream = next(iter(self._streams.items()))
+                if now - stream.last_heard < STREAM_IDLE_TIMEOUT:
+                    break
+                del self._streams[sender]
+            for sender, stream in self._streams.items():
+                if stream.gap_since is None or now - stream.gap_since < REPAIR_TIMEOUT:
+                    continue
+                next_seq = min(stream.pending) if stream.pending else stream.highest + 1
+                lost = next_seq - stream.next_seq
+                logger.warning("Lost %d multicast messages from %s", lost, sender)
+                self.metrics.increment("multicast_lost", lost)
+                stream.next_seq = next_seq
+                stream.gap_since = None
+                self._deliver_ready(sender, stream)
+                # Later gaps were asked for when they opened; they get a full timeout too
+                self._note_gap(stream)
+                
+    def _heartbeat(self):
+        """After a burst, announce our last sequence number so a lost tail is noticed."""
+        with self.lock:
+            if self._last_send is None or time.monotonic() - self._last_send < HEARTBEAT_DELAY:
+                return
+            self._last_send = None
+            seq = self._seq
+        try:
+            self.sock.sendto(self._datagram(seq), (self.group, self.multicast_port))
+        except OSError as e:
+            logger.debug("Error sending multicast heartbeat: %s", e)
+            
+    def stop(self):
+        """Leave the group and stop receiving."""
+        self.running = False
+        if self.sock:
+            # Shutting down wakes recvfrom() at once; it reports ENOTCONN on a UDP socket
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+        if self.thread:
+            self.thread.join(timeout=1)
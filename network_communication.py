@@ -1,18 +1,353 @@
+import base64
+import itertools
+import logging
 import socket
 import threading
-import json
 import time
+import uuid
+from collections import OrderedDict, deque
+from framing import FrameDecoder, FrameTooLargeError, HEADER_SIZE, MAX_FRAME_SIZE, encode_frame
+from codec import ADVERTISED_CODECS, JSON_CODEC, CodecError, decode_payload, negotiate_codec
+from compression import (COMPRESSED_MAGIC, COMPRESSIONS, DEFAULT_COMPRESSION_LEVEL,
+                         DEFAULT_COMPRESSION_THRESHOLD, CompressionError, StreamCompressor,
+                         StreamDecompressor, negotiate_compression)
+from file_transfer import FileTransferManager, DEFAULT_DOWNLOAD_DIR
+from metrics import Metrics, TIMING_SAMPLE_INTERVAL
+from reconnect import ReconnectScheduler
+from multicast import MULTICAST_GROUP, MULTICAST_PORT, MulticastChannel
+from session import MAX_SESSIONS, SEQUENCE_HEADER, SEQUENCED_MAGIC, PeerSession
+from flow_control import DEFAULT_INBOUND_BURST, DEFAULT_INBOUND_BYTE_RATE, DEFAULT_INBOUND_RATE, FlowLimiter
+from tls import TLSSocket, certificate_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# What to do when a peer's outbound queue is full
+SEND_POLICY_DROP = "drop"  # Discard the new frame
+SEND_POLICY_DISCONNECT = "disconnect"  # Close the connection to the slow peer
+SEND_POLICY_BLOCK = "block"  # Wait for room in the queue
+SEND_POLICIES = (SEND_POLICY_DROP, SEND_POLICY_DISCONNECT, SEND_POLICY_BLOCK)
+
+# Seconds the block policy waits for room before dropping the frame, so a stalled
+# peer cannot hold up the sender, possibly the UI thread, indefinitely
+DEFAULT_SEND_BLOCK_TIMEOUT = 1.0
+
+# Attempts to win back a dropped peer, about two minutes' worth, before waiting for discovery
+RECONNECT_ATTEMPTS = 8
+
+# How long a writer waits for more frames to share a write with, in seconds
+DEFAULT_FLUSH_WINDOW = 0.0005
+
+# A write stops waiting for more frames once this many bytes are queued
+COALESCE_BYTES = 64 * 1024
+
+# Most buffers a single sendmsg() takes (IOV_MAX on Linux and macOS)
+MAX_IOVECS = 1024
+
+# Seconds of silence before keepalive probes start, then between probes, and the number
+# of unanswered probes after which the connection is dropped
+DEFAULT_KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 5
+
+class OutboundQueue:
+    """Bounded queue of encoded frames waiting to be written to one peer."""
+    # Results of put()
+    QUEUED = "queued"
+    DROPPED = "dropped"
+    OVERFLOW = "overflow"
+    CLOSED = "closed"
+
+    def __init__(self, maxsize=1000, policy=SEND_POLICY_DISCONNECT, block_timeout=DEFAULT_SEND_BLOCK_TIMEOUT,
+                 metrics=None):
+        if policy not in SEND_POLICIES:
+            raise ValueError(f"Unknown send policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.metrics = metrics
+        self.frames = deque()
+        self.queued_bytes = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+        # Statistics
+        self.max_depth = 0
+        self.dropped_frames = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+
+    def put(self, data, can_block=True):
+        """Queue a frame, applying the overflow policy when the queue is full."""
+        with self._cond:
+            if self.closed:
+                return self.CLOSED
+
+            if len(self.frames) >= self.maxsize:
+                if self.policy == SEND_POLICY_DISCONNECT:
+                    self._record_dropped()
+                    return self.OVERFLOW
+
+                has_room = lambda: self.closed or len(self.frames) < self.maxsize
+                if not (self.policy == SEND_POLICY_BLOCK and can_block
+                        and self._cond.wait_for(has_room, self.block_timeout)):
+                    self._record_dropped()
+                    return self.DROPPED
+                if self.closed:
+                    return self.CLOSED
+
+            self.frames.append(data)
+            self.queued_bytes += len(data)
+            self.max_depth = max(self.max_depth, len(self.frames))
+            self._cond.notify_all()
+            return self.QUEUED
+
+    def wait_for_room(self, timeout=None):
+        """Wait until a frame can be queued without overflowing. Returns False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self.closed or len(self.frames) < self.maxsize, timeout)
+            
+    def take(self, block=True, linger=0):
+        """Remove and return every queued frame. Returns None once closed and empty.
+
+        With linger, frames queued within that many seconds of the first are returned in
+        the same batch, unless COALESCE_BYTES are queued sooner.
+        """
+        with self._cond:
+            if block:
+                self._cond.wait_for(lambda: self.frames or self.closed)
+            if not self.frames:
+                return None if self.closed else []
+            if linger:
+                self._cond.wait_for(lambda: self.closed or self.queued_bytes >= COALESCE_BYTES, linger)
+            batch = list(self.frames)
+            self.frames.clear()
+            self.queued_bytes = 0
+            self._cond.notify_all()
+            return batch
+
+    def _record_dropped(self):
+        self.dropped_frames += 1
+        if self.metrics:
+            self.metrics.increment("frames_dropped")
+
+    def record_sent(self, frames, nbytes):
+        """Account for frames written to the socket."""
+        self.sent_frames += frames
+        self.sent_bytes += nbytes
+        if self.metrics:
+            self.metrics.increment("frames_out", frames)
+            self.metrics.increment("bytes_out", nbytes)
+
+    def close(self):
+        """Wake up every waiting reader and writer; no further frames are accepted."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        """Return queue depth and throughput counters."""
+        return {
+            "depth": len(self.frames),
+            "max_depth": self.max_depth,
+            "capacity": self.maxsize,
+            "dropped_frames": self.dropped_frames,
+            "sent_frames": self.sent_frames,
+            "sent_bytes": self.sent_bytes,
+        }
+
+class ConnectionState:
+    """Per-connection protocol state shared by the threaded and asyncio transports."""
+    def __init__(self, communication, address, outgoing=False):
+        self.communication = communication
+        self.address = address
+        self.outgoing = outgoing  # We opened this connection, rather than accepted it
+        self.peer_id = None  # The peer's node id, from its hello
+        self.peer_port = None  # The port the peer listens on, from its hello
+        self.multicast = None  # The (group, port) the peer receives room broadcasts on, if any
+        self.announced = False  # The connection callback has reported this connection
+        self.session = None  # The peer's PeerSession, if its hello offered to resume
+        self.resumed = False  # The peer told us what it has received, so sequenced messages may flow
+        self.outbound = communication._create_outbound_queue()
+        self.inbound_limiter = communication._create_inbound_limiter(address)  # None when unlimited
+        self.outbound_limiter = None  # Keeps us to the limits the peer advertised, if any
+        self.throttled = False  # We have stopped reading from the peer for going over its limits
+        self.tls_object = None  # The connection's SSLObject, when it is encrypted
+        self.verified = False  # The peer proved it holds the certificate pinned for it
+        self.verifying = None  # The hello of a peer that dialled us, held until it authenticates
+        self.deferred = []  # Messages the peer sent while it was authenticating
+        self.rejected = False  # Closed because the peer's certificate failed its pin check
+        self.codec = JSON_CODEC  # Until the peer's hello offers something better
+        self.compressor = None  # Set once the peer's hello offers compression
+        self.decompressor = None  # Created when the peer first sends a compressed payload
+        self.handshake_done = False
+
+        # Only ever updated by the receiving side of the connection, so no lock is needed
+        self.frames_in = 0
+        self.bytes_in = 0
+
+    def compress_frame(self, frame):
+        """Compress an encoded frame for the wire. Must be called in send order."""
+        compressor = self.compressor
+        if compressor is None:
+            return frame
+        payload = memoryview(frame)[HEADER_SIZE:]
+        compressed = compressor.compress(payload)
+        return frame if compressed is payload else encode_frame(compressed)
+
+    def decompress_payload(self, payload):
+        """Restore a compressed payload received from the peer. Must be called in receive order."""
+        if self.decompressor is None:
+            self.decompressor = StreamDecompressor(self.communication.max_frame_size)
+        return self.decompressor.decompress(payload)
+        
+    def peer_certificate(self):
+        """Return the DER-encoded certificate the peer presented, or None."""
+        return self.tls_object.getpeercert(binary_form=True)
+        
+    def request_certificate(self):
+        """Ask a peer that dialled us to authenticate with its certificate."""
+        self.tls_object.verify_client_post_handshake()
+
+class PeerConnection(ConnectionState):
+    """A connected peer socket whose outbound frames are written by a dedicated thread.
+
+    Senders only queue frames, so a slow or stalled peer never delays the caller or
+    delivery to other peers.
+    """
+    def __init__(self, communication, sock, address, outgoing=False):
+        super().__init__(communication, address, outgoing)
+        self.sock = sock
+        self.tls_object = getattr(sock, "tls_object", None)  # Set for a TLSSocket
+        self.writer_thread = threading.Thread(target=self._write_loop)
+        self.writer_thread.daemon = True
+
+    def start(self):
+        """Start the writer thread."""
+        self.writer_thread.start()
+
+    def _write_loop(self):
+        """Drain the outbound queue into the socket until the connection closes.
+
+        Frames queued within the flush window of each other go out in one vectored
+        write, so a burst costs one syscall and, with Nagle disabled, as few packets
+        as its size allows.
+        """
+        while True:
+            batch = self.outbound.take(linger=self.communication.flush_window)
+            if batch is None:
+                break
+            try:
+                frames = [self.compress_frame(data) for data in batch]
+                self._send_frames(frames)
+                nbytes = sum(len(data) for data in frames)
+                self.outbound.record_sent(len(frames), nbytes)
+                delay = self.communication._outbound_delay(self, len(frames), nbytes)
+                if delay:
+                    time.sleep(delay)
+            except OSError as e:
+                # Once the connection is being closed, failed writes are expected
+                if not self.outbound.closed:
+                    logger.warning("Error sending to %s: %s", self.address, e)
+                break
+        self.close()
+        
+    def _send_frames(self, frames):
+        """Write every frame, with as few syscalls as the platform allows."""
+        metrics = self.communication.metrics
+        # TLS encrypts a single buffer at a time anyway
+        if not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b"".join(frames))
+            metrics.increment("socket_writes")
+            return
+        buffers = [memoryview(data) for data in frames]
+        first = 0
+        while first < len(buffers):
+            sent = self.sock.sendmsg(buffers[first:first + MAX_IOVECS])
+            metrics.increment("socket_writes")
+            # Skip what was written completely and resume inside a partly written frame
+            while first < len(buffers) and sent >= len(buffers[first]):
+                sent -= len(buffers[first])
+                first += 1
+            if sent:
+                buffers[first] = buffers[first][sent:]
+
+    def peer_certificate(self):
+        # The writer thread may be using the TLS object at the same time
+        return self.sock.getpeercert(binary_form=True)
+        
+    def request_certificate(self):
+        self.sock.verify_client_post_handshake()
+        
+    def close(self):
+        """Shut the socket down; the reader thread then cleans up the connection."""
+        self.outbound.close()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
 class NetworkCommunication:
-    def __init__(self, port=5000, message_callback=None, connection_callback=None):
+    def __init__(self, port=5000, message_callback=None, connection_callback=None,
+                 max_frame_size=MAX_FRAME_SIZE, send_queue_size=1000,
+                 send_policy=SEND_POLICY_DISCONNECT, send_block_timeout=DEFAULT_SEND_BLOCK_TIMEOUT,
+                 download_dir=DEFAULT_DOWNLOAD_DIR, file_callback=None, compression=True,
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 compression_level=DEFAULT_COMPRESSION_LEVEL, metrics=None, node_id=None,
+                 connect_timeout=10, reconnect=True, relay_host=False, multicast=False,
+                 multicast_group=MULTICAST_GROUP, multicast_port=MULTICAST_PORT,
+                 flush_window=DEFAULT_FLUSH_WINDOW, send_buffer_size=None, receive_buffer_size=None,
+                 keepalive_idle=DEFAULT_KEEPALIVE_IDLE, inbound_rate=DEFAULT_INBOUND_RATE,
+                 inbound_burst=DEFAULT_INBOUND_BURST, inbound_byte_rate=DEFAULT_INBOUND_BYTE_RATE, tls=None):
+        if send_policy not in SEND_POLICIES:
+            raise ValueError(f"Unknown send policy: {send_policy}")
+        if tls and multicast:
+            raise ValueError("Multicast datagrams are neither encrypted nor authenticated, so they cannot be used with TLS")
         self.port = port
+        self.max_frame_size = max_frame_size
+        self.send_queue_size = send_queue_size
+        self.send_policy = send_policy
+        self.send_block_timeout = send_block_timeout
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+        self.connect_timeout = connect_timeout
+        self.flush_window = flush_window  # 0 writes every batch as soon as it is queued
+        self.send_buffer_size = send_buffer_size  # SO_SNDBUF, or None for the OS default
+        self.receive_buffer_size = receive_buffer_size  # SO_RCVBUF, or None for the OS default
+        self.keepalive_idle = keepalive_idle  # None turns TCP keepalive off
+        # Frames and bytes per second each peer may send us; None for no limit
+        self.inbound_rate = inbound_rate
+        self.inbound_burst = inbound_burst
+        self.inbound_byte_rate = inbound_byte_rate
+        self.tls = tls  # The TLSIdentity every connection is encrypted with, or None for plaintext
+        self.pinned_certificates = {}  # {(ip, port): certificate fingerprint the peer advertised}
+        self.pinned_ids = {}  # {peer id: certificate fingerprint}, to check peers that dial us
+        self.tls_peer_ids = {}  # {(ip, port): peer id}, to offer the peer's saved TLS session
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.add_collector(self._collect_metrics)
+        self._encode_sequence = itertools.count()  # Picks the encodes whose time is sampled
         self.server_socket = None
-        self.connections = {}  # {address: socket}
+        self.connections = {}  # {address: PeerConnection}
+        self.node_id = node_id or uuid.uuid4().hex  # Identifies this node in the handshake
+        self.peer_ids = {}  # {peer node id: the one connection kept for that peer}
+        self.sessions = OrderedDict()  # {peer node id: PeerSession}, least recently connected first
+        self.lock = threading.Lock()
         self.server_thread = None
         self.running = False
         self.message_callback = message_callback
         self.connection_callback = connection_callback
-        
+        self.relay_host = relay_host  # Forward room broadcasts between the peers connected to us
+        self.relay = None  # Listen address of the relay our room broadcasts go through, if any
+        self.multicast = MulticastChannel(
+            self.node_id, port, self._deliver_multicast, self._request_multicast_repair,
+            multicast_group, multicast_port, self.metrics
+        ) if multicast else None
+        self.file_transfers = FileTransferManager(self, download_dir, file_callback)
+
+        # Retries connections that failed or dropped; attempts run on its own small pool
+        self.reconnect = reconnect
+        self.reconnects = ReconnectScheduler(self.connect_to_peer, metrics=self.metrics)
+
     def start_server(self):
         """Start the server to listen for incoming connections."""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -23,139 +358,824 @@ class NetworkCommunication:
         self.server_thread = threading.Thread(target=self._accept_connections)
         self.server_thread.daemon = True
         self.server_thread.start()
-        print(f"Server started on port {self.port}")
-        
+        self.reconnects.start()
+        if self.multicast:
+            self.multicast.start()
+        logger.info("Server started on port %d", self.port)
+
     def _accept_connections(self):
         """Accept incoming connections."""
         while self.running:
             try:
                 client_socket, address = self.server_socket.accept()
-                print(f"Connection from {address}")
-                
-                # Start a thread to handle this client
+                logger.info("Connection from %s", address)
+                self._configure_socket(client_socket)
+
+                # Start a thread to handle this client, after the TLS handshake if any
                 client_thread = threading.Thread(
-                    target=self._handle_client,
+                    target=self._serve_client,
                     args=(client_socket, address)
                 )
                 client_thread.daemon = True
                 client_thread.start()
-                
-                # Store the connection
-                self.connections[address] = client_socket
-                
-                # Notify about new connection
-                if self.connection_callback:
-                    self.connection_callback(address, True)
-                    
+
             except Exception as e:
                 if self.running:  # Only print error if we're supposed to be running
-                    print(f"Error accepting connection: {e}")
+                    logger.error("Error accepting connection: %s", e)
                     
-    def _handle_client(self, client_socket, address):
+    def _serve_client(self, client_socket, address):
+        """Set up an accepted connection and handle it until it closes."""
+        if self.tls:
+            try:
+                client_socket.settimeout(self.connect_timeout)
+                client_socket = self._wrap_tls(client_socket, server_side=True)
+                client_socket.settimeout(None)
+            except Exception as e:
+                logger.warning("TLS handshake with %s failed: %s", address, e)
+                self.metrics.increment("tls_handshake_failures")
+                client_socket.close()
+                return
+                
+        # Store the connection and notify about it
+        conn = PeerConnection(self, client_socket, address)
+        self._register_connection(address, conn)
+        if conn.tls_object is not None:
+            self._check_tls(conn)
+        conn.start()
+        self._handle_client(conn, address)
+
+    def _handle_client(self, conn, address):
         """Handle communication with a connected client."""
+        decoder = FrameDecoder(max_frame_size=self.max_frame_size)
         try:
             while self.running:
-                # Receive data
-                data = client_socket.recv(4096)
-                if not data:
+                # Receive data straight into the decoder's buffer
+                if not decoder.recv_from(conn.sock):
                     break
+
+                # Process every complete frame received so far
+                frames_in, bytes_in = conn.frames_in, conn.bytes_in
+                for payload in decoder.frames():
+                    self._process_frame(conn, payload)
                     
-                # Process the received message
-                try:
-                    message = json.loads(data.decode('utf-8'))
-                    print(f"Received from {address}: {message}")
-                    
-                    # Call the message callback
-                    if self.message_callback:
-                        self.message_callback(address, message)
-                except json.JSONDecodeError:
-                    print(f"Received invalid JSON from {address}")
-                    
+                # A peer over its limits waits in its own socket buffer, then its send queue
+                delay = self._inbound_delay(conn, conn.frames_in - frames_in, conn.bytes_in - bytes_in)
+                if delay:
+                    time.sleep(delay)
+
+        except FrameTooLargeError as e:
+            logger.warning("Dropping connection to %s: %s", address, e)
         except Exception as e:
-            print(f"Error handling client {address}: {e}")
+            logger.warning("Error handling client %s: %s", address, e)
         finally:
-            # Clean up
-            client_socket.close()
-            if address in self.connections:
-                del self.connections[address]
+            # Clean up and notify about disconnection
+            conn.close()
+            conn.sock.close()
+            self._unregister_connection(address, conn)
+            
+    def _configure_socket(self, sock):
+        """Apply the latency, buffer and keepalive options to a peer connection's socket."""
+        # Writes are already coalesced, so Nagle would only add delay
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.send_buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+        if self.receive_buffer_size:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+        if self.keepalive_idle is None:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # The timings are only tunable on some platforms; elsewhere the OS defaults apply
+        for option, value in (("TCP_KEEPIDLE", self.keepalive_idle), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                              ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+                
+    def _wrap_tls(self, sock, server_side=False, server_hostname=None):
+        """Complete the TLS handshake on a connected socket, within its timeout."""
+        context = self.tls.server_context if server_side else self.tls.client_context
+        tls_socket = TLSSocket(sock, context, server_side, server_hostname)
+        try:
+            tls_socket.do_handshake()
+        except Exception:
+            sock.close()
+            raise
+        return tls_socket
+        
+    def _tls_server_name(self, ip, port):
+        """The server name to dial ip:port with, naming the peer whose TLS session to resume."""
+        return self.tls.server_name(self.tls_peer_ids.get((ip, port)))
+        
+    def _check_tls(self, conn):
+        """Count a connection's TLS handshake and check the certificate of a peer we dialled.
+
+        Returns False if the certificate is not the one the peer advertised.
+        """
+        tls_object = conn.tls_object
+        self.metrics.increment("tls_resumed_handshakes" if tls_object.session_reused else "tls_full_handshakes")
+        if not conn.outgoing:
+            return True  # Peers connecting to us have no certificate to check
+        pinned = self.pinned_certificates.get(conn.address)
+        if pinned is None:
+            logger.info("No certificate pinned for %s:%d; the connection is encrypted but the peer is unverified",
+                        *conn.address)
+            return True
+        if certificate_fingerprint(tls_object.getpeercert(binary_form=True)) == pinned:
+            conn.verified = True
+            return True
+        logger.warning("Certificate of %s:%d does not match the one it advertised, closing the connection",
+                       *conn.address)
+        self.metrics.increment("tls_pin_mismatches")
+        return False
+        
+    def _verify_peer(self, conn, hello):
+        """Check that a TLS peer holds the certificate pinned for the id in its hello.
+
+        A peer we dialled showed its certificate in the handshake. A peer that dialled
+        us sends its certificate in the hello and is then asked to authenticate with it;
+        the hello waits until it has, see _on_verified(). Returns False if the hello has
+        to wait or the connection was closed.
+        """
+        peer_id = hello["id"]  # Checked by _check_hello()
+        pinned = self.pinned_ids.get(peer_id)
+        if pinned is None:
+            return True  # Nothing to check the peer against; encrypted, but unverified
+        if conn.outgoing:
+            if certificate_fingerprint(conn.peer_certificate()) == pinned:
+                conn.verified = True
+                return True
+        else:
+            try:
+                certificate = base64.b64decode(hello.get("certificate", ""), validate=True)
+            except (TypeError, ValueError):
+                certificate = b""
+            if certificate_fingerprint(certificate) == pinned:
+                # Only pinned certificates are trusted, so no other would be accepted
+                self.tls.trust(certificate)
+                conn.verifying = hello
+                conn.request_certificate()
+                self._queue_frame(conn, encode_frame(JSON_CODEC.encode({"type": "verify"})))
+                return False
+        self._reject_peer(conn, peer_id)
+        return False
+        
+    def _on_verified(self, conn):
+        """Finish the handshake with a peer that dialled us, once it has authenticated."""
+        hello, conn.verifying = conn.verifying, None
+        certificate = conn.peer_certificate()
+        if certificate is None or certificate_fingerprint(certificate) != self.pinned_ids.get(hello.get("id")):
+            self._reject_peer(conn, hello.get("id"))
+            return
+        conn.verified = True
+        self.metrics.increment("tls_clients_verified")
+        self._on_hello(conn, hello)
+        deferred, conn.deferred = conn.deferred, []
+        for message in deferred:
+            self._dispatch_message(conn, message)
             
-            # Notify about disconnection
-            if self.connection_callback:
-                self.connection_callback(address, False)
+    def _reject_peer(self, conn, peer_id):
+        logger.warning("%s did not authenticate with the certificate pinned for peer %s, closing the connection",
+                       conn.address, peer_id)
+        self.metrics.increment("tls_pin_mismatches")
+        conn.rejected = True
+        conn.close()
+        
+    def peer_fingerprint(self, address):
+        """Return the fingerprint of the certificate the peer at address presented, or None."""
+        conn = self.connections.get(address)
+        if conn is None or conn.tls_object is None:
+            return None
+        certificate = conn.peer_certificate()
+        return certificate_fingerprint(certificate) if certificate else None
+        
+    def pin_peer(self, ip, port, peer_id, fingerprint=None):
+        """Record the identity a discovered peer advertised.
+
+        TLS connections to ip:port, and from the peer with peer_id, are then only kept
+        if the peer's certificate matches fingerprint. Connections to ip:port resume the
+        last TLS session with that peer.
+        """
+        if peer_id:
+            self.tls_peer_ids[(ip, port)] = peer_id
+        if fingerprint:
+            self.pinned_certificates[(ip, port)] = fingerprint
+            if peer_id:
+                self.pinned_ids[peer_id] = fingerprint
+        else:
+            self.pinned_certificates.pop((ip, port), None)
+            self.pinned_ids.pop(peer_id, None)
                 
+    def _create_inbound_limiter(self, address=None):
+        """Create the limiter for a new connection's inbound frames, or None if unlimited.
+
+        The relay we elected forwards the whole room's messages to us, far more than any
+        one peer sends, so our connection to it is left unlimited. The relay still limits
+        what each of its clients sends it.
+        """
+        if not self.inbound_rate and not self.inbound_byte_rate:
+            return None
+        if address is not None and address == self.relay:
+            return None
+        return FlowLimiter(self.inbound_rate, self.inbound_burst, self.inbound_byte_rate)
+        
+    def _inbound_delay(self, conn, frames, nbytes):
+        """Charge frames received from a peer; returns how long to stop reading from it."""
+        if conn.inbound_limiter is None or not frames:
+            return 0
+        delay = conn.inbound_limiter.charge(frames, nbytes)
+        if delay:
+            if not conn.throttled:
+                # Once per connection, as a flooding peer would flood the log as well
+                logger.warning("%s is sending faster than its limits, slowing it down", conn.address)
+                conn.throttled = True
+            self.metrics.increment("inbound_throttled")
+            self.metrics.observe("inbound_throttle_seconds", int(delay * 1e9))
+        return delay
+        
+    def _outbound_delay(self, conn, frames, nbytes):
+        """Charge frames written to a peer; returns how long to wait to stay within its limits."""
+        if conn.outbound_limiter is None:
+            return 0
+        delay = conn.outbound_limiter.charge(frames, nbytes)
+        if delay:
+            self.metrics.increment("outbound_paced")
+        return delay
+
+    def _create_outbound_queue(self):
+        """Create the outbound frame queue for a new connection."""
+        return OutboundQueue(self.send_queue_size, self.send_policy, self.send_block_timeout, self.metrics)
+
+    def _register_connection(self, address, conn):
+        """Store a new connection and start the handshake.
+
+        The connection callback only fires once the handshake has shown which peer is on
+        the other end, see _announce(). Returns False, without storing it, if another
+        connection to the same address was registered first.
+        """
+        with self.lock:
+            if address in self.connections:
+                return False
+            self.connections[address] = conn
+        self.metrics.increment("connections_opened")
+        self._send_hello(conn)
+        return True
+
+    def _unregister_connection(self, address, conn):
+        """Forget a closed connection and notify about it, once per connection."""
+        with self.lock:
+            if self.connections.get(address) is not conn:
+                return
+            del self.connections[address]
+            if conn.peer_id is not None and self.peer_ids.get(conn.peer_id) is conn:
+                del self.peer_ids[conn.peer_id]
+        self.metrics.increment("connections_closed")
+        self.metrics.increment("frames_in", conn.frames_in)
+        self.metrics.increment("bytes_in", conn.bytes_in)
+        if conn.announced and self.connection_callback:
+            self.connection_callback(address, False)
+        if conn.announced and self.running:
+            self._schedule_reconnect(conn)
+
+    def _schedule_reconnect(self, conn):
+        """Try to win back a dropped peer, unless another connection to it is still open."""
+        # Peers that predate the handshake never told us their port, but we dialled it
+        port = conn.peer_port or (conn.address[1] if conn.outgoing else None)
+        if not self.reconnect or not port or conn.peer_id in self.peer_ids:
+            return
+        ip = conn.address[0]
+        if self.find_peer(ip, port):
+            return
+        logger.info("Lost connection to peer at %s:%d, reconnecting", ip, port)
+        # A short jittered pause spreads out peers that dropped together
+        self.reconnects.schedule((ip, port), ip, port, delay=self.reconnects.backoff(0),
+                                 max_attempts=RECONNECT_ATTEMPTS)
+
+    def _is_preferred(self, conn):
+        """Whether conn was opened by the peer with the smaller node id.
+
+        Both ends compute the same answer, so when two peers connect to each other at
+        the same time they agree on which of the two connections to keep.
+        """
+        initiator = self.node_id if conn.outgoing else conn.peer_id
+        return initiator == min(self.node_id, conn.peer_id)
+
+    def _announce(self, conn):
+        """Report a connection to the application, keeping one connection per peer."""
+        duplicate = None
+        with self.lock:
+            if self.connections.get(conn.address) is not conn:
+                return  # Already closed
+            if conn.peer_id is not None:
+                existing = self.peer_ids.get(conn.peer_id)
+                if existing is not None and existing is not conn:
+                    if conn.verified != existing.verified:
+                        # An unverified connection never takes the place of a verified one
+                        duplicate = existing if conn.verified else conn
+                    elif self._is_preferred(conn) and not self._is_preferred(existing):
+                        duplicate = existing
+                    else:
+                        duplicate = conn
+                if duplicate is not conn:
+                    self.peer_ids[conn.peer_id] = conn
+            if duplicate is not conn:
+                conn.announced = True
+
+        if duplicate is not None:
+            logger.info("Closing duplicate connection to peer %s at %s", conn.peer_id, duplicate.address)
+            self.metrics.increment("duplicate_connections_closed")
+            duplicate.close()
+        if conn.announced and self.connection_callback:
+            self.connection_callback(conn.address, True)
+
+    def find_peer(self, ip, port):
+        """Return the address of an open connection to the peer listening at ip:port, or None."""
+        for address, conn in list(self.connections.items()):
+            if address == (ip, port) or (address[0] == ip and conn.peer_port == port):
+                return address
+        return None
+
+    def _send_hello(self, conn):
+        """Announce what this side supports. Always JSON, so any peer can read it."""
+        hello = {
+            "type": "hello",
+            "id": self.node_id,
+            "port": self.port,
+            "codecs": ADVERTISED_CODECS,
+            "compression": list(COMPRESSIONS) if self.compression else [],
+            "resume": True,
+        }
+        if conn.inbound_limiter is not None:
+            # Credit the peer may use; a sender that keeps to it is never slowed down by us
+            hello["flow"] = [self.inbound_rate or None, self.inbound_burst, self.inbound_byte_rate or None]
+        if self.multicast:
+            # Where our multicast stream stands, so the peer can ask for anything it misses
+            hello["multicast"] = [self.multicast.group, self.multicast.multicast_port, self.multicast.last_seq]
+        if self.tls:
+            # The certificate we authenticate with when the peer asks, see _verify_peer()
+            hello["certificate"] = base64.b64encode(self.tls.certificate).decode("ascii")
+        self._queue_frame(conn, encode_frame(JSON_CODEC.encode(hello)))
+
+    def _check_hello(self, conn, hello):
+        """Whether a hello names the peer and its port as expected; closes the connection if not."""
+        peer_id, port = hello.get("id"), hello.get("port")
+        if (isinstance(peer_id, str) and peer_id
+                and isinstance(port, int) and not isinstance(port, bool) and 1 <= port <= 65535
+                and isinstance(hello.get("codecs", []), list)
+                and isinstance(hello.get("compression", []), list)):
+            return True
+        logger.warning("Invalid hello from %s, closing the connection", conn.address)
+        self.metrics.increment("invalid_hellos")
+        conn.rejected = True
+        conn.close()
+        return False
+        
+    def _on_hello(self, conn, hello):
+        """Settle the connection's options from the peer's hello."""
+        conn.codec = negotiate_codec(hello.get("codecs", []))
+        compression = negotiate_compression(hello.get("compression", [])) if self.compression else None
+        if compression is not None:
+            conn.compressor = StreamCompressor(self.compression_level, self.compression_threshold)
+        conn.peer_id = hello.get("id")
+        conn.peer_port = hello.get("port")
+        if isinstance(hello.get("multicast"), list):
+            conn.multicast = tuple(hello["multicast"][:2])
+            last_seq = hello["multicast"][2:3]
+            if self.multicast and conn.peer_id and last_seq and isinstance(last_seq[0], int):
+                try:
+                    self.multicast.expect(uuid.UUID(conn.peer_id), last_seq[0] + 1)
+                except ValueError:
+                    pass
+        conn.outbound_limiter = FlowLimiter.from_advertisement(hello.get("flow"))
+        if conn.tls_object is not None and conn.outgoing and conn.peer_id:
+            # Offered when we next dial this peer, which then skips the full handshake
+            self.tls_peer_ids[conn.address] = conn.peer_id
+            self.tls.save_session(conn.peer_id, conn.tls_object.session)
+        conn.handshake_done = True
+        logger.info("Handshake with %s complete, using %s codec and %s compression",
+                    conn.address, conn.codec.name, compression or "no")
+
+        if conn.peer_id == self.node_id:
+            logger.info("Closing connection to ourselves at %s", conn.address)
+            conn.close()
+            return
+        if hello.get("resume") and conn.peer_id is not None:
+            conn.session = self._session(conn.peer_id)
+        self._announce(conn)
+        if conn.session is not None and self.peer_ids.get(conn.peer_id) is conn:
+            # Tell the peer where to pick up; it replays whatever we have not received
+            resume = {"type": "resume", "received": conn.session.received}
+            self._queue_frame(conn, encode_frame(JSON_CODEC.encode(resume)))
+            
+    def _session(self, peer_id):
+        """Return the session with a peer, starting one for a peer we have not met."""
+        with self.lock:
+            session = self.sessions.get(peer_id)
+            if session is None:
+                session = self.sessions[peer_id] = PeerSession(peer_id)
+                if len(self.sessions) > MAX_SESSIONS:
+                    self.sessions.popitem(last=False)
+            else:
+                self.sessions.move_to_end(peer_id)
+            return session
+            
+    def _on_resume(self, conn, message):
+        """Replay the messages the peer has not received, then let new ones flow."""
+        session = conn.session
+        received = message.get("received")
+        if session is None or not isinstance(received, int):
+            return
+        if self.peer_ids.get(conn.peer_id) is not conn:
+            return  # A duplicate connection, about to be closed
+        with session.send_lock:
+            with session.lock:
+                session.acknowledge(received)
+                replay = session.unacked_after(received)
+            for seq, missed in replay:
+                self._queue_frame(conn, self._sequenced_frame(session, seq, self._encode_for(conn, missed)))
+            conn.resumed = True
+        if replay:
+            logger.info("Replayed %d messages to %s", len(replay), conn.address)
+            self.metrics.increment("messages_replayed", len(replay))
+            
+    def _on_sequenced(self, conn, payload):
+        """Check a sequenced payload against the peer's session.
+
+        Returns the encoded message it carries, or None when it is a duplicate.
+        """
+        session = conn.session
+        if session is None or len(payload) < SEQUENCE_HEADER.size:
+            logger.warning("Received unexpected sequenced message from %s", conn.address)
+            return None
+        _, seq, ack = SEQUENCE_HEADER.unpack_from(payload)
+        with session.lock:
+            session.acknowledge(ack)
+            lost = session.accept(seq)
+            ack_due = lost is not None and session.ack_due()
+            if ack_due:
+                session.acked_sent = session.received
+                ack = session.received
+        if lost is None:
+            # Already received before a reconnect made the peer replay it
+            self.metrics.increment("duplicates_dropped")
+            return None
+        if lost:
+            logger.warning("%d messages from %s were lost", lost, conn.address)
+            self.metrics.increment("messages_lost", lost)
+        if ack_due:
+            self._queue_frame(conn, encode_frame(JSON_CODEC.encode({"type": "ack", "ack": ack})))
+        return payload[SEQUENCE_HEADER.size:]
+        
+    def _on_ack(self, conn, message):
+        if conn.session is not None and isinstance(message.get("ack"), int):
+            with conn.session.lock:
+                conn.session.acknowledge(message["ack"])
+
+    def _process_frame(self, conn, payload):
+        """Decode a single frame payload and hand it to the message callback."""
+        address = conn.address
+        if conn.rejected:
+            return  # Whatever else the peer sent is not trusted either
+        conn.frames_in += 1
+        conn.bytes_in += HEADER_SIZE + len(payload)
+        timed = not conn.frames_in % TIMING_SAMPLE_INTERVAL
+        start = time.perf_counter_ns() if timed else 0
+        try:
+            if payload and payload[0] == COMPRESSED_MAGIC:
+                payload = conn.decompress_payload(payload)
+            if payload and payload[0] == SEQUENCED_MAGIC:
+                payload = self._on_sequenced(conn, payload)
+                if payload is None:
+                    return
+            message = decode_payload(payload)
+        except CompressionError as e:
+            # The rest of the stream depends on this payload, so it cannot be skipped
+            logger.warning("Dropping connection to %s: %s", address, e)
+            conn.close()
+            return
+        except CodecError as e:
+            logger.warning("Received invalid message from %s: %s", address, e)
+            return
+        if not isinstance(message, dict):
+            logger.warning("Received invalid message from %s", address)
+            return
+
+        if timed:
+            self.metrics.observe("decode_seconds", time.perf_counter_ns() - start)
+        logger.debug("Received from %s: %s", address, message)
+
+        if message.get("type") == "hello":
+            if not self._check_hello(conn, message):
+                return
+            if conn.tls_object is None or self._verify_peer(conn, message):
+                self._on_hello(conn, message)
+            return
+        if conn.verifying is not None:
+            # Nothing the peer says counts until it has proven who it is
+            if message.get("type") == "verified":
+                self._on_verified(conn)
+            else:
+                conn.deferred.append(message)
+            return
+        if message.get("type") == "verify":
+            # TLS answered the certificate request in front of this, so the reply follows our certificate
+            self._queue_frame(conn, encode_frame(JSON_CODEC.encode({"type": "verified"})))
+            return
+        self._dispatch_message(conn, message, timed)
+        
+    def _dispatch_message(self, conn, message, timed=False):
+        """Handle a decoded message, passing anything but protocol traffic to the message callback."""
+        address = conn.address
+        if not conn.handshake_done:
+            # Peers that predate the handshake never send a hello
+            conn.handshake_done = True
+            self._announce(conn)
+
+        if message.get("type") == "resume":
+            self._on_resume(conn, message)
+            return
+        if message.get("type") == "ack":
+            self._on_ack(conn, message)
+            return
+        if message.get("type") == "relay":
+            self._on_relay(conn, message)
+            return
+        if message.get("type") == "multicast_nack":
+            self._on_multicast_nack(conn, message)
+            return
+        if message.get("type") == "multicast_repair":
+            self._on_multicast_repair(conn, message)
+            return
+
+        # File transfer control messages are handled here rather than by the application
+        if str(message.get("type", "")).startswith("file_"):
+            self.file_transfers.handle_message(address, message)
+            return
+
+        # Call the message callback
+        if self.message_callback:
+            start = time.perf_counter_ns() if timed else 0
+            self.message_callback(address, message)
+            if timed:
+                self.metrics.observe("message_callback_seconds", time.perf_counter_ns() - start)
+
+    def _on_relay(self, conn, envelope):
+        """Fan a room broadcast sent to us as the relay out to every other peer."""
+        message = envelope.get("message")
+        # Only chat messages are relayed; anything else could be mistaken for protocol traffic
+        if not isinstance(message, dict) or message.get("type") != "message":
+            logger.warning("Received invalid relay request from %s", conn.address)
+            return
+        # Receivers only see the relay's address, so say who the message is from
+        message = dict(message, origin=conn.peer_id,
+                       origin_address=[conn.address[0], conn.peer_port or conn.address[1]])
+        if self.relay_host:
+            self.metrics.increment("relayed_messages")
+            self._broadcast(message, exclude=conn)
+        else:
+            logger.warning("%s relays through us, but we are not a relay", conn.address)
+        # Whoever runs the relay is in the room too
+        if self.message_callback:
+            self.message_callback(conn.address, message)
+            
+    def _multicast_peer(self, sender):
+        """Return the connection to the node whose id is the UUID sender, or None."""
+        return self.peer_ids.get(str(sender)) or self.peer_ids.get(sender.hex)
+        
+    def _deliver_multicast(self, sender, address, message):
+        # Name the peer by its connection when we have one, as for messages sent over TCP
+        conn = self._multicast_peer(sender)
+        if self.message_callback:
+            self.message_callback(conn.address if conn else address, message)
+            
+    def _request_multicast_repair(self, sender, seqs):
+        conn = self._multicast_peer(sender)
+        return conn is not None and self.send_message(conn.address, {"type": "multicast_nack", "seqs": seqs})
+        
+    def _on_multicast_nack(self, conn, message):
+        """Resend room broadcasts that a peer missed over its TCP connection."""
+        if not self.multicast:
+            return
+        seqs = [seq for seq in message.get("seqs", []) if isinstance(seq, int)]
+        for seq, missed in self.multicast.repair(seqs):
+            self.send_message(conn.address, {"type": "multicast_repair", "seq": seq, "message": missed})
+            
+    def _on_multicast_repair(self, conn, message):
+        """Accept a room broadcast that came over TCP, in its place in the sender's order."""
+        if (not self.multicast or conn.peer_id is None or not isinstance(message.get("seq"), int)
+                or not isinstance(message.get("message"), dict)):
+            return
+        try:
+            sender = uuid.UUID(conn.peer_id)
+        except ValueError:
+            return
+        self.multicast.on_repair(sender, message.get("seq"), (conn.address[0], conn.peer_port),
+                                 message["message"])
+
     def connect_to_peer(self, ip, port):
         """Connect to a peer on the network."""
+        if not self.running:
+            return False
+        if self.find_peer(ip, port):
+            logger.debug("Already connected to peer at %s:%d", ip, port)
+            return True
+        self.metrics.increment("connect_attempts")
         try:
             # Create a socket and connect
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_socket.connect((ip, port))
+            peer_socket = socket.create_connection((ip, port), timeout=self.connect_timeout)
+            self._configure_socket(peer_socket)
+            if self.tls:
+                peer_socket = self._wrap_tls(peer_socket, server_hostname=self._tls_server_name(ip, port))
+            peer_socket.settimeout(None)
             address = (ip, port)
-            
-            # Store the connection
-            self.connections[address] = peer_socket
-            
-            # Start a thread to handle this connection
+            conn = PeerConnection(self, peer_socket, address, outgoing=True)
+            if conn.tls_object is not None and not self._check_tls(conn):
+                peer_socket.close()
+                self.metrics.increment("connect_failures")
+                return False
+
+            # Start threads to handle this connection
             client_thread = threading.Thread(
                 target=self._handle_client,
-                args=(peer_socket, address)
+                args=(conn, address)
             )
             client_thread.daemon = True
+
+            # Store the connection; a simultaneous attempt may have got there first
+            if not self._register_connection(address, conn):
+                peer_socket.close()
+                return True
             client_thread.start()
-            
-            # Notify about new connection
-            if self.connection_callback:
-                self.connection_callback(address, True)
-                
-            print(f"Connected to peer at {ip}:{port}")
+            conn.start()
+
+            logger.info("Connected to peer at %s:%d", ip, port)
             return True
-            
+
         except Exception as e:
-            print(f"Error connecting to peer at {ip}:{port}: {e}")
+            logger.warning("Error connecting to peer at %s:%d: %s", ip, port, e)
+            self.metrics.increment("connect_failures")
             return False
-            
+
+    def connect_to_peer_async(self, ip, port, delay=0, callback=None):
+        """Connect to a peer in the background, calling callback(success) when done."""
+        def attempt():
+            success = self.connect_to_peer(ip, port)
+            if callback:
+                callback(success)
+
+        timer = threading.Timer(delay, attempt)
+        timer.daemon = True
+        timer.start()
+
     def send_message(self, address, message):
-        """Send a message to a specific peer."""
-        if address in self.connections:
-            try:
-                # Convert message to JSON and send
-                data = json.dumps(message).encode('utf-8')
-                self.connections[address].sendall(data)
-                return True
-            except Exception as e:
-                print(f"Error sending message to {address}: {e}")
-                # Remove the broken connection
-                self.connections[address].close()
-                del self.connections[address]
-                if self.connection_callback:
-                    self.connection_callback(address, False)
-                return False
-        else:
-            print(f"No connection to {address}")
+        """Queue a message for a specific peer. Returns False if it could not be queued."""
+        conn = self.connections.get(address)
+        if conn is None:
+            logger.warning("No connection to %s", address)
             return False
-            
+
+        return self._queue_message(conn, message)
+
     def broadcast_message(self, message):
-        """Send a message to all connected peers."""
-        disconnected = []
-        for address, conn in list(self.connections.items()):
-            try:
-                data = json.dumps(message).encode('utf-8')
-                conn.sendall(data)
-            except Exception as e:
-                print(f"Error broadcasting to {address}: {e}")
-                disconnected.append(address)
+        """Queue a message for the whole room.
+
+        When every connected peer receives the multicast group, the message is sent as
+        a single datagram. Otherwise, with a relay connected, it is sent to the relay
+        once and the relay fans it out. Failing both it is queued for every connected peer.
+        """
+        relay = self.find_peer(*self.relay) if self.relay and not self.relay_host else None
+        if relay is None and self._multicast_reaches_everyone():
+            seq, sent = self.multicast.send(message)
+            if not sent:
+                # Too large for a datagram; sent in sequence over TCP instead
+                self._broadcast({"type": "multicast_repair", "seq": seq, "message": message})
+            return
+        if relay is not None and self.send_message(relay, {"type": "relay", "message": message}):
+            return
+        self._broadcast(message)
+        
+    def _multicast_reaches_everyone(self):
+        if not self.multicast:
+            return False
+        group = (self.multicast.group, self.multicast.multicast_port)
+        connections = list(self.connections.values())
+        return bool(connections) and all(conn.multicast == group for conn in connections)
+
+    def _broadcast(self, message, exclude=None):
+        """Queue a message for every connected peer but exclude, encoding it once per codec in use."""
+        frames = {}
+        for conn in list(self.connections.values()):
+            if conn is not exclude:
+                self._queue_message(conn, message, frames)
                 
-        # Clean up disconnected peers
-        for address in disconnected:
-            if address in self.connections:
-                self.connections[address].close()
-                del self.connections[address]
-                if self.connection_callback:
-                    self.connection_callback(address, False)
-                    
+    def _queue_message(self, conn, message, cache=None):
+        """Encode a message with the connection's codec and queue it as a single frame.
+
+        With a peer that keeps a session the message is numbered and kept until
+        acknowledged. It is only written to the connection kept for the peer, once that
+        has resumed; until then it waits to be replayed.
+        """
+        session = conn.session
+        if session is None:
+            return self._queue_frame(conn, self._encode_for(conn, message, cache))
+        # Sends to the peer are queued one at a time, so they are queued in sequence order.
+        # Waiting for room happens first: a sender must not hold send_lock while the
+        # thread that would make room needs it to relay or replay.
+        target = self.peer_ids.get(conn.peer_id)
+        if target is not None:
+            self._wait_for_room(target)
+        with session.send_lock:
+            with session.lock:
+                seq, evicted = session.add(message)
+            if evicted:
+                self.metrics.increment("retransmit_evicted", evicted)
+            target = self.peer_ids.get(conn.peer_id)
+            if target is None or not target.resumed:
+                return True
+            data = self._encode_for(target, message, cache)
+            return self._queue_frame(target, self._sequenced_frame(session, seq, data), can_block=False)
+            
+    def _sequenced_frame(self, session, seq, data):
+        """Turn an encoded frame into the sequenced frame numbered seq, acking what we have received."""
+        with session.lock:
+            header = SEQUENCE_HEADER.pack(SEQUENCED_MAGIC, seq, session.received)
+            session.acked_sent = session.received
+        return encode_frame(header + data[HEADER_SIZE:])
+
+    def _encode_for(self, conn, message, cache=None):
+        """Encode a message into a frame for a connection, reusing cached encodings."""
+        data = cache.get(conn.codec.name) if cache is not None else None
+        if data is None:
+            timed = not next(self._encode_sequence) % TIMING_SAMPLE_INTERVAL
+            start = time.perf_counter_ns() if timed else 0
+            data = encode_frame(conn.codec.encode(message))
+            if timed:
+                self.metrics.observe("encode_seconds", time.perf_counter_ns() - start)
+            if cache is not None:
+                cache[conn.codec.name] = data
+        return data
+
+    def send_file(self, address, path):
+        """Offer a file to a peer; it is streamed over its own connection once accepted."""
+        if address not in self.connections:
+            logger.warning("No connection to %s", address)
+            return None
+        return self.file_transfers.send_file(address, path)
+        
+    def _wait_for_room(self, conn):
+        """Under the block policy, wait until conn's queue has room."""
+        if self.send_policy == SEND_POLICY_BLOCK:
+            conn.outbound.wait_for_room(self.send_block_timeout)
+
+    def _queue_frame(self, conn, data, can_block=True):
+        """Put an encoded frame on a peer's outbound queue, applying the send policy."""
+        result = conn.outbound.put(data, can_block)
+        if result == OutboundQueue.OVERFLOW:
+            logger.warning("Send queue to %s is full, disconnecting", conn.address)
+            conn.close()
+        elif result == OutboundQueue.DROPPED:
+            logger.warning("Send queue to %s is full, dropping message", conn.address)
+        return result == OutboundQueue.QUEUED
+
+    def get_queue_stats(self):
+        """Return outbound queue statistics for every connected peer."""
+        return {address: conn.outbound.stats() for address, conn in list(self.connections.items())}
+
+    def _collect_metrics(self):
+        """Counters kept by the open connections themselves."""
+        connections = list(self.connections.values())
+        return {
+            "frames_in": sum(conn.frames_in for conn in connections),
+            "bytes_in": sum(conn.bytes_in for conn in connections),
+            "retransmit_buffered": sum(len(session.unacked) for session in list(self.sessions.values())),
+        }
+
+    def get_stats(self):
+        """Return the metrics and per-peer queue and compression statistics as plain data."""
+        compression = self.get_compression_stats()
+        return {
+            "metrics": self.metrics.snapshot(),
+            "peers": {
+                f"{address[0]}:{address[1]}": {"queue": queue, "compression": compression.get(address)}
+                for address, queue in self.get_queue_stats().items()
+            },
+        }
+
+    def get_compression_stats(self):
+        """Return bytes saved and CPU time spent on compression for every connected peer."""
+        return {
+            address: {
+                "sent": conn.compressor.stats() if conn.compressor else None,
+                "received": conn.decompressor.stats() if conn.decompressor else None,
+            }
+            for address, conn in list(self.connections.items())
+        }
+
     def stop(self):
         """Stop the server and close all connections."""
         self.running = False
-        
+        self.reconnects.stop()
+        if self.multicast:
+            self.multicast.stop()
+
         # Close all client connections
         for address, conn in list(self.connections.items()):
             try:
@@ -163,12 +1183,17 @@ class NetworkCommunication:
             except:
                 pass
         self.connections.clear()
-        
-        # Close server socket
+
+        # Close server socket; shutting it down first wakes accept(), which close() alone
+        # does not, so the port stops accepting connections nobody will serve
         if self.server_socket:
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             try:
                 self.server_socket.close()
             except:
                 pass
-            
-        print("Network communication stopped")
+
+        logger.info("Network communication stopped")
@@ -1,20 +1,55 @@
+import asyncio
+import ipaddress
+import logging
 import socket
-import threading
-from zeroconf import ServiceInfo, Zeroconf, ServiceBrowser
 import time
 import uuid
+from zeroconf import IPVersion, ServiceInfo, ServiceStateChange, current_time_millis
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo, AsyncZeroconf
+from metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# How long to wait for a service's records before giving up on it
+RESOLVE_TIMEOUT_MS = 3000
+
+# Changes arriving within this many seconds are reported to listeners together
+DEBOUNCE_DELAY = 0.2
+
+# Value of the "role" service property advertised by nodes that relay room broadcasts
+ROLE_RELAY = "relay"
 
 class NetworkDiscovery:
-    def __init__(self, service_name="_lnchat._tcp.local.", port=5000):
-        self.zeroconf = Zeroconf()
+    """Finds LNChat peers with mDNS and announces this one.
+
+    Everything runs on zeroconf's own event loop: browser events only schedule a
+    resolution, which is answered from zeroconf's record cache when possible and by a
+    query otherwise, so a busy network never stalls the loop. Resolved services are
+    cached by the peer id they advertise until their records' TTL runs out, when they
+    are resolved again. Changes are debounced, so a burst of add, update and remove
+    events for a peer reaches the listeners as at most one net change. Listeners are
+    called on the zeroconf loop and must not block.
+    """
+    def __init__(self, service_name="_lnchat._tcp.local.", port=5000, metrics=None, properties=None):
+        self.aiozc = AsyncZeroconf()
+        self.zeroconf = self.aiozc.zeroconf
+        self.loop = self.zeroconf.loop
+        self.metrics = metrics if metrics is not None else Metrics()
         self.service_name = service_name
         self.port = port
-        self.discovered_services = {}
+        self.properties = properties or {}  # Advertised alongside our id, e.g. {"role": ROLE_RELAY}
+        self.discovered_services = {}  # {peer id: {"name", "address", "addresses", "role", "fingerprint", "expires"}}
+        self.service_ids = {}  # {service name: peer id}
         self.listeners = []
         self.local_ip = self._get_local_ip()
         self.unique_id = str(uuid.uuid4())
         self.browser = None
         self.info = None
+        self.register_future = None
+        self._generations = {}  # {service name: count of removals}, to discard stale resolutions
+        self._reported = {}  # {peer id: address the listeners were last told about}
+        self._flush_handle = None
+        self._expiry_handles = {}  # {peer id: timer re-resolving the service when its records expire}
         
     def _get_local_ip(self):
         """Get the local IP address of this machine."""
@@ -29,17 +64,27 @@ class NetworkDiscovery:
             s.close()
         return IP
         
-    def register_service(self):
-        """Register this service on the network."""
+    async def _register(self):
         self.info = ServiceInfo(
             self.service_name,
             f"LNChat-{self.unique_id}.{self.service_name}",
             addresses=[socket.inet_aton(self.local_ip)],
             port=self.port,
-            properties={'id': self.unique_id}
+            properties={**self.properties, 'id': self.unique_id}
         )
-        self.zeroconf.register_service(self.info)
-        print(f"Service registered: {self.local_ip}:{self.port}")
+        start = time.perf_counter_ns()
+        # Registering returns a task that finishes once probing and announcing are done
+        await (await self.aiozc.async_register_service(self.info))
+        self.metrics.observe("discovery_register_seconds", time.perf_counter_ns() - start)
+        logger.info("Service registered: %s:%d", self.local_ip, self.port)
+        
+    def register_service(self):
+        """Register this service on the network, blocking until it has been announced."""
+        asyncio.run_coroutine_threadsafe(self._register(), self.loop).result()
+        
+    def register_service_async(self):
+        """Register this service in the background, as mDNS probing takes most of a second."""
+        self.register_future = asyncio.run_coroutine_threadsafe(self._register(), self.loop)
         
     def add_listener(self, callback):
         """Add a listener for service discovery events."""
@@ -55,49 +100,153 @@ class NetworkDiscovery:
         for listener in self.listeners:
             listener(service_info, added)
             
-    class ServiceListener:
-        """Listener for zeroconf service events."""
-        def __init__(self, discovery):
-            self.discovery = discovery
+    def _select_address(self, addresses):
+        """Pick the address most likely to reach a peer advertising several.
+
+        Prefers our own subnet and avoids link-local addresses. Only IPv4 addresses are
+        offered, as that is all the servers listen on.
+        """
+        local = ipaddress.ip_address(self.local_ip)
+        
+        def rank(address):
+            ip = ipaddress.ip_address(address)
+            return (ip.is_link_local, ip.packed[:3] != local.packed[:3])
+        
+        return min(addresses, key=rank) if addresses else None
+        
+    def _on_service_state_change(self, zeroconf, service_type, name, state_change):
+        """Browser callback, on the zeroconf loop; resolution happens in a task."""
+        if state_change is ServiceStateChange.Removed:
+            self._generations[name] = self._generations.get(name, 0) + 1
+            self._forget(self.service_ids.pop(name, None))
+        else:
+            asyncio.ensure_future(self._resolve(service_type, name))
+            
+    async def _resolve(self, service_type, name):
+        generation = self._generations.get(name, 0)
+        info = AsyncServiceInfo(service_type, name)
+        # Answered straight from the cache when every record is there
+        resolved = await info.async_request(self.zeroconf, RESOLVE_TIMEOUT_MS)
+        if self._generations.get(name, 0) != generation:
+            return  # Removed while we were waiting
+        if not resolved:
+            logger.debug("Could not resolve %s", name)
+            self._forget(self.service_ids.pop(name, None))
+            return
             
-        def add_service(self, zc, type_, name):
-            info = zc.get_service_info(type_, name)
-            if info:
-                service_id = info.properties.get(b'id', b'').decode('utf-8')
-                # Don't add our own service
-                if service_id != self.discovery.unique_id:
-                    ip = socket.inet_ntoa(info.addresses[0])
-                    port = info.port
-                    self.discovery.discovered_services[name] = (ip, port)
-                    print(f"Service added: {name} at {ip}:{port}")
-                    self.discovery.notify_listeners((ip, port), added=True)
-                    
-        def remove_service(self, zc, type_, name):
-            if name in self.discovery.discovered_services:
-                ip, port = self.discovery.discovered_services[name]
-                del self.discovery.discovered_services[name]
-                print(f"Service removed: {name}")
-                self.discovery.notify_listeners((ip, port), added=False)
-                
-        def update_service(self, zc, type_, name):
-            self.add_service(zc, type_, name)
+        service_id = info.properties.get(b'id', b'').decode('utf-8')
+        # Don't add our own service
+        if not service_id or service_id == self.unique_id:
+            return
+        # A peer reachable only over IPv6 cannot be dialled, as no server listens there
+        addresses = info.parsed_scoped_addresses(IPVersion.V4Only)
+        address = self._select_address(addresses)
+        if address is None:
+            return
+            
+        record = self.zeroconf.cache.get(info.dns_service())
+        ttl = record.get_remaining_ttl(current_time_millis()) if record else 120
+        previous_id = self.service_ids.get(name)
+        if previous_id is not None and previous_id != service_id:
+            self._forget(previous_id)  # The peer restarted under the same name
+        self.service_ids[name] = service_id
+        self.discovered_services[service_id] = {
+            "name": name,
+            "address": (address, info.port),
+            "addresses": addresses,
+            "role": info.properties.get(b'role', b'').decode('utf-8'),
+            "fingerprint": info.properties.get(b'tls', b'').decode('utf-8') or None,
+            "expires": time.monotonic() + ttl,
+        }
+        self._schedule_expiry(service_id, service_type, name, ttl)
+        self._schedule_flush()
+        
+    def _forget(self, service_id):
+        if service_id is None or self.discovered_services.pop(service_id, None) is None:
+            return
+        handle = self._expiry_handles.pop(service_id, None)
+        if handle:
+            handle.cancel()
+        self._schedule_flush()
+        
+    def _schedule_expiry(self, service_id, service_type, name, ttl):
+        """Resolve the service again when its records expire, dropping it if that fails."""
+        handle = self._expiry_handles.pop(service_id, None)
+        if handle:
+            handle.cancel()
+        self._expiry_handles[service_id] = self.loop.call_later(
+            max(ttl, 1), lambda: asyncio.ensure_future(self._resolve(service_type, name)))
+            
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = self.loop.call_later(DEBOUNCE_DELAY, self._flush)
+            
+    def _flush(self):
+        """Tell the listeners about the net changes since the last flush."""
+        self._flush_handle = None
+        current = {service_id: entry["address"] for service_id, entry in self.discovered_services.items()}
+        for service_id, address in list(self._reported.items()):
+            if current.get(service_id) != address:
+                del self._reported[service_id]
+                logger.info("Service removed: %s:%d", *address)
+                self.metrics.increment("discovery_removed")
+                self.notify_listeners(address, added=False)
+        for service_id, address in current.items():
+            if service_id not in self._reported:
+                self._reported[service_id] = address
+                logger.info("Service added: %s at %s:%d", service_id, *address)
+                self.metrics.increment("discovery_added")
+                self.notify_listeners(address, added=True)
             
     def start_discovery(self):
         """Start discovering services on the network."""
-        self.browser = ServiceBrowser(
-            self.zeroconf, 
-            self.service_name, 
-            self.ServiceListener(self)
-        )
+        def start():
+            self.browser = AsyncServiceBrowser(
+                self.zeroconf,
+                self.service_name,
+                handlers=[self._on_service_state_change]
+            )
+        self.loop.call_soon_threadsafe(start)
         
     def get_discovered_services(self):
-        """Get all discovered services."""
-        return list(self.discovered_services.values())
+        """Get all discovered services whose records have not expired."""
+        now = time.monotonic()
+        return [entry["address"] for entry in list(self.discovered_services.values()) if entry["expires"] > now]
         
-    def stop(self):
-        """Stop service discovery and unregister service."""
+    def get_peer(self, address):
+        """Get the (peer id, certificate fingerprint or None) advertised at address, or None."""
+        for service_id, entry in list(self.discovered_services.items()):
+            if entry["address"] == address:
+                return service_id, entry["fingerprint"]
+        return None
+        
+    def get_relays(self):
+        """Get the (peer id, address) of every discovered relay, in the order clients elect them."""
+        now = time.monotonic()
+        return sorted((service_id, entry["address"]) for service_id, entry in list(self.discovered_services.items())
+                      if entry["role"] == ROLE_RELAY and entry["expires"] > now)
+                      
+    async def _stop(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+        for handle in self._expiry_handles.values():
+            handle.cancel()
         if self.browser:
-            self.browser.cancel()
+            await self.browser.async_cancel()
+        if self.register_future:
+            try:
+                await asyncio.wrap_future(self.register_future)
+            except Exception as e:
+                logger.warning("Service registration failed: %s", e)
+                return
         if self.info:
-            self.zeroconf.unregister_service(self.info)
+            # Unregistering returns a task that finishes once the goodbye has been sent
+            await (await self.aiozc.async_unregister_service(self.info))
+        
+    def stop(self):
+        """Stop service discovery and unregister service."""
+        try:
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result(timeout=5)
+        except Exception as e:
+            logger.warning("Error stopping discovery: %s", e)
         self.zeroconf.close()
@@ -0,0 +1,157 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class ReconnectScheduler:
+    """Retries connections to peers with exponential backoff and jitter.
+
+    Pending attempts live in a single timer heap, at most one per peer, and a fixed
+    pool of worker threads takes them off the heap as they fall due. The pool size caps
+    the number of concurrent attempts, so a flapping network costs a bounded number of
+    threads and SYNs no matter how many peers drop at once. Each failure doubles the
+    peer's delay up to max_delay, randomized by jitter so peers that dropped together
+    do not retry together. When any attempt succeeds the network is evidently back,
+    so every other backed-off attempt is brought forward.
+    """
+    def __init__(self, connect, max_concurrent=4, base_delay=0.5, max_delay=60, jitter=0.5,
+                 max_attempts=None, metrics=None):
+        self.connect = connect  # connect(ip, port) -> bool, may block
+        self.max_concurrent = max_concurrent
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+        self.metrics = metrics
+        self.pending = {}  # {key: entry}
+        self._heap = []  # (due, sequence, key); entries whose due time changed are skipped
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self.running = False
+        
+    def start(self):
+        """Accept attempts; workers are started as attempts are scheduled."""
+        self.running = True
+        
+    def _add_workers(self):
+        # Nodes that never lose a peer never pay for the pool
+        while len(self._workers) < min(self.max_concurrent, len(self.pending)):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+            
+    def backoff(self, attempt):
+        """Delay before retrying after attempt failures, with jitter applied."""
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * random.uniform(1 - self.jitter, 1)
+        
+    def _push(self, entry, due):
+        entry["due"] = due
+        heapq.heappush(self._heap, (due, next(self._sequence), entry["key"]))
+        self._cond.notify()
+        
+    def schedule(self, key, ip, port, delay=0, max_attempts=None):
+        """Arrange an attempt to connect to the peer at ip:port, unless one is already pending.
+
+        key identifies the peer; attempts for the same key are never made twice at once.
+        max_attempts overrides the scheduler's limit for this peer.
+        """
+        with self._cond:
+            if not self.running:
+                return
+            if key in self.pending:
+                # The latest reason to connect decides how long to keep trying
+                self.pending[key]["max_attempts"] = max_attempts or self.max_attempts
+                return
+            entry = {"key": key, "ip": ip, "port": port, "attempt": 0, "due": None, "in_flight": False,
+                     "max_attempts": max_attempts or self.max_attempts}
+            self.pending[key] = entry
+            self._push(entry, time.monotonic() + delay)
+            self._add_workers()
+            
+    def cancel(self, key):
+        """Stop retrying a peer, e.g. because it left the network."""
+        with self._cond:
+            self.pending.pop(key, None)
+            
+    def _next_due(self):
+        """Pop the next attempt that is due, waiting for it. Returns None when stopped."""
+        with self._cond:
+            while self.running:
+                now = time.monotonic()
+                if self._heap:
+                    due, _, key = self._heap[0]
+                    entry = self.pending.get(key)
+                    if entry is None or entry["due"] != due or entry["in_flight"]:
+                        heapq.heappop(self._heap)  # Cancelled or rescheduled
+                        continue
+                    if due <= now:
+                        heapq.heappop(self._heap)
+                        entry["in_flight"] = True
+                        return entry
+                    self._cond.wait(due - now)
+                else:
+                    self._cond.wait()
+            return None
+            
+    def _work(self):
+        while True:
+            entry = self._next_due()
+            if entry is None:
+                return
+            self._attempt(entry)
+            
+    def _attempt(self, entry):
+        if self.metrics:
+            self.metrics.increment("reconnect_attempts")
+        try:
+            success = self.connect(entry["ip"], entry["port"])
+        except Exception as e:
+            logger.warning("Error reconnecting to %s:%d: %s", entry["ip"], entry["port"], e)
+            success = False
+            
+        with self._cond:
+            entry["in_flight"] = False
+            if self.pending.get(entry["key"]) is not entry:
+                return  # Cancelled meanwhile
+            if success:
+                del self.pending[entry["key"]]
+                self._expedite()
+            else:
+                entry["attempt"] += 1
+                if entry["max_attempts"] is not None and entry["attempt"] >= entry["max_attempts"]:
+                    del self.pending[entry["key"]]
+                    logger.info("Giving up on %s:%d after %d attempts",
+                                entry["ip"], entry["port"], entry["attempt"])
+                else:
+                    self._push(entry, time.monotonic() + self.backoff(entry["attempt"]))
+                    
+        if self.metrics:
+            self.metrics.increment("reconnects" if success else "reconnect_failures")
+        if not success:
+            logger.debug("Connecting to %s:%d failed, attempt %d", entry["ip"], entry["port"], entry["attempt"])
+            
+    def _expedite(self):
+        """Bring backed-off attempts forward to a short, jittered delay."""
+        soon = time.monotonic() + self.backoff(0)
+        for entry in self.pending.values():
+            if not entry["in_flight"] and entry["due"] > soon:
+                entry["attempt"] = 0
+                self._push(entry, soon + random.uniform(0, self.base_delay))
+                
+    def stop(self):
+        """Drop every pending attempt and stop the workers."""
+        with self._cond:
+            self.running = False
+            self.pending.clear()
+            self._heap.clear()
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join(timeout=1)
+        self._workers = []
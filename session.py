@@ -0,0 +1,80 @@
+import struct
+import threading
+from collections import OrderedDict
+
+# A sequenced payload starts with this byte, the message's sequence number and the
+# sender's cumulative ack, followed by the encoded message itself
+SEQUENCED_MAGIC = 0xA1
+SEQUENCE_HEADER = struct.Struct("!BQQ")
+
+# Messages kept per peer until it acknowledges them; older ones are given up. Below
+# the default send queue size, so a full replay fits in the queue.
+RETRANSMIT_BUFFER_SIZE = 512
+
+# A receiver with nothing to piggyback its ack on sends one after this many messages
+ACK_INTERVAL = 32
+
+# Peers whose sessions are kept, for the ones that come back after a reconnect
+MAX_SESSIONS = 256
+
+class PeerSession:
+    """Sequence numbers and unacknowledged messages exchanged with one peer.
+
+    Outlives the peer's connections, so messages a dead connection may not have
+    delivered can be replayed on the next one. Sequence numbers start at 1; received
+    is the highest one delivered from the peer and doubles as the ack we send. All
+    state is guarded by lock. Senders also hold send_lock while queueing, to keep
+    frames in sequence order; acknowledgements only take lock, so they are never held
+    up by a sender.
+    """
+    def __init__(self, peer_id, buffer_size=RETRANSMIT_BUFFER_SIZE):
+        self.peer_id = peer_id
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.next_seq = 1
+        self.unacked = OrderedDict()  # {seq: message} sent but not acknowledged yet
+        self.received = 0
+        self.acked_sent = 0  # The last ack we sent, piggybacked or on its own
+        
+    def add(self, message):
+        """Number a message and keep it until acknowledged.
+
+        Returns its sequence number and how many older messages were given up to make room.
+        """
+        seq = self.next_seq
+        self.next_seq += 1
+        self.unacked[seq] = message
+        evicted = 0
+        while len(self.unacked) > self.buffer_size:
+            self.unacked.popitem(last=False)
+            evicted += 1
+        return seq, evicted
+        
+    def acknowledge(self, ack):
+        """Forget every message the peer has acknowledged."""
+        while self.unacked:
+            seq = next(iter(self.unacked))
+            if seq > ack:
+                break
+            del self.unacked[seq]
+            
+    def unacked_after(self, seq):
+        """Return the (seq, message) pairs still kept that come after seq, in order."""
+        return [(kept, message) for kept, message in self.unacked.items() if kept > seq]
+        
+    def accept(self, seq):
+        """Record a message received from the peer.
+
+        Returns None for a duplicate, otherwise how many messages before it were lost
+        because the peer had already given them up.
+        """
+        if seq <= self.received:
+            return None
+        lost = seq - self.received - 1
+        self.received = seq
+        return lost
+        
+    def ack_due(self):
+        """Whether enough messages arrived since our last ack to send one on its own."""
+        return self.received - self.acked_sent >= ACK_INTERVAL
@@ -0,0 +1,105 @@
+import random
+from chat_ui import MessageRing, PeerList
+
+def record(timestamp, message_id):
+    return ((timestamp, message_id), "sender", f"message {message_id}")
+    
+def keys(records):
+    return [key for key, _, _ in records]
+    
+def test_ring_pages_around_a_key():
+    ring = MessageRing(capacity=10)
+    for n in range(6):
+        ring.add(record(n, n))
+    assert len(ring) == 6
+    assert (ring.oldest_key, ring.newest_key) == ((0, 0), (5, 5))
+    assert keys(ring.newest(2)) == [(4, 4), (5, 5)]
+    assert keys(ring.before((3, 3), 2)) == [(1, 1), (2, 2)]
+    assert keys(ring.after((3, 3), 5)) == [(4, 4), (5, 5)]
+    # Keys between records work too
+    assert keys(ring.after((2.5, 0), 1)) == [(3, 3)]
+    assert ring.before((0, 0), 5) == []
+    
+def test_full_ring_overwrites_oldest():
+    ring = MessageRing(capacity=3)
+    for n in range(5):
+        assert ring.add(record(n, n))
+    assert keys(ring.newest(10)) == [(2, 2), (3, 3), (4, 4)]
+    # Older than everything kept, so there is no room for it
+    assert not ring.add(record(1, 9))
+    assert len(ring) == 3
+    
+def test_ring_inserts_out_of_order_records_in_place():
+    ring = MessageRing(capacity=50)
+    records = [record(random.random(), n) for n in range(200)]
+    for item in records:
+        ring.add(item)
+    assert keys(ring.newest(50)) == sorted(keys(records))[-50:]
+    
+def test_empty_ring():
+    ring = MessageRing()
+    assert ring.oldest_key is None and ring.newest_key is None
+    assert ring.newest(5) == []
+
+def apply(listbox, change):
+    """Change a list the way a list box is changed for PeerList.update()."""
+    deleted, appended = change
+    for row in deleted:
+        del listbox[row]
+    listbox.extend(appended)
+    
+def check(peers, listbox):
+    assert peers.rows == [address for address, label in peers.labels.items() if peers.filter in label.lower()]
+    assert listbox == [peers.labels[address] for address in peers.rows]
+    for row, address in enumerate(peers.rows):
+        assert peers.row_of[address] == row
+        assert peers.address_at(row) == address
+    assert len(peers.row_of) == len(peers.rows)
+    
+def test_peers_in_connection_order():
+    peers, listbox = PeerList(), []
+    apply(listbox, peers.update({("10.0.0.1", 1): "alice", ("10.0.0.2", 1): "bob"}))
+    apply(listbox, peers.update({("10.0.0.3", 1): "carol"}))
+    assert listbox == ["alice", "bob", "carol"]
+    assert len(peers) == 3
+    check(peers, listbox)
+    
+def test_leaving_and_renamed_peers():
+    peers, listbox = PeerList(), []
+    apply(listbox, peers.update({("10.0.0.1", 1): "alice", ("10.0.0.2", 1): "bob", ("10.0.0.3", 1): "carol"}))
+    deleted, appended = peers.update({("10.0.0.1", 1): None, ("10.0.0.2", 1): "bobby"})
+    assert (deleted, appended) == ([1, 0], ["bobby"])
+    apply(listbox, (deleted, appended))
+    assert listbox == ["carol", "bobby"]
+    check(peers, listbox)
+    assert peers.update({("10.0.0.2", 1): "bobby", ("10.0.0.9", 1): None}) == ([], [])
+    
+def test_address_at_out_of_range():
+    peers = PeerList()
+    peers.update({("10.0.0.1", 1): "alice"})
+    assert peers.address_at(1) is None
+    assert peers.address_at(-1) is None
+    
+def test_filter_hides_peers_but_keeps_them():
+    peers, listbox = PeerList(), []
+    apply(listbox, peers.update({("10.0.0.1", 1): "Alice", ("10.0.0.2", 1): "bob", ("10.0.0.3", 1): "alina"}))
+    listbox = peers.set_filter(" AL ")
+    assert listbox == ["Alice", "alina"]
+    apply(listbox, peers.update({("10.0.0.4", 1): "albert", ("10.0.0.5", 1): "dave", ("10.0.0.1", 1): None}))
+    assert listbox == ["alina", "albert"]
+    assert len(peers) == 4
+    check(peers, listbox)
+    
+    assert peers.set_filter("") == ["bob", "alina", "albert", "dave"]
+    
+def test_random_changes_keep_rows_and_list_box_in_step():
+    rng = random.Random(7)
+    peers, listbox = PeerList(), []
+    addresses = [(f"10.0.0.{i}", 5000) for i in range(40)]
+    for step in range(300):
+        if step % 50 == 0:
+            listbox = peers.set_filter(rng.choice(["", "1", "peer-2"]))
+        changes = {address: rng.choice([None, f"peer-{rng.randrange(30)}"])
+                   for address in rng.sample(addresses, rng.randrange(1, 6))}
+        apply(listbox, peers.update(changes))
+        check(peers, listbox)
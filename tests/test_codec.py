@@ -0,0 +1,50 @@
+import pytest
+import codec
+from codec import BINARY_CODEC, JSON_CODEC, CodecError, decode_payload, negotiate_codec
+
+MESSAGES = [
+    {"type": "message", "content": "hello"},
+    {"type": "message", "content": "héllo ☃\n"},
+    {"type": "message", "content": "to all", "room": True, "uid": "abc", "sent_at": 1700000000.25},
+    {"type": "hello", "id": "node", "port": 5000, "codecs": ["binary", "json"], "resume": [3, 7]},
+    {"type": "sync_ranges", "ranges": [[0, 2 ** 40, 2 ** 63 - 1, 12], [-5, 0, 0, 0]]},
+    {"type": "nested", "value": {"list": [None, True, False, 1.5, "", []], "map": {}}},
+]
+
+@pytest.mark.parametrize("message", MESSAGES)
+@pytest.mark.parametrize("codec", [BINARY_CODEC, JSON_CODEC], ids=lambda codec: codec.name)
+def test_round_trip(codec, message):
+    payload = codec.encode(message)
+    assert codec.decode(payload) == message
+    # Payloads say which codec made them
+    assert decode_payload(payload) == message
+    
+def test_chat_message_skips_body_encoding():
+    payload = BINARY_CODEC.encode({"type": "message", "content": "hi"})
+    assert payload[2:] == b"hi"
+    
+@pytest.mark.parametrize("payload", [
+    b"\xb1",
+    b"\xb1\x09body",
+    b"\xb1\x01\xff\xfe",
+    b"",
+    b"\xb1\x00\x81\x91\x01\x01",  # Map keyed by an array
+    b"\xb1\x00" + b"\x91" * 100000 + b"\xc0",  # Nested deeper than the stack allows
+    b"[" * 100000 + b"]" * 100000,
+    b"\xff\xfe",
+])
+def test_invalid_payload(payload):
+    with pytest.raises(CodecError):
+        decode_payload(payload)
+        
+def test_negotiate_codec(monkeypatch):
+    monkeypatch.setattr(codec, "ADVERTISED_CODECS", ["binary", "json"])
+    assert negotiate_codec(["json", "binary"]) is BINARY_CODEC
+    assert negotiate_codec(["json"]) is JSON_CODEC
+    assert negotiate_codec([]) is JSON_CODEC
+    
+def test_binary_needs_msgpack_to_be_offered(monkeypatch):
+    monkeypatch.setattr(codec, "ADVERTISED_CODECS", ["json"])
+    # Peers offering binary still get JSON; binary payloads they send are still understood
+    assert negotiate_codec(["binary", "json"]) is JSON_CODEC
+    assert decode_payload(BINARY_CODEC.encode({"type": "x"})) == {"type": "x"}
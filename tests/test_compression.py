@@ -0,0 +1,60 @@
+import json
+import os
+import pytest
+from compression import (COMPRESSED_MAGIC, CompressionError, StreamCompressor, StreamDecompressor,
+                         negotiate_compression)
+                         
+def message(i):
+    return json.dumps({"type": "message", "content": f"hello number {i} " * 30}).encode("utf-8")
+    
+def test_round_trip_keeps_payloads_in_order():
+    compressor, decompressor = StreamCompressor(), StreamDecompressor(1 << 20)
+    payloads = [message(i) for i in range(20)] + [os.urandom(5000)]
+    for payload in payloads:
+        data = compressor.compress(payload)
+        assert data[0] == COMPRESSED_MAGIC
+        assert decompressor.decompress(data) == payload
+    assert decompressor.stats()["frames"] == len(payloads)
+    
+def test_window_carries_over_between_payloads():
+    compressor = StreamCompressor()
+    first = compressor.compress(message(1))
+    second = compressor.compress(message(1))
+    assert len(second) < len(first) / 2
+    
+def test_small_payload_is_sent_unchanged():
+    compressor = StreamCompressor(threshold=256)
+    payload = b'{"type": "ping"}'
+    assert compressor.compress(payload) is payload
+    stats = compressor.stats()
+    assert (stats["skipped_frames"], stats["compressed_frames"]) == (1, 0)
+    
+def test_stats_count_bytes_saved():
+    compressor, decompressor = StreamCompressor(), StreamDecompressor(1 << 20)
+    payload = message(0)
+    decompressor.decompress(compressor.compress(payload))
+    assert compressor.stats()["bytes_in"] == decompressor.stats()["bytes_out"] == len(payload)
+    assert compressor.stats()["bytes_saved"] == decompressor.stats()["bytes_saved"] > 0
+    
+def test_corrupt_payload_is_rejected():
+    with pytest.raises(CompressionError):
+        StreamDecompressor(1 << 20).decompress(bytes([COMPRESSED_MAGIC, 0xFF, 0xFF, 0xFF, 0xFF]))
+        
+def test_out_of_order_payload_is_rejected():
+    compressor, decompressor = StreamCompressor(), StreamDecompressor(1 << 20)
+    compressor.compress(message(0))
+    with pytest.raises(CompressionError):
+        # Refers back to a window the decompressor never saw
+        decompressor.decompress(compressor.compress(message(0)))
+        
+def test_payload_over_limit_is_rejected():
+    data = StreamCompressor().compress(b"x" * 100000)
+    assert len(data) < 1000
+    with pytest.raises(CompressionError):
+        StreamDecompressor(99999).decompress(data)
+    assert StreamDecompressor(100000).decompress(data) == b"x" * 100000
+    
+def test_negotiation():
+    assert negotiate_compression(["lz4", "zlib"]) == "zlib"
+    assert negotiate_compression(["lz4"]) is None
+    assert negotiate_compression([]) is None
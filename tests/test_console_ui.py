@@ -0,0 +1,154 @@
+import io
+import os
+import socket
+import pytest
+from console_ui import ConsoleSession, ConsoleUI
+
+class Recorder:
+    """Records callback calls and answers with a fixed result."""
+    def __init__(self, result=True):
+        self.calls = []
+        self.result = result
+        
+    def __call__(self, *args, **kwargs):
+        self.calls.append(args + tuple(kwargs.values()))
+        return self.result
+        
+@pytest.fixture
+def ui():
+    ui = ConsoleUI(send_callback=Recorder((1.0, 1)), broadcast_callback=Recorder((1.0, 2)),
+                   connect_callback=Recorder(), send_file_callback=Recorder(),
+                   file_response_callback=Recorder(), output_stream=io.StringIO())
+    ui.add_peer(("10.0.0.1", 5000), "alice")
+    ui.add_peer(("10.0.0.2", 5000), "bob")
+    return ui
+    
+@pytest.fixture
+def session():
+    lines = []
+    session = ConsoleSession(lines.append)
+    session.lines = lines
+    return session
+    
+def test_peers_lists_numbered_peers(ui, session):
+    ui.handle_command(session, "/to 2")
+    ui.handle_command(session, "/peers")
+    assert session.lines[-2:] == ["1. alice (10.0.0.1:5000)", "2. bob (10.0.0.2:5000) *"]
+    
+def test_plain_line_needs_selected_peer(ui, session):
+    ui.handle_command(session, "hello")
+    assert session.lines == ["No peer selected; use /to N first"]
+    assert not ui.send_callback.calls
+    
+    ui.handle_command(session, "/to 1")
+    ui.handle_command(session, "  hello  ")
+    assert ui.send_callback.calls == [(("10.0.0.1", 5000), {"type": "message", "content": "hello"})]
+    
+def test_msg_sends_to_numbered_peer(ui, session):
+    ui.handle_command(session, "/msg 2 hi there")
+    assert ui.send_callback.calls == [(("10.0.0.2", 5000), {"type": "message", "content": "hi there"})]
+    assert "You: hi there" in ui.output_stream.getvalue()
+    
+@pytest.mark.parametrize("index", ["0", "-1", "3", "x"])
+def test_unknown_peer_number(ui, session, index):
+    ui.handle_command(session, f"/msg {index} hi")
+    assert session.lines == [f"No peer {index}; use /peers to list them"]
+    assert not ui.send_callback.calls
+    
+def test_failed_send_is_reported(ui, session):
+    ui.send_callback.result = None
+    ui.handle_command(session, "/msg 1 hi")
+    assert session.lines == ["Could not send to alice"]
+    
+def test_all_broadcasts(ui, session):
+    ui.handle_command(session, "/all hello room")
+    assert ui.broadcast_callback.calls == [({"type": "message", "content": "hello room"},)]
+    ui.broadcast_callback.result = None
+    ui.handle_command(session, "/all anyone?")
+    assert session.lines == ["No connected peers"]
+    
+def test_connect_parses_address(ui, session):
+    ui.handle_command(session, "/connect 10.0.0.9 5001")
+    assert ui.connect_callback.calls == [("10.0.0.9", 5001)]
+    for line in ("/connect", "/connect 10.0.0.9", "/connect 10.0.0.9 port"):
+        ui.handle_command(session, line)
+    assert session.lines == ["Usage: /connect IP PORT"] * 3
+    
+def test_file_offer_accept_and_reject(ui, session):
+    ui.offer_file("t1", "alice", "a.txt", 10)
+    ui.offer_file("t2", "alice", "b.txt", 20)
+    assert "alice offers b.txt (20 bytes): /accept 2 or /reject 2" in ui.output_stream.getvalue()
+    ui.handle_command(session, "/accept 1")
+    ui.handle_command(session, "/reject 2")
+    assert ui.file_response_callback.calls == [("t1", True), ("t2", False)]
+    
+    ui.handle_command(session, "/accept 1")
+    ui.handle_command(session, "/accept x")
+    assert session.lines == ["No file offer 1", "No file offer x"]
+    
+def test_file_sends_path(ui, session):
+    ui.handle_command(session, "/file 1 /tmp/a file.txt")
+    assert ui.send_file_callback.calls == [(("10.0.0.1", 5000), "/tmp/a file.txt")]
+    
+def test_history_and_search(ui, session):
+    ui.history_loader = Recorder([((0, 1), "alice", "old")])
+    ui.search_callback = Recorder([((2, 3), "*", "bob", "newer"), ((1, 2), "*", "alice", "older")])
+    ui.handle_command(session, "/history 5")
+    ui.handle_command(session, "/search ol")
+    assert ui.history_loader.calls == [(5,)]
+    assert ui.search_callback.calls == [("ol", 20)]
+    assert [line.split("] ", 1)[1] for line in session.lines] == ["alice: old", "alice: older", "bob: newer"]
+    
+    ui.search_callback.result = []
+    ui.handle_command(session, "/search nothing")
+    assert session.lines[-1] == "No messages found"
+    
+def test_unknown_command(ui, session):
+    ui.handle_command(session, "/frobnicate now")
+    assert session.lines == ["Unknown command /frobnicate; /help lists the commands"]
+    ui.handle_command(session, "   ")
+    assert len(session.lines) == 1
+    
+def test_control_port_needs_token():
+    with pytest.raises(ValueError):
+        ConsoleUI(control_port=0)
+        
+@pytest.fixture
+def control_ui():
+    ui = ConsoleUI(control_port=0, control_token="s3cret", input_stream=io.StringIO(),
+                   output_stream=io.StringIO(), stats_callback=lambda: {"answer": 42})
+    ui._start_control_server()
+    yield ui
+    ui.stop()
+    
+def control_session(ui, data):
+    """Send data to the control port and return everything written back."""
+    with socket.create_connection(ui._control_socket.getsockname(), timeout=5) as sock:
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        received = b""
+        while chunk := sock.recv(4096):
+            received += chunk
+    return received.decode("utf-8")
+    
+def test_control_client_with_token(control_ui):
+    assert '"answer": 42' in control_session(control_ui, b"s3cret\n/stats\n")
+    
+def test_control_client_with_wrong_token(control_ui):
+    reply = control_session(control_ui, b"guess\n/stats\n")
+    assert reply == "Wrong control token\n"
+    
+def test_control_client_without_token(control_ui):
+    reply = control_session(control_ui, b"/stats\n")
+    assert reply == "Wrong control token\n"
+    
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix-domain sockets")
+def test_control_path_is_private(tmp_path):
+    path = str(tmp_path / "control.sock")
+    ui = ConsoleUI(control_path=path, input_stream=io.StringIO(), output_stream=io.StringIO())
+    ui._start_control_server()
+    try:
+        assert os.stat(path).st_mode & 0o777 == 0o600
+    finally:
+        ui.stop()
+    assert not os.path.exists(path)
@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+import pytest
+from file_transfer import FileTransferManager, _file_key
+
+class FakeCommunication:
+    """Delivers control messages straight to the other side's manager."""
+    def __init__(self, address):
+        self.address = address
+        self.peer = None
+        self.tls = None
+        self.running = True
+        self.connections = {}
+        
+    def send_message(self, address, message):
+        threading.Thread(target=self.peer.manager.handle_message, args=(self.address, message)).start()
+        return True
+        
+def linked_managers(tmp_path, **kwargs):
+    """Return a sender and a receiver manager wired to each other over loopback."""
+    sender_comm = FakeCommunication(("127.0.0.1", 5001))
+    receiver_comm = FakeCommunication(("127.0.0.1", 5002))
+    sender_comm.peer, receiver_comm.peer = receiver_comm, sender_comm
+    sender_comm.connections[receiver_comm.address] = receiver_comm.connections[sender_comm.address] = object()
+    
+    managers = []
+    for comm, folder in ((sender_comm, "unused"), (receiver_comm, "downloads")):
+        events = []
+        done = threading.Event()
+        
+        def callback(event, info, events=events, done=done):
+            events.append((event, info))
+            if event in ("complete", "failed"):
+                done.set()
+                
+        comm.manager = FileTransferManager(comm, str(tmp_path / folder), callback, chunk_size=4096,
+                                           timeout=5, **kwargs)
+        comm.manager.events, comm.manager.done = events, done
+        managers.append(comm.manager)
+    return managers
+    
+def wait_for_event(manager, name, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not any(kind == name for kind, _ in manager.events) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return any(kind == name for kind, _ in manager.events)
+    
+def kinds(manager):
+    return [kind for kind, _ in manager.events if kind != "progress"]
+    
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "report.bin"
+    path.write_bytes(os.urandom(4096 * 5 + 123))
+    return path
+    
+def test_offer_waits_for_user(tmp_path, source):
+    sender, receiver = linked_managers(tmp_path)
+    transfer_id = sender.send_file(("127.0.0.1", 5002), str(source))
+    assert wait_for_event(receiver, "offer")
+    assert list(receiver.pending) == [transfer_id]
+    assert not receiver.incoming
+    assert not os.path.exists(tmp_path / "downloads")
+    
+def test_accepted_offer_is_received(tmp_path, source):
+    sender, receiver = linked_managers(tmp_path)
+    transfer_id = sender.send_file(("127.0.0.1", 5002), str(source))
+    assert wait_for_event(receiver, "offer")
+    assert receiver.accept_offer(transfer_id)
+    assert sender.done.wait(5) and receiver.done.wait(5)
+    
+    assert kinds(sender) == ["offer", "accept", "complete"]
+    assert kinds(receiver) == ["offer", "accept", "complete"]
+    assert (tmp_path / "downloads" / "report.bin").read_bytes() == source.read_bytes()
+    assert os.listdir(tmp_path / "downloads") == ["report.bin"]
+    assert not receiver.accept_offer(transfer_id)
+    
+def test_rejected_offer_fails_on_sender(tmp_path, source):
+    sender, receiver = linked_managers(tmp_path)
+    transfer_id = sender.send_file(("127.0.0.1", 5002), str(source))
+    assert wait_for_event(receiver, "offer")
+    assert receiver.reject_offer(transfer_id, "no thanks")
+    assert sender.done.wait(5)
+    
+    kind, info = sender.events[-1]
+    assert (kind, info["error"]) == ("failed", "no thanks")
+    assert not sender.outgoing and not receiver.pending
+    
+def test_too_many_pending_offers_rejects_oldest(tmp_path, source):
+    sender, receiver = linked_managers(tmp_path, max_pending=1)
+    first = sender.send_file(("127.0.0.1", 5002), str(source))
+    assert wait_for_event(receiver, "offer")
+    second = sender.send_file(("127.0.0.1", 5002), str(source))
+    assert sender.done.wait(5)
+    
+    assert list(receiver.pending) == [second]
+    assert sender.events[-1][1]["transfer_id"] == first
+    
+def test_offer_name_cannot_escape_download_dir(tmp_path):
+    _, receiver = linked_managers(tmp_path)
+    receiver.handle_message(("127.0.0.1", 5001), {
+        "type": "file_offer", "transfer_id": "ab" * 16, "name": "../../etc/passwd", "size": 1
+    })
+    assert receiver.pending["ab" * 16]["name"] == "passwd"
+    
+def test_invalid_offer_is_ignored(tmp_path):
+    _, receiver = linked_managers(tmp_path)
+    for offer in ({"transfer_id": "../x", "size": 1}, {"transfer_id": "ab", "size": -1},
+                  {"transfer_id": "ab", "size": True}):
+        receiver.handle_message(("127.0.0.1", 5001), dict(offer, type="file_offer", name="a"))
+    assert not receiver.pending and not receiver.events
+    
+def test_transfer_resumes_from_saved_offset(tmp_path, source):
+    sender, receiver = linked_managers(tmp_path, auto_accept=True)
+    data = source.read_bytes()
+    resume_at = 4096 * 3
+    downloads = tmp_path / "downloads"
+    downloads.mkdir()
+    
+    # Leave behind what an interrupted attempt at the same file would have written
+    file_key = _file_key(str(source))
+    part_path = downloads / f"report.bin.{file_key[:16]}.part"
+    part_path.write_bytes(data[:resume_at])
+    part_path.with_name(part_path.name + ".json").write_text(
+        json.dumps({"file_key": file_key, "size": len(data), "offset": resume_at}))
+        
+    sender.send_file(("127.0.0.1", 5002), str(source))
+    assert sender.done.wait(5) and receiver.done.wait(5)
+    
+    accepted = [info for kind, info in sender.events if kind == "accept"]
+    assert [info["offset"] for info in accepted] == [resume_at]
+    progress = [info["offset"] for kind, info in receiver.events if kind == "progress"]
+    assert progress[0] == resume_at + 4096
+    assert (downloads / "report.bin").read_bytes() == data
+    assert os.listdir(downloads) == ["report.bin"]
+    
+def test_resume_state_of_other_file_is_ignored(tmp_path):
+    _, receiver = linked_managers(tmp_path)
+    state_path = tmp_path / "state.json"
+    state_path.write_text(json.dumps({"file_key": "other", "size": 10, "offset": 5}))
+    assert receiver._load_resume_offset(str(state_path), "mine", 10) == 0
+    assert receiver._load_resume_offset(str(state_path), "other", 10) == 5
+    assert receiver._load_resume_offset(str(state_path), "other", 11) == 0
+    
@@ -0,0 +1,60 @@
+import pytest
+import flow_control
+from flow_control import FlowLimiter, TokenBucket
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        
+    def __call__(self):
+        return self.now
+        
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(flow_control.time, "monotonic", clock)
+    return clock
+    
+def test_bucket_allows_burst_then_asks_to_wait(clock):
+    bucket = TokenBucket(rate=10, burst=5)
+    assert [bucket.charge(1) for _ in range(5)] == [0] * 5
+    assert bucket.charge(1) == pytest.approx(0.1)
+    assert bucket.charge(2) == pytest.approx(0.3)
+    
+def test_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(rate=10, burst=5)
+    bucket.charge(5)
+    clock.now += 0.2
+    assert bucket.charge(2) == 0
+    assert bucket.charge(1) == pytest.approx(0.1)
+    clock.now += 100
+    assert bucket.tokens < 5
+    bucket.charge(0)
+    assert bucket.tokens == 5
+    
+def test_limiter_takes_longer_of_both_delays(clock):
+    limiter = FlowLimiter(rate=10, burst=10, byte_rate=1000)
+    assert limiter.charge(1, 1000) == 0
+    # One frame left but the byte budget is a second overdrawn
+    assert limiter.charge(1, 1000) == pytest.approx(1.0)
+    
+def test_limiter_dimensions_can_be_unlimited(clock):
+    frames_only = FlowLimiter(rate=10, burst=1, byte_rate=None)
+    assert frames_only.bytes is None
+    assert frames_only.charge(1, 10 ** 9) == 0
+    bytes_only = FlowLimiter(rate=0, byte_rate=100)
+    assert bytes_only.frames is None
+    assert bytes_only.charge(10 ** 6, 100) == 0
+    
+def test_burst_defaults_to_rate(clock):
+    assert FlowLimiter(rate=7, burst=None).frames.burst == 7
+    
+def test_from_advertisement():
+    limiter = FlowLimiter.from_advertisement([100, 50, 4096])
+    assert (limiter.frames.rate, limiter.frames.burst, limiter.bytes.rate) == (100, 50, 4096)
+    limiter = FlowLimiter.from_advertisement([0, "x", 4096])
+    assert limiter.frames is None and limiter.bytes.rate == 4096
+    
+@pytest.mark.parametrize("flow", [None, "fast", [], [1, 2], [1, 2, 3, 4], [0, 0, 0], [-1, 5, None]])
+def test_unusable_advertisement_means_no_limit(flow):
+    assert FlowLimiter.from_advertisement(flow) is None
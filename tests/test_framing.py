@@ -0,0 +1,39 @@
+import pytest
+from framing import FrameDecoder, FrameTooLargeError, encode_frame
+
+def decode(decoder, data):
+    decoder.feed(data)
+    return [bytes(payload) for payload in decoder.frames()]
+    
+def test_frame_split_across_reads():
+    decoder = FrameDecoder()
+    data = encode_frame(b"hello world")
+    received = []
+    for offset in range(len(data)):
+        received += decode(decoder, data[offset:offset + 1])
+    assert received == [b"hello world"]
+    assert decoder.pending() == 0
+    
+def test_frames_merged_in_one_read():
+    decoder = FrameDecoder()
+    payloads = [b"a", b"", b"bc" * 100, b"d"]
+    data = b"".join(encode_frame(payload) for payload in payloads)
+    # The last frame's header arrives with the others, its payload later
+    assert decode(decoder, data[:-1]) == payloads[:-1]
+    assert decode(decoder, data[-1:]) == payloads[-1:]
+    
+def test_frame_larger_than_buffer():
+    decoder = FrameDecoder(buffer_size=16)
+    payload = bytes(range(256)) * 10
+    data = encode_frame(payload) + encode_frame(b"next")
+    assert decode(decoder, data[:100]) == []
+    assert decode(decoder, data[100:]) == [payload, b"next"]
+    # The buffer shrinks back once the oversized frame is consumed
+    assert len(decoder.get_buffer()) == 16
+    
+def test_frame_too_large():
+    decoder = FrameDecoder(max_frame_size=10)
+    decoder.feed(encode_frame(b"x" * 11))
+    with pytest.raises(FrameTooLargeError) as error:
+        list(decoder.frames())
+    assert (error.value.size, error.value.limit) == (11, 10)
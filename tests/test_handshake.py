@@ -0,0 +1,65 @@
+import json
+import socket
+import time
+import pytest
+from async_communication import AsyncNetworkCommunication
+from framing import FrameDecoder, encode_frame
+from network_communication import NetworkCommunication
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+        
+@pytest.fixture(params=[NetworkCommunication, AsyncNetworkCommunication], ids=["threads", "asyncio"])
+def server(request):
+    events = []
+    communication = request.param(free_port(), connection_callback=lambda address, up: events.append(up),
+                                  reconnect=False)
+    communication.start_server()
+    communication.events = events
+    yield communication
+    communication.stop()
+    
+def send_hello(port, hello):
+    """Send a hello as a raw peer, returning whether the server closed the connection."""
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as sock:
+        sock.sendall(encode_frame(json.dumps(hello).encode("utf-8")))
+        decoder = FrameDecoder()
+        try:
+            while decoder.recv_from(sock):
+                list(decoder.frames())
+        except socket.timeout:
+            return False
+    return True
+    
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+    
+@pytest.mark.parametrize("hello", [
+    {"type": "hello", "id": ["x"], "port": 5000},
+    {"type": "hello", "id": "", "port": 5000},
+    {"type": "hello", "port": 5000},
+    {"type": "hello", "id": "peer", "port": "5000"},
+    {"type": "hello", "id": "peer", "port": 0},
+    {"type": "hello", "id": "peer", "port": 70000},
+    {"type": "hello", "id": "peer", "port": True},
+    {"type": "hello", "id": "peer", "port": 5000, "codecs": 7},
+])
+def test_invalid_hello_is_rejected(server, hello):
+    assert send_hello(server.port, hello)
+    assert wait_for(lambda: server.metrics.snapshot()["counters"].get("connections_closed") == 1)
+    counters = server.metrics.snapshot()["counters"]
+    assert counters["invalid_hellos"] == 1
+    assert server.peer_ids == {} and server.connections == {}
+    assert server.events == []
+    
+def test_valid_hello_is_announced(server):
+    with socket.create_connection(("127.0.0.1", server.port), timeout=5) as sock:
+        sock.sendall(encode_frame(json.dumps({"type": "hello", "id": "peer", "port": 5000}).encode("utf-8")))
+        assert wait_for(lambda: "peer" in server.peer_ids)
+        assert server.events == [True]
+    assert wait_for(lambda: server.events == [True, False])
@@ -0,0 +1,142 @@
+import time
+import pytest
+from history_sync import ALL_BUCKETS, MAX_CLOCK_SKEW, SYNC_FANOUT, HistorySync, sync_fields
+from message_store import MessageStore
+from metrics import Metrics
+
+class Link:
+    """Stands in for the network, passing sync messages between two instances by hand."""
+    def __init__(self):
+        self.metrics = Metrics()
+        self.queue = []
+        
+    def send_message(self, address, message):
+        self.queue.append((address, message))
+        return True
+        
+class Node:
+    def __init__(self, path, name, link):
+        self.store = MessageStore(str(path), flush_interval=0.01)
+        self.shown = []
+        self.sync = HistorySync(link, self.store, "*", lambda author: f"Peer ({author})",
+                                lambda sender, content, key: self.shown.append(content))
+        self.handlers = {
+            "sync_ranges": self.sync._on_ranges,
+            "sync_ids": self.sync._on_ids,
+            "sync_request": self.sync._on_request,
+            "sync_messages": self.sync._on_messages,
+        }
+        
+    def add(self, n):
+        self.store.append("*", "x", f"message {n}", timestamp=1_700_000_000 + n * 60, uid=f"uid{n}", author="x")
+        
+    def close(self):
+        self.sync.stop()
+        self.store.close()
+        
+@pytest.fixture
+def nodes(tmp_path):
+    link = Link()
+    pair = Node(tmp_path / "a.sqlite3", "A", link), Node(tmp_path / "b.sqlite3", "B", link)
+    yield link, pair
+    for node in pair:
+        node.close()
+        
+def run_sync(link, a, b):
+    """Run a sync started by a to completion, returning the number of rounds."""
+    low, high = ALL_BUCKETS
+    a.store.flush()
+    b.store.flush()
+    link.queue.append(("b", {"type": "sync_ranges",
+                             "ranges": [a.sync._summarise(a.store.sync_buckets(low, high), low, high)]}))
+    rounds = 0
+    while link.queue:
+        rounds += 1
+        address, message = link.queue.pop(0)
+        # Messages addressed to b came from a, and the other way round
+        receiver, sender = (b, "a") if address == "b" else (a, "b")
+        before = len(link.queue)
+        receiver.handlers[message["type"]](sender, message)
+        receiver.store.flush()
+        # Replies go back to whoever sent the message
+        link.queue[before:] = [(sender, reply) for _, reply in link.queue[before:]]
+    return rounds
+    
+def uids(node):
+    return set(node.store.sync_ids(*ALL_BUCKETS))
+    
+def test_split_covers_range_without_gaps(nodes):
+    _, (a, _) = nodes
+    buckets = [(bucket, bucket * 7, 1 + bucket % 3) for bucket in range(100, 300)]
+    ranges = a.sync._split(buckets, 50, 400)
+    assert len(ranges) <= SYNC_FANOUT
+    assert ranges[0][0] == 50 and ranges[-1][1] == 400
+    assert all(previous[1] == following[0] for previous, following in zip(ranges, ranges[1:]))
+    assert sum(entry[3] for entry in ranges) == sum(count for _, _, count in buckets)
+    
+def test_split_single_bucket(nodes):
+    _, (a, _) = nodes
+    assert a.sync._split([(5, 9, 3)], 0, 10) == [[0, 10, 9, 3]]
+    
+def test_identical_histories_cost_one_round(nodes):
+    link, (a, b) = nodes
+    for n in range(500):
+        a.add(n)
+        b.add(n)
+    assert run_sync(link, a, b) == 1
+    assert a.shown == b.shown == []
+    
+def test_sync_transfers_only_missing_messages(nodes):
+    link, (a, b) = nodes
+    a_lacks = {10, 400, 401}
+    b_lacks = {0, 250, 999}
+    for n in range(1000):
+        if n not in a_lacks:
+            a.add(n)
+        if n not in b_lacks:
+            b.add(n)
+    run_sync(link, a, b)
+    assert uids(a) == uids(b) == {f"uid{n}" for n in range(1000)}
+    assert sorted(a.shown) == sorted(f"message {n}" for n in a_lacks)
+    assert sorted(b.shown) == sorted(f"message {n}" for n in b_lacks)
+    counters = link.metrics.snapshot()["counters"]
+    assert counters["sync_messages_sent"] == len(a_lacks) + len(b_lacks)
+    
+def test_sync_into_empty_history(nodes):
+    link, (a, b) = nodes
+    for n in range(300):
+        b.add(n)
+    run_sync(link, a, b)
+    assert len(uids(a)) == 300
+    assert len(a.shown) == 300
+    
+def test_sync_fields():
+    now = time.time()
+    assert sync_fields({"uid": "u", "sent_at": now, "author": "a"}) == {"uid": "u", "timestamp": now, "author": "a"}
+    assert sync_fields({"uid": "u", "sent_at": now, "author": None}) == {}
+    assert sync_fields({"uid": 5, "sent_at": now, "author": "a"}) == {}
+    assert sync_fields({"uid": "u", "sent_at": -1, "author": "a"}) == {}
+    assert sync_fields({"uid": "u", "sent_at": "now", "author": "a"}) == {}
+    assert sync_fields({"uid": "u", "sent_at": float("nan"), "author": "a"}) == {}
+    assert sync_fields({"uid": "u", "sent_at": now + MAX_CLOCK_SKEW + 60, "author": "a"}) == {}
+    assert sync_fields({"uid": "u", "sent_at": now + MAX_CLOCK_SKEW - 60, "author": "a"}) != {}
+    
+def test_synced_messages_are_never_ours(nodes):
+    _, (a, _) = nodes
+    # A peer claiming to relay a message we wrote
+    a.sync._on_messages("b", {"messages": [["forged", 1_700_000_000, "A", "words in our mouth"]]})
+    a.store.flush()
+    [(key, sender, content)] = a.store.load_page(peer="*")
+    assert sender == "Peer (A)"
+    with a.store._read_lock:
+        assert a.store._read_conn.execute("SELECT outgoing FROM messages").fetchall() == [(0,)]
+        
+def test_synced_messages_from_the_future_are_dropped(nodes):
+    _, (a, _) = nodes
+    a.sync._on_messages("b", {"messages": [
+        ["future", time.time() + 10 * MAX_CLOCK_SKEW, "x", "from the future"],
+        ["malformed", 1_700_000_000, "x"],
+        ["present", time.time(), "x", "from now"],
+    ]})
+    a.store.flush()
+    assert a.shown == ["from now"]
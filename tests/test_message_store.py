@@ -0,0 +1,129 @@
+import sqlite3
+import pytest
+from message_store import MessageStore
+
+@pytest.fixture
+def store(tmp_path):
+    store = MessageStore(str(tmp_path / "history.sqlite3"))
+    yield store
+    store.close()
+    
+def contents(records):
+    return [record[-1] for record in records]
+    
+def test_search_matches_every_word_and_prefix(store):
+    store.append("10.0.0.1", "a", "the quick brown fox", timestamp=1)
+    store.append("10.0.0.1", "a", "a quick reply", timestamp=2)
+    store.append("10.0.0.1", "a", "brown bread", timestamp=3)
+    store.flush()
+    assert contents(store.search("quick")) == ["a quick reply", "the quick brown fox"]
+    assert contents(store.search("quick bro")) == ["the quick brown fox"]
+    assert store.search("NEAR AND") == []
+    assert store.search("  !! ") == []
+    
+def test_search_orders_by_message_time(store):
+    # Synced messages are written after newer ones but keep their own time
+    store.append("*", "a", "sync late", timestamp=300)
+    store.append("*", "a", "sync early", timestamp=100)
+    store.append("*", "a", "sync middle", timestamp=200)
+    store.flush()
+    records = store.search("sync")
+    assert contents(records) == ["sync late", "sync middle", "sync early"]
+    assert [key[0] for key, *_ in records] == [300, 200, 100]
+    
+def test_search_peer_filter_is_exact(store):
+    store.append("192.168.1.5", "a", "hello five", timestamp=1)
+    store.append("10.192.168.1.5", "a", "hello other", timestamp=2)
+    store.append("192.168.1.50", "a", "hello fifty", timestamp=3)
+    store.append("*", "a", "hello room", timestamp=4)
+    store.flush()
+    assert contents(store.search("hello", peer="192.168.1.5")) == ["hello five"]
+    assert contents(store.search("hello", peer="*")) == ["hello room"]
+    assert store.search("missing", peer="192.168.1.5") == []
+    assert len(store.search("hello")) == 4
+    
+def test_search_limit_and_time_range(store):
+    for n in range(50):
+        store.append("10.0.0.1", "a", f"note {n}", timestamp=n)
+    store.flush()
+    assert contents(store.search("note", limit=3)) == ["note 49", "note 48", "note 47"]
+    assert contents(store.search("note", since=10, until=13)) == ["note 12", "note 11", "note 10"]
+    
+def test_room_search_is_not_limited_to_newest_matches(store):
+    store.append("*", "a", "topic in the room", timestamp=1)
+    for n in range(100):
+        store.append("10.0.0.1", "a", f"topic {n}", timestamp=n + 2)
+    store.flush()
+    assert contents(store.search("topic", peer="*", limit=5)) == ["topic in the room"]
+    
+def test_index_without_peer_is_rebuilt(tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    store = MessageStore(path)
+    store.close()
+    # Recreate the index as older versions wrote it
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("DROP TRIGGER messages_search_insert")
+        conn.execute("DROP TABLE messages_search")
+        conn.execute("INSERT INTO messages (id, peer, timestamp, sender, content, outgoing) "
+                     "VALUES (1, '10.0.0.1', 1, 'a', 'kept message', 0)")
+        conn.execute("CREATE VIRTUAL TABLE messages_search USING fts5(content, content='messages', content_rowid='id')")
+    conn.close()
+    store = MessageStore(path)
+    try:
+        assert contents(store.search("kept", peer="10.0.0.1")) == ["kept message"]
+    finally:
+        store.close()
+    
+def test_page_returns_newest_oldest_first(store):
+    for i in range(10):
+        store.append("10.0.0.1", "a", f"m{i}", timestamp=i)
+    store.flush()
+    assert contents(store.load_page(limit=3)) == ["m7", "m8", "m9"]
+    assert len(store.load_page()) == 10
+
+def test_page_before_and_after_key(store):
+    keys = [store.append("10.0.0.1", "a", f"m{i}", timestamp=i) for i in range(10)]
+    store.flush()
+    assert contents(store.load_page(before=keys[5], limit=2)) == ["m3", "m4"]
+    assert contents(store.load_page(after=keys[5], limit=2)) == ["m6", "m7"]
+    assert contents(store.load_page(before=keys[0])) == []
+    assert contents(store.load_page(after=keys[9])) == []
+    
+def test_page_keys_break_timestamp_ties(store):
+    keys = [store.append("10.0.0.1", "a", f"m{i}", timestamp=5) for i in range(4)]
+    store.flush()
+    page = store.load_page(before=keys[2])
+    assert contents(page) == ["m0", "m1"]
+    assert [key for key, *_ in page] == keys[:2]
+    assert contents(store.load_page(after=keys[1])) == ["m2", "m3"]
+    
+def test_page_pages_through_whole_history(store):
+    for i in range(25):
+        store.append("10.0.0.1", "a", f"m{i}", timestamp=i)
+    store.flush()
+    seen = []
+    page = store.load_page(limit=10)
+    while page:
+        seen[:0] = contents(page)
+        page = store.load_page(before=page[0][0], limit=10)
+    assert seen == [f"m{i}" for i in range(25)]
+    
+def test_page_peer_filter(store):
+    store.append("10.0.0.1", "a", "one", timestamp=1)
+    store.append("10.0.0.2", "b", "two", timestamp=2)
+    store.append("10.0.0.1", "a", "three", timestamp=3)
+    store.flush()
+    assert contents(store.load_page(peer="10.0.0.1")) == ["one", "three"]
+    assert contents(store.load_page(peer="10.0.0.3")) == []
+    
+def test_page_survives_reopen(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    store = MessageStore(path)
+    store.append("10.0.0.1", "a", "kept", timestamp=1)
+    store.close()
+    store = MessageStore(path)
+    try:
+        assert store.load_page() == [((1, 1), "a", "kept")]
+    finally:
+        store.close()
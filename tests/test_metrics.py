@@ -0,0 +1,84 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from metrics import Histogram, Metrics, start_stats_server
+
+def test_counters_add_up():
+    metrics = Metrics()
+    metrics.increment("sent")
+    metrics.increment("sent", 4)
+    assert metrics.snapshot()["counters"] == {"sent": 5}
+    
+def test_counters_from_other_threads_are_kept():
+    metrics = Metrics()
+    threads = [threading.Thread(target=lambda: [metrics.increment("sent") for _ in range(1000)])
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.increment("sent")
+    # The first snapshot retires the finished threads' shards; the totals must not change
+    assert metrics.snapshot()["counters"]["sent"] == 4001
+    assert metrics.snapshot()["counters"]["sent"] == 4001
+    
+def test_collectors_add_to_counters():
+    metrics = Metrics()
+    metrics.increment("frames", 2)
+    metrics.add_collector(lambda: {"frames": 3, "peers": 1})
+    assert metrics.snapshot()["counters"] == {"frames": 5, "peers": 1}
+    
+def test_histogram_summary():
+    histogram = Histogram()
+    for microseconds in range(1, 101):
+        histogram.observe(microseconds * 1000)
+    summary = histogram.snapshot()
+    assert summary["count"] == 100
+    assert summary["min"] == pytest.approx(1e-6)
+    assert summary["max"] == pytest.approx(100e-6)
+    assert summary["mean"] == pytest.approx(50.5e-6)
+    # Percentiles are bucket upper bounds, within a factor of two of the true value
+    assert 50e-6 <= summary["p50"] <= 100e-6
+    assert summary["p99"] == summary["p999"] == pytest.approx(100e-6)
+    
+def test_histogram_clamps_huge_durations():
+    histogram = Histogram()
+    histogram.observe(10 ** 15)
+    assert histogram.percentile(0.5) == pytest.approx(10 ** 6)
+    
+def test_empty_histogram():
+    summary = Histogram().snapshot()
+    assert summary["count"] == 0
+    assert summary["p50"] is summary["mean"] is summary["max"] is None
+    
+def test_histogram_merge():
+    first, second = Histogram(), Histogram()
+    first.observe(2000)
+    second.observe(1000)
+    second.observe(8000)
+    first.merge(second)
+    assert (first.count, first.min, first.max, first.total) == (3, 1000, 8000, 11000)
+    
+def test_timer_records_block():
+    metrics = Metrics()
+    for _ in range(3):
+        with metrics.timer("work"):
+            pass
+    summary = metrics.snapshot()["histograms"]["work"]
+    assert summary["count"] == 3
+    assert summary["min"] >= 0
+    
+def test_stats_server():
+    server = start_stats_server(0, lambda: {"counters": {"sent": 1}})
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        with urllib.request.urlopen(url + "/stats", timeout=5) as response:
+            assert json.load(response) == {"counters": {"sent": 1}}
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + "/other", timeout=5)
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
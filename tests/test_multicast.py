@@ -0,0 +1,124 @@
+import uuid
+import pytest
+import multicast
+from multicast import MulticastChannel
+
+SENDER = uuid.uuid4()
+ADDRESS = ("192.0.2.1", 5000)
+
+class Receiver:
+    """A channel that is never started, fed datagrams directly."""
+    def __init__(self):
+        self.delivered = []
+        self.requests = []
+        self.channel = MulticastChannel(str(uuid.uuid4()), 5001, self.deliver, self.request_repair)
+        
+    def deliver(self, sender, address, message):
+        self.delivered.append(message["n"])
+        
+    def request_repair(self, sender, seqs):
+        self.requests.append(list(seqs))
+        return True
+        
+    def datagram(self, seq, n=None):
+        payload = b"" if n is None else multicast.JSON_CODEC.encode({"n": n})
+        header = multicast.DATAGRAM_HEADER.pack(multicast.DATAGRAM_MAGIC, SENDER.bytes, ADDRESS[1], seq)
+        self.channel._on_datagram(header + payload, ADDRESS[0])
+        
+@pytest.fixture
+def receiver():
+    return Receiver()
+    
+def test_delivers_in_order(receiver):
+    for seq in (1, 2, 3):
+        receiver.datagram(seq, seq)
+    assert receiver.delivered == [1, 2, 3]
+    assert receiver.requests == []
+    
+def test_gap_is_repaired(receiver):
+    receiver.datagram(1, 1)
+    receiver.datagram(4, 4)
+    assert receiver.delivered == [1]
+    assert receiver.requests == [[2, 3]]
+    receiver.datagram(5, 5)
+    # Missing messages are asked for once
+    assert receiver.requests == [[2, 3]]
+    receiver.channel.on_repair(SENDER, 3, ADDRESS, {"n": 3})
+    receiver.channel.on_repair(SENDER, 2, ADDRESS, {"n": 2})
+    assert receiver.delivered == [1, 2, 3, 4, 5]
+    # A late duplicate is dropped
+    receiver.datagram(2, 2)
+    assert receiver.delivered == [1, 2, 3, 4, 5]
+    
+def test_heartbeat_reveals_lost_tail(receiver):
+    receiver.datagram(1, 1)
+    receiver.datagram(3)
+    assert receiver.requests == [[2, 3]]
+    
+def test_gap_expires(receiver, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(multicast.time, "monotonic", lambda: clock[0])
+    receiver.datagram(1, 1)
+    receiver.datagram(3, 3)
+    receiver.datagram(6, 6)
+    receiver.channel._expire_gaps()
+    assert receiver.delivered == [1]
+    clock[0] += multicast.REPAIR_TIMEOUT
+    receiver.channel._expire_gaps()
+    assert receiver.delivered == [1, 3]
+    assert receiver.channel.metrics.snapshot()["counters"]["multicast_lost"] == 1
+    # The next gap gets its own timeout
+    receiver.channel._expire_gaps()
+    assert receiver.delivered == [1, 3]
+    clock[0] += multicast.REPAIR_TIMEOUT
+    receiver.channel._expire_gaps()
+    assert receiver.delivered == [1, 3, 6]
+    
+def test_expect_recovers_messages_lost_before_the_first(receiver):
+    receiver.channel.expect(SENDER, 1)
+    receiver.datagram(3, 3)
+    assert receiver.delivered == []
+    assert receiver.requests == [[1, 2]]
+    
+def test_without_expect_starts_at_first_datagram(receiver):
+    receiver.datagram(3, 3)
+    assert receiver.delivered == [3]
+    # Once datagrams arrived, a late expect changes nothing
+    receiver.channel.expect(SENDER, 1)
+    receiver.datagram(4, 4)
+    assert receiver.delivered == [3, 4]
+    assert receiver.requests == []
+    
+def test_gap_beyond_history_is_given_up(receiver):
+    receiver.datagram(1, 1)
+    receiver.datagram(3_000_000)
+    # Only what the sender can still hold is asked for
+    assert len(receiver.requests) == 1
+    assert receiver.requests[0] == list(range(3_000_000 - multicast.HISTORY_SIZE + 1, 3_000_001))
+    counters = receiver.channel.metrics.snapshot()["counters"]
+    assert counters["multicast_lost"] == 3_000_000 - multicast.HISTORY_SIZE - 1
+    
+def test_messages_held_behind_a_skipped_gap_are_delivered(receiver):
+    receiver.datagram(1, 1)
+    receiver.datagram(3, 3)
+    receiver.datagram(multicast.HISTORY_SIZE + 10, "last")
+    assert receiver.delivered[:2] == [1, 3]
+    
+def test_streams_are_capped(receiver, monkeypatch):
+    monkeypatch.setattr(multicast, "MAX_STREAMS", 4)
+    channel = receiver.channel
+    senders = [uuid.uuid4() for _ in range(6)]
+    for sender in senders:
+        channel.on_repair(sender, 1, ADDRESS, {"n": 1})
+    assert list(channel._streams) == senders[2:]
+    
+def test_idle_streams_are_dropped(receiver, monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(multicast.time, "monotonic", lambda: clock[0])
+    receiver.datagram(1, 1)
+    clock[0] += multicast.STREAM_IDLE_TIMEOUT - 1
+    receiver.channel._expire_gaps()
+    assert SENDER in receiver.channel._streams
+    clock[0] += 1
+    receiver.channel._expire_gaps()
+    assert SENDER not in receiver.channel._streams
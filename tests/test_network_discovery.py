@@ -0,0 +1,16 @@
+from network_discovery import NetworkDiscovery
+
+def select(local_ip, addresses):
+    discovery = NetworkDiscovery.__new__(NetworkDiscovery)  # Address ranking needs no zeroconf
+    discovery.local_ip = local_ip
+    return discovery._select_address(addresses)
+    
+def test_prefers_own_subnet():
+    assert select("192.168.1.10", ["10.0.0.5", "192.168.1.20"]) == "192.168.1.20"
+    
+def test_avoids_link_local():
+    assert select("192.168.1.10", ["169.254.3.3", "10.0.0.5"]) == "10.0.0.5"
+    assert select("192.168.1.10", ["169.254.3.3"]) == "169.254.3.3"
+    
+def test_nothing_offered():
+    assert select("192.168.1.10", []) is None
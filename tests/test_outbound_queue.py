@@ -0,0 +1,64 @@
+import threading
+import time
+import pytest
+from metrics import Metrics
+from network_communication import (SEND_POLICY_BLOCK, SEND_POLICY_DISCONNECT, SEND_POLICY_DROP,
+                                   OutboundQueue)
+                                   
+def full_queue(policy, **kwargs):
+    queue = OutboundQueue(maxsize=2, policy=policy, metrics=Metrics(), **kwargs)
+    assert queue.put(b"a") == queue.put(b"b") == OutboundQueue.QUEUED
+    return queue
+    
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        OutboundQueue(policy="spin")
+        
+def test_drop_discards_new_frame():
+    queue = full_queue(SEND_POLICY_DROP)
+    assert queue.put(b"c") == OutboundQueue.DROPPED
+    assert queue.take() == [b"a", b"b"]
+    assert queue.stats()["dropped_frames"] == 1
+    assert queue.metrics.snapshot()["counters"]["frames_dropped"] == 1
+    
+def test_disconnect_reports_overflow():
+    queue = full_queue(SEND_POLICY_DISCONNECT)
+    assert queue.put(b"c") == OutboundQueue.OVERFLOW
+    assert queue.stats()["max_depth"] == 2
+    
+def test_block_waits_for_room():
+    queue = full_queue(SEND_POLICY_BLOCK, block_timeout=5)
+    threading.Timer(0.05, queue.take).start()
+    assert queue.put(b"c") == OutboundQueue.QUEUED
+    assert queue.take() == [b"c"]
+    
+def test_block_gives_up_after_timeout():
+    queue = full_queue(SEND_POLICY_BLOCK, block_timeout=0.05)
+    start = time.monotonic()
+    assert queue.put(b"c") == OutboundQueue.DROPPED
+    assert 0.05 <= time.monotonic() - start < 1
+    
+def test_block_is_bounded_by_default():
+    queue = full_queue(SEND_POLICY_BLOCK)
+    assert queue.block_timeout is not None
+    
+def test_block_never_waits_when_caller_cannot():
+    queue = full_queue(SEND_POLICY_BLOCK, block_timeout=5)
+    start = time.monotonic()
+    assert queue.put(b"c", can_block=False) == OutboundQueue.DROPPED
+    assert time.monotonic() - start < 1
+    
+def test_close_wakes_blocked_sender():
+    queue = full_queue(SEND_POLICY_BLOCK, block_timeout=5)
+    threading.Timer(0.05, queue.close).start()
+    assert queue.put(b"c") == OutboundQueue.CLOSED
+    assert queue.put(b"d") == OutboundQueue.CLOSED
+    # Queued frames are still handed out once closed, then the end is reported
+    assert queue.take() == [b"a", b"b"]
+    assert queue.take() is None
+    
+def test_take_without_blocking():
+    queue = OutboundQueue()
+    assert queue.take(block=False) == []
+    queue.record_sent(3, 30)
+    assert queue.stats()["sent_frames"] == 3 and queue.stats()["sent_bytes"] == 30
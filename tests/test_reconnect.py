@@ -0,0 +1,94 @@
+import threading
+import time
+import pytest
+from reconnect import ReconnectScheduler
+
+def test_backoff_doubles_up_to_max_delay():
+    scheduler = ReconnectScheduler(None, base_delay=0.5, max_delay=10, jitter=0)
+    assert [scheduler.backoff(attempt) for attempt in range(7)] == [0.5, 1, 2, 4, 8, 10, 10]
+    
+def test_backoff_jitter_only_shortens_delay():
+    scheduler = ReconnectScheduler(None, base_delay=1, max_delay=60, jitter=0.5)
+    delays = [scheduler.backoff(3) for _ in range(200)]
+    assert all(4 <= delay <= 8 for delay in delays)
+    assert len(set(delays)) > 1
+    
+class Peer:
+    """connect() stand-in failing a set number of times before it succeeds."""
+    def __init__(self, failures):
+        self.failures = failures
+        self.attempts = []
+        self.done = threading.Event()
+        
+    def connect(self, ip, port):
+        self.attempts.append(time.monotonic())
+        if len(self.attempts) > self.failures:
+            self.done.set()
+            return True
+        return False
+        
+@pytest.fixture
+def scheduler():
+    schedulers = []
+    
+    def create(connect, **kwargs):
+        scheduler = ReconnectScheduler(connect, base_delay=0.02, jitter=0, **kwargs)
+        scheduler.start()
+        schedulers.append(scheduler)
+        return scheduler
+        
+    yield create
+    for created in schedulers:
+        created.stop()
+        
+def test_retries_with_growing_delays(scheduler):
+    peer = Peer(failures=3)
+    reconnects = scheduler(peer.connect)
+    reconnects.schedule("peer", "127.0.0.1", 5000)
+    assert peer.done.wait(5)
+    gaps = [later - earlier for earlier, later in zip(peer.attempts, peer.attempts[1:])]
+    assert len(gaps) == 3
+    assert gaps[0] >= 0.04 and gaps[1] >= 0.08 and gaps[2] >= 0.16
+    assert "peer" not in reconnects.pending
+    
+def test_gives_up_after_max_attempts(scheduler):
+    peer = Peer(failures=100)
+    reconnects = scheduler(peer.connect, max_attempts=2)
+    reconnects.schedule("peer", "127.0.0.1", 5000)
+    deadline = time.monotonic() + 5
+    while "peer" in reconnects.pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert "peer" not in reconnects.pending
+    assert len(peer.attempts) == 2
+    
+def test_one_pending_attempt_per_key(scheduler):
+    peer = Peer(failures=0)
+    reconnects = scheduler(peer.connect)
+    reconnects.schedule("peer", "127.0.0.1", 5000, delay=0.1)
+    reconnects.schedule("peer", "127.0.0.1", 5000)
+    assert peer.done.wait(5)
+    time.sleep(0.2)
+    assert len(peer.attempts) == 1
+    
+def test_success_brings_backed_off_attempts_forward(scheduler):
+    slow = Peer(failures=100)
+    fast = Peer(failures=0)
+    reconnects = scheduler(lambda ip, port: (fast if port == 1 else slow).connect(ip, port), max_delay=60)
+    reconnects.schedule("slow", "127.0.0.1", 2)
+    # Once its first attempt has failed, back the slow peer off beyond the test's patience
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with reconnects._cond:
+            entry = reconnects.pending["slow"]
+            if entry["attempt"] == 1:
+                entry["attempt"] = 10
+                reconnects._push(entry, time.monotonic() + 60)
+                break
+        time.sleep(0.005)
+    assert len(slow.attempts) == 1
+    reconnects.schedule("fast", "127.0.0.1", 1)
+    assert fast.done.wait(5)
+    deadline = time.monotonic() + 5
+    while len(slow.attempts) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(slow.attempts) >= 2
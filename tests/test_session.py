@@ -0,0 +1,41 @@
+from session import ACK_INTERVAL, PeerSession
+
+def test_add_numbers_messages_from_one():
+    session = PeerSession("peer")
+    assert [session.add(f"m{n}") for n in range(3)] == [(1, 0), (2, 0), (3, 0)]
+    
+def test_acknowledge_forgets_acknowledged_messages():
+    session = PeerSession("peer")
+    for n in range(5):
+        session.add(f"m{n}")
+    session.acknowledge(3)
+    assert session.unacked_after(0) == [(4, "m3"), (5, "m4")]
+    # A stale ack changes nothing
+    session.acknowledge(1)
+    assert list(session.unacked) == [4, 5]
+    assert session.unacked_after(4) == [(5, "m4")]
+    
+def test_full_buffer_evicts_oldest():
+    session = PeerSession("peer", buffer_size=3)
+    for n in range(3):
+        session.add(n)
+    assert session.add(3) == (4, 1)
+    assert list(session.unacked) == [2, 3, 4]
+    
+def test_accept_reports_duplicates_and_losses():
+    session = PeerSession("peer")
+    assert session.accept(1) == 0
+    assert session.accept(1) is None
+    assert session.accept(4) == 2
+    assert session.accept(3) is None
+    assert session.received == 4
+    
+def test_ack_due_after_interval():
+    session = PeerSession("peer")
+    for seq in range(1, ACK_INTERVAL):
+        session.accept(seq)
+    assert not session.ack_due()
+    session.accept(ACK_INTERVAL)
+    assert session.ack_due()
+    session.acked_sent = session.received
+    assert not session.ack_due()
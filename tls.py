@@ -0,0 +1,234 @@
+import datetime
+import hashlib
+import os
+import re
+import ssl
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Our certificate only lives as long as the process, but clocks on a LAN may disagree
+CERTIFICATE_DAYS = 365
+
+# Peers whose TLS sessions are kept for resuming, like the message sessions in session.py
+MAX_TLS_SESSIONS = 256
+
+# Bytes read from the socket at a time by TLSSocket; a full TLS record and its header
+RECEIVE_SIZE = 16 * 1024 + 256
+
+# Peer ids that can double as the server name a session is saved under
+_SERVER_NAME = re.compile(r"[A-Za-z0-9-]{1,63}")
+
+class TLSError(Exception):
+    """Raised when a certificate cannot be created."""
+    
+def certificate_fingerprint(der):
+    """Return the fingerprint peers pin a DER-encoded certificate to."""
+    return hashlib.sha256(der).hexdigest()
+    
+def generate_certificate(common_name, certfile, keyfile):
+    """Write a new self-signed ECDSA certificate and its private key as PEM files."""
+    # Optional and slow to import, so only loaded when a certificate is needed
+    try:
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.x509.oid import NameOID
+    except ImportError:
+        command = ["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1",
+                   "-nodes", "-days", str(CERTIFICATE_DAYS), "-subj", f"/CN={common_name}",
+                   "-keyout", keyfile, "-out", certfile]
+        try:
+            subprocess.run(command, check=True, capture_output=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise TLSError(f"Cannot create a certificate; install the cryptography package or openssl: {e}") from e
+        return
+        
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name)
+                   .issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(days=1))
+                   .not_valid_after(now + datetime.timedelta(days=CERTIFICATE_DAYS))
+                   .sign(key, hashes.SHA256()))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(certfile, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+        
+class _ResumingContext(ssl.SSLContext):
+    """Client context that offers the session saved for the peer named by server_hostname.
+
+    Both transports create their TLS objects through wrap_bio(), asyncio without a way
+    to pass a session, so the server name is what tells us which peer is being dialled.
+    """
+    sessions = None  # {server name: SSLSession}, set by TLSIdentity
+    
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and self.sessions is not None:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+        
+class TLSIdentity:
+    """This node's self-signed certificate and the TLS contexts for its connections.
+
+    There is no certificate authority on a LAN: peers check our certificate against
+    the fingerprint we advertise in our discovery record instead. Peers that dial us
+    authenticate with their own certificate once the handshake is done, as we only
+    learn which certificate to expect from their hello; see trust(). The client context
+    keeps the latest session of every peer it connects to, by peer id, so reconnecting
+    after a network blip takes an abbreviated handshake instead of a full one.
+    """
+    def __init__(self, certfile, keyfile, max_sessions=MAX_TLS_SESSIONS):
+        self.server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.server_context.minimum_version = ssl.TLSVersion.TLSv1_3
+        self.server_context.load_cert_chain(certfile, keyfile)
+        self.server_context.num_tickets = 1  # Clients only keep the latest session anyway
+        # Clients are only asked for their certificate after the handshake, when asked to
+        self.server_context.post_handshake_auth = True
+        self.server_context.verify_mode = ssl.CERT_OPTIONAL
+        
+        self.client_context = _ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.client_context.minimum_version = ssl.TLSVersion.TLSv1_3
+        # Self-signed certificates are checked against the pinned fingerprint instead
+        self.client_context.check_hostname = False
+        self.client_context.verify_mode = ssl.CERT_NONE
+        self.client_context.load_cert_chain(certfile, keyfile)
+        self.client_context.post_handshake_auth = True
+        self.sessions = self.client_context.sessions = OrderedDict()  # Least recently used first
+        self.max_sessions = max_sessions
+        
+        with open(certfile, encoding="ascii") as f:
+            self.certificate = ssl.PEM_cert_to_DER_cert(f.read())  # Sent in our hello, see trust()
+        self.fingerprint = certificate_fingerprint(self.certificate)
+            
+    @classmethod
+    def generate(cls, common_name):
+        """Create an identity with a new certificate, kept only in memory."""
+        with tempfile.TemporaryDirectory() as directory:
+            certfile = os.path.join(directory, "cert.pem")
+            keyfile = os.path.join(directory, "key.pem")
+            generate_certificate(common_name, certfile, keyfile)
+            return cls(certfile, keyfile)
+            
+    def trust(self, certificate):
+        """Let peers authenticate to us with a DER-encoded certificate.
+
+        OpenSSL only accepts client certificates it can verify, so the certificates of
+        peers that dial us are trusted one by one, once they match a pinned fingerprint.
+        """
+        self.server_context.load_verify_locations(cadata=certificate)
+            
+    def server_name(self, peer_id):
+        """Return the server name to dial a peer with, so its saved session is offered."""
+        return peer_id if peer_id and _SERVER_NAME.fullmatch(peer_id) else None
+        
+    def save_session(self, peer_id, session):
+        """Keep the latest session of a peer we connected to, for the next connection."""
+        name = self.server_name(peer_id)
+        if name is None or session is None:
+            return
+        self.sessions[name] = session
+        self.sessions.move_to_end(name)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+            
+class TLSSocket:
+    """Blocking TLS connection for a reader thread and a writer thread working at once.
+
+    OpenSSL does not allow one connection to be used from two threads at the same
+    time, so the TLS state lives in an SSLObject over memory buffers, guarded by a
+    lock that is never held during socket I/O. Offers the socket methods the threaded
+    transport uses.
+    """
+    def __init__(self, sock, context, server_side=False, server_hostname=None):
+        self.sock = sock
+        self._incoming = ssl.MemoryBIO()
+        self._outgoing = ssl.MemoryBIO()
+        self.tls_object = context.wrap_bio(self._incoming, self._outgoing, server_side, server_hostname)
+        self._lock = threading.Lock()  # Guards the SSLObject and its buffers
+        self._send_lock = threading.Lock()  # Keeps encrypted records in order on the socket
+        
+    def do_handshake(self):
+        """Complete the handshake, within the socket's timeout."""
+        while True:
+            try:
+                with self._lock:
+                    self.tls_object.do_handshake()
+                self._flush()
+                return
+            except ssl.SSLWantReadError:
+                self._flush()
+                if not self._receive():
+                    raise ConnectionError("Connection closed during the TLS handshake")
+                    
+    def _receive(self):
+        """Feed the next bytes from the socket to TLS. Returns False at EOF."""
+        data = self.sock.recv(RECEIVE_SIZE)
+        with self._lock:
+            if data:
+                self._incoming.write(data)
+            else:
+                self._incoming.write_eof()
+        return bool(data)
+        
+    def _flush(self, blocking=True):
+        """Send whatever TLS has produced."""
+        # A writer already sending will pick up anything left behind on its next write
+        if not self._send_lock.acquire(blocking):
+            return
+        try:
+            with self._lock:
+                data = self._outgoing.read()
+            if data:
+                self.sock.sendall(data)
+        finally:
+            self._send_lock.release()
+            
+    def recv_into(self, buffer):
+        """Decrypt received data into buffer. Returns 0 once the peer has closed."""
+        while True:
+            try:
+                with self._lock:
+                    return self.tls_object.read(len(buffer), buffer)
+            except ssl.SSLWantReadError:
+                pass
+            except (ssl.SSLZeroReturnError, ssl.SSLEOFError):
+                return 0
+            # Reading may have produced records to answer, such as a key update
+            self._flush(blocking=False)
+            self._receive()
+            
+    def sendall(self, data):
+        """Encrypt and send all of data."""
+        with self._send_lock:
+            with self._lock:
+                view = memoryview(data)
+                while view:
+                    view = view[self.tls_object.write(view):]
+                records = self._outgoing.read()
+            self.sock.sendall(records)
+            
+    def getpeercert(self, binary_form=False):
+        with self._lock:
+            return self.tls_object.getpeercert(binary_form)
+            
+    def verify_client_post_handshake(self):
+        """Ask the client for its certificate; the request goes out with the next write."""
+        with self._lock:
+            self.tls_object.verify_client_post_handshake()
+            
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+        
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+        
+    def close(self):
+        self.sock.close()